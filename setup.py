@@ -3,7 +3,7 @@
 
 from setuptools import find_packages, setup
 
-test_requires = ['docker>=2.0', 'mock', 'nose']
+test_requires = ['docker>=2.0', 'mock', 'nose', 'pymysql']
 
 setup(
     author='Riccardo Coccioli',
@@ -14,7 +14,7 @@ setup(
             'switchdc = switchdc.switch:main',
         ],
     },
-    extras_require={'test': test_requires},
+    extras_require={'mysql': ['pymysql'], 'test': test_requires},
     install_requires=['pyyaml',  'redis', 'requests', 'dnspython'],
     test_requires=test_requires,
     name='switchdc',
@@ -5,7 +5,9 @@ from conftool.drivers import BackendError
 
 from switchdc import SwitchdcError
 from switchdc.dry_run import is_dry_run
+from switchdc.lib.governor import governor
 from switchdc.log import logger
+from switchdc.timing import timed_call, timed_generator
 
 
 class ConfigError(SwitchdcError):
@@ -24,9 +26,13 @@ class Confctl(object):
         selectors = {}
         for tag, expr in tags.items():
             selectors[tag] = re.compile('^{}$'.format(expr))
-        for obj in self.entity.query(selectors):
+        with governor.acquire('etcd'):
+            objects = list(self.entity.query(selectors))
+
+        for obj in objects:
             yield obj
 
+    @timed_call('confctl.update')
     def update(self, changed, **tags):
         """
         Updates the value of conftool objects corresponding to the selection
@@ -44,7 +50,8 @@ class Confctl(object):
                 continue
 
             try:
-                obj.update(changed)
+                with governor.acquire('etcd'):
+                    obj.update(changed)
             except BackendError as e:
                 logger.error("Error writing to etcd: %s", e)
                 raise ConfigError(1)
@@ -52,6 +59,7 @@ class Confctl(object):
                 logger.error("Generic error in conftool: %s", e)
                 raise ConfigError(3)
 
+    @timed_generator('confctl.get')
     def get(self, **tags):
         """Gets conftool objects corresponding to the selection."""
         for obj in self._select(tags):
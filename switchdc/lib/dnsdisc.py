@@ -1,25 +1,89 @@
+import threading
 import time
 
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+import dns.exception
 import dns.resolver
 
 from switchdc import SwitchdcError
 from switchdc.dry_run import is_dry_run
 from switchdc.lib.confctl import Confctl
+from switchdc.lib.governor import governor
 from switchdc.lib.remote import Remote
 from switchdc.log import logger
+from switchdc.timing import timed, timings
+
+
+MAX_POOL_SIZE = 10  # Maximum number of concurrent DNS queries
+QUERY_TIMEOUT = 3  # Timeout in seconds of each DNS query
+CONVERGENCE_TIMEOUT = 30  # Seconds to wait for all the nameservers to serve the expected answers
+# Convergence polling starts fine-grained and backs off exponentially up to CONVERGENCE_SLEEP_MAX seconds
+CONVERGENCE_SLEEP_MIN = 0.2
+CONVERGENCE_SLEEP_MAX = 3
+CONVERGENCE_SLEEP_FACTOR = 1.5
+
+
+class DnsAnswer(namedtuple('DnsAnswer', ['nameserver', 'record', 'addresses', 'ttl', 'latency', 'error'])):
+    """The answer of a nameserver for a record: addresses and ttl are None if the query failed with error."""
+
+    __slots__ = ()
 
 
 class Discovery(object):
+    _resolvers = None  # Nameserver: resolver, shared by all the instances for the whole run, see get_resolvers()
+    _resolvers_lock = threading.Lock()
+
     def __init__(self, *records):
-        nameservers = Remote.query('R:class = role::authdns::server')
-        self.resolvers = {}
         self.discovery = Confctl('discovery')
-        for nameserver in nameservers:
-            resolver = dns.resolver.Resolver()
-            resolver.nameservers = [rdata.address for rdata in dns.resolver.query(nameserver)]
-            self.resolvers[nameserver] = resolver
         self.records = records
 
+    @property
+    def resolvers(self):
+        """Dictionary of nameserver: resolver for all the authdns servers."""
+        return Discovery.get_resolvers()
+
+    @classmethod
+    def get_resolvers(cls, refresh=False):
+        """Return the dictionary of nameserver: resolver, building it only once unless refreshed.
+
+        Arguments:
+        refresh -- whether to query again the authdns servers and their addresses. [optional, default: False]
+        """
+        with cls._resolvers_lock:
+            if cls._resolvers is None or refresh:
+                cls._resolvers = cls._build_resolvers()
+            return cls._resolvers
+
+    @classmethod
+    def refresh(cls):
+        """Query again the authdns servers and their addresses, for all the instances."""
+        cls.get_resolvers(refresh=True)
+
+    @staticmethod
+    def _build_resolvers():
+        """Return a dictionary of nameserver: resolver, resolving concurrently the address of each nameserver."""
+        nameservers = sorted(Remote.query('R:class = role::authdns::server'))
+        if not nameservers:
+            return {}
+
+        def get_resolver(nameserver):
+            resolver = dns.resolver.Resolver()
+            with governor.acquire('dns'), timed('dns.query'):
+                resolver.nameservers = [rdata.address for rdata in dns.resolver.query(nameserver)]
+            return resolver
+
+        pool = ThreadPool(min(len(nameservers), MAX_POOL_SIZE))
+        try:
+            resolvers = pool.map(get_resolver, nameservers)
+        finally:
+            pool.close()
+            pool.join()
+
+        logger.debug('Built the resolvers for nameservers: {nameservers}'.format(nameservers=', '.join(nameservers)))
+        return dict(zip(nameservers, resolvers))
+
     def update_ttl(self, ttl):
         """Update the TTL for all records.
 
@@ -31,64 +95,187 @@ class Discovery(object):
         logger.debug('Updating the TTL of {dnsdisc} to {ttl} seconds'.format(dnsdisc=dnsdisc, ttl=ttl))
         self.discovery.update({'ttl': ttl}, dnsdisc=dnsdisc)
 
-    def check_ttl(self, expected):
-        """Check the TTL for all records.
+    def check_ttl(self, expected, timeout=CONVERGENCE_TIMEOUT):
+        """Wait until all the nameservers serve the expected TTL for all records.
 
         Arguments:
-        ttl -- the expected TTL value
+        expected -- the expected TTL value
+        timeout  -- the seconds to wait for all the nameservers to converge. [optional, default: CONVERGENCE_TIMEOUT]
         """
         logger.debug('Checking that TTL={ttl} for {records}.discovery.wmnet records'.format(
             ttl=expected, records=self.records))
 
-        for record in self.resolve():
-            if not is_dry_run() and record.ttl != expected:
-                logger.error("Expected TTL '{expected}', got '{ttl}'".format(expected=expected, ttl=record.ttl))
-                raise SwitchdcError(1)
+        def check(answer):
+            if answer.ttl != expected:
+                return "Expected TTL '{expected}', got '{ttl}' for record {record}".format(
+                    expected=expected, ttl=answer.error if answer.error is not None else answer.ttl,
+                    record=answer.record)
+
+        self.wait_for_convergence(check, timeout=timeout)
 
-    def check_record(self, name, expected, attempts=3, sleep=3):
-        """Check that a record resolve to the expected IP.
+    def check_record(self, name, expected, timeout=CONVERGENCE_TIMEOUT):
+        """Wait until a record resolves to the expected IP on all the nameservers.
 
         Arguments:
         name     -- the record to check the resolution for.
         expected -- the expected record to compare the resolution to.
+        timeout  -- the seconds to wait for all the nameservers to converge. [optional, default: CONVERGENCE_TIMEOUT]
         """
-        logger.debug('Checking that {name}.discovery.wmnet records matches {expected}'.format(
-            name=name, expected=expected))
-
-        # Getting the expected record from the first resolver
-        address = self.resolvers[self.resolvers.keys()[0]].query(expected)[0].address
-
-        for i in xrange(attempts):
-            logger.debug('Attempt {attempt} to check resolution for record {record}'.format(attempt=i, record=name))
-            failed = False
-            for record in self.resolve(name=name):
-                if not is_dry_run() and record[0].address != address:
-                    failed = True
-                    logger.error("Expected IP '{expected}', got '{address}' for record {record}".format(
-                        expected=address, address=record[0].address, record=name))
-
-            if not failed:
+        self.check_records({name: expected}, timeout=timeout)
+
+    def check_records(self, expected, timeout=CONVERGENCE_TIMEOUT):
+        """Wait until multiple records resolve to the expected IPs on all the nameservers.
+
+        Arguments:
+        expected -- a dictionary of record: the expected record to compare the resolution to.
+        timeout  -- the seconds to wait for all the nameservers to converge. [optional, default: CONVERGENCE_TIMEOUT]
+        """
+        logger.debug('Checking that {records} discovery.wmnet records match {expected}'.format(
+            records=', '.join(sorted(expected)), expected=', '.join(expected[name] for name in sorted(expected))))
+
+        # Getting the expected records from the first resolver
+        nameserver = sorted(self.resolvers.keys())[0]
+        addresses = {}
+        for answer in self.query([(nameserver, name) for name in set(expected.values())]).itervalues():
+            if answer.error is not None:
+                logger.error('Unable to resolve the expected record {record}: {e}'.format(
+                    record=answer.record, e=answer.error))
+                raise SwitchdcError(1)
+            addresses[answer.record] = answer.addresses[0]
+
+        def check(answer):
+            address = addresses[expected[answer.record]]
+            got = answer.error if answer.error is not None else answer.addresses[0]
+            if got != address:
+                return "Expected IP '{expected}', got '{address}' for record {record}".format(
+                    expected=address, address=got, record=answer.record)
+
+        self.wait_for_convergence(check, names=expected.keys(), timeout=timeout)
+
+    def wait_for_convergence(self, check, names=(), timeout=CONVERGENCE_TIMEOUT):
+        """Poll the nameservers with backing-off intervals until all of them serve the expected answers.
+
+        Return a dictionary of nameserver: seconds it took to converge, that are also recorded in the timings as the
+        dns.convergence operation. Raise SwitchdcError if any nameserver has not converged before the timeout.
+        In DRY-RUN mode the nameservers are polled only once and the mismatches are just logged.
+
+        Arguments:
+        check   -- a function that receives a DnsAnswer and returns None if it's the expected one, a message
+                   describing the mismatch otherwise.
+        names   -- the record names to check, all the records if empty. [optional, default: ()]
+        timeout -- the seconds to wait for all the nameservers to converge. [optional, default: CONVERGENCE_TIMEOUT]
+        """
+        start = time.time()
+        deadline = start + timeout
+        sleep = CONVERGENCE_SLEEP_MIN
+        pending = sorted(self.resolvers)
+        converged = {}
+
+        while True:
+            mismatches = {}
+            for (nameserver, _), answer in self.resolve_matrix(*names, nameservers=pending).iteritems():
+                mismatch = check(answer)
+                if mismatch is not None:
+                    mismatches.setdefault(nameserver, []).append(mismatch)
+
+            elapsed = time.time() - start
+            for nameserver in pending:
+                if nameserver not in mismatches:
+                    converged[nameserver] = elapsed
+                    timings.record('dns.convergence', elapsed, host=nameserver)
+                    logger.debug('Nameserver {ns} converged in {elapsed:.3f}s'.format(ns=nameserver, elapsed=elapsed))
+
+            pending = sorted(mismatches)
+            if not pending:
                 break
-            elif i != (attempts - 1):  # Do not sleep after the last attempt
-                time.sleep(sleep)
-        else:
-            raise SwitchdcError(1)
 
-    def resolve(self, name=None):
-        """Generator that yields the resolved records.
+            if is_dry_run() or time.time() >= deadline:
+                log = logger.debug if is_dry_run() else logger.error
+                for nameserver in pending:
+                    for mismatch in sorted(mismatches[nameserver]):
+                        log('{mismatch} from {ns}'.format(mismatch=mismatch, ns=nameserver))
+
+                if is_dry_run():
+                    break
+
+                logger.error('{num} nameservers did not converge in {timeout}s: {ns}'.format(
+                    num=len(pending), timeout=timeout, ns=', '.join(pending)))
+                raise SwitchdcError(1)
+
+            time.sleep(min(sleep, max(deadline - time.time(), 0)))
+            sleep = min(CONVERGENCE_SLEEP_MAX, sleep * CONVERGENCE_SLEEP_FACTOR)
+
+        if converged:
+            logger.info('{num} nameservers converged in {elapsed:.3f}s'.format(
+                num=len(converged), elapsed=max(converged.values())))
+
+        return converged
+
+    def resolve(self, *names):
+        """Generator that yields the DnsAnswer of each nameserver for each record, all queried concurrently.
 
         Arguments:
-        name -- optional record name to filter for.
+        *names -- optional record names to filter for.
         """
-        if name is not None:
-            records = [name]
-        else:
-            records = self.records
-
-        for nameserver, resolver in self.resolvers.iteritems():
-            for record in records:
-                answer = resolver.query('{}.discovery.wmnet'.format(record))
-                message = '{ns}:{rec}: {ip} TTL {ttl}'.format(
-                    ns=nameserver, rec=record, ip=answer[0].address, ttl=answer.ttl)
-                logger.debug(message)
-                yield answer
+        matrix = self.resolve_matrix(*names)
+        for key in sorted(matrix):
+            yield matrix[key]
+
+    def resolve_matrix(self, *names, **kwargs):
+        """Query concurrently all the nameservers for all the records, return a dictionary (nameserver, record): DnsAnswer.
+
+        Arguments:
+        *names      -- optional record names to filter for.
+        nameservers -- the nameservers to query, all of them if None. [optional, default: None]
+        timeout     -- the timeout in seconds of each query. [optional, default: QUERY_TIMEOUT]
+        """
+        records = names or self.records
+        nameservers = kwargs.pop('nameservers', None)
+        if nameservers is None:
+            nameservers = self.resolvers
+
+        answers = self.query([(nameserver, '{}.discovery.wmnet'.format(record))
+                              for nameserver in nameservers for record in records], **kwargs)
+
+        matrix = {}
+        for (nameserver, qname), answer in answers.iteritems():
+            record = qname[:-len('.discovery.wmnet')]
+            matrix[(nameserver, record)] = answer._replace(record=record)
+            logger.debug('{ns}:{rec}: {ip} TTL {ttl} in {latency:.3f}s{error}'.format(
+                ns=nameserver, rec=record, ip=answer.addresses and answer.addresses[0], ttl=answer.ttl,
+                latency=answer.latency, error='' if answer.error is None else ', error: {e}'.format(e=answer.error)))
+
+        return matrix
+
+    def query(self, queries, timeout=QUERY_TIMEOUT):
+        """Execute concurrently the DNS queries, return a dictionary of (nameserver, name): DnsAnswer.
+
+        Arguments:
+        queries -- a list of (nameserver, name) tuples with the names to query to each nameserver
+        timeout -- the timeout in seconds of each query. [optional, default: QUERY_TIMEOUT]
+        """
+        queries = list(queries)
+        if not queries:
+            return {}
+
+        resolvers = self.resolvers
+
+        def execute(query):
+            nameserver, name = query
+            start = time.time()
+            try:
+                with governor.acquire('dns'), timed('dns.query'):
+                    answer = resolvers[nameserver].query(name, lifetime=timeout)
+                return DnsAnswer(nameserver, name, [rdata.address for rdata in answer], answer.ttl,
+                                 time.time() - start, None)
+            except dns.exception.DNSException as e:
+                return DnsAnswer(nameserver, name, None, None, time.time() - start, e.__class__.__name__)
+
+        pool = ThreadPool(min(len(queries), MAX_POOL_SIZE))
+        try:
+            answers = pool.map(execute, queries)
+        finally:
+            pool.close()
+            pool.join()
+
+        return dict(zip(queries, answers))
@@ -0,0 +1,89 @@
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+from switchdc import get_global_config
+from switchdc.log import logger
+from switchdc.timing import timings
+
+
+# Maximum concurrent usage of each shared resource by the whole process, overridable with the governor_limits key
+# of the global configuration.
+DEFAULT_LIMITS = {
+    'hosts': 1000,  # Hosts with an in-flight SSH session
+    'puppetdb': 4,  # PuppetDB queries
+    'etcd': 8,  # Conftool reads and writes
+    'redis': 32,  # Redis commands
+    'dns': 32,  # DNS queries
+}
+
+
+class Governor(object):
+    """Process-wide limiter of the concurrent operations on shared infrastructure, shared by all the lib modules."""
+
+    def __init__(self, limits):
+        """Governor constructor.
+
+        Arguments:
+        limits -- a dictionary of resource: maximum number of tokens concurrently in use. Resources without a limit
+                  are not limited.
+        """
+        self.limits = dict(limits)
+        self._in_use = defaultdict(int)
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def acquire(self, resource, tokens=1):
+        """Context manager that holds the given tokens of a resource, waiting until they are available.
+
+        The time spent waiting is recorded in the timings as the governor.<resource> operation.
+
+        Arguments:
+        resource -- the name of the resource
+        tokens   -- the number of tokens to hold, capped to the resource limit. [optional, default: 1]
+        """
+        limit = self.limits.get(resource)
+        if limit is None or tokens <= 0:
+            yield
+            return
+
+        tokens = min(tokens, limit)
+        start = time.time()
+        with self._condition:
+            while self._in_use[resource] + tokens > limit:
+                self._condition.wait()
+            self._in_use[resource] += tokens
+
+        wait = time.time() - start
+        timings.record('governor.{resource}'.format(resource=resource), wait)
+        if wait > 1:
+            logger.debug('Waited {wait:.3f}s for {tokens} {resource} tokens'.format(
+                wait=wait, tokens=tokens, resource=resource))
+
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._in_use[resource] -= tokens
+                self._condition.notify_all()
+
+    def in_use(self, resource):
+        """Return the number of tokens of a resource currently in use.
+
+        Arguments:
+        resource -- the name of the resource
+        """
+        with self._condition:
+            return self._in_use[resource]
+
+
+def _get_limits():
+    """Return the resource limits, merging the defaults with the ones in the global configuration."""
+    limits = dict(DEFAULT_LIMITS)
+    limits.update(get_global_config().get('governor_limits', {}))
+    return limits
+
+
+governor = Governor(_get_limits())
@@ -8,8 +8,12 @@ from switchdc.dry_run import is_dry_run
 from switchdc.log import logger
 from switchdc.lib.confctl import Confctl
 from switchdc.lib.remote import Remote, RemoteExecutionError
+from switchdc.timing import timed_call
 
+JOBRUNNERS_DRAIN_TIMEOUT = 900  # Maximum seconds to wait for the running jobs to complete on a jobrunner
 
+
+@timed_call('mediawiki.check_config_line')
 def check_config_line(filename, expected):
     """Return True if the expected string is found in the configuration file, False otherwise.
 
@@ -126,7 +130,8 @@ def jobrunners(dc, verify_status, stop=False):
         logger.info('Stopping jobrunners in {dc}'.format(dc=dc))
         # We wait for all jobs on HHVM on jobrunners to finish before proceeding
         remote.async('service jobrunner stop', 'service jobchron stop',
-                     'while [ "$(hhvmadm /check-load)" -gt 1 ]; do sleep 1; done')
+                     'while [ "$(hhvmadm /check-load)" -gt 1 ]; do sleep 1; done',
+                     host_timeout=JOBRUNNERS_DRAIN_TIMEOUT)
 
     _validate_status(verify_status)
     if verify_status == 'stopped':
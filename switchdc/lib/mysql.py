@@ -1,15 +1,436 @@
-from switchdc import SwitchdcError
+import math
+import threading
+import time
+
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
+
+try:
+    import pymysql
+except ImportError:  # The native backend is optional, without it all the queries are executed through Cumin
+    pymysql = None
+
+from switchdc import get_global_config, SwitchdcError
 from switchdc.dry_run import is_dry_run
-from switchdc.lib.remote import Remote
+from switchdc.lib.remote import Remote, RemoteExecutionError, wait_all
 from switchdc.log import logger
+from switchdc.timing import timed
 
 CORE_SHARDS = ('s1', 's2', 's3', 's4', 's5', 's6', 's7', 'x1', 'es2', 'es3')
+# Timeouts in seconds for MASTER_GTID_WAIT, see get_gtid_wait_timeout()
+GTID_WAIT_DEFAULT_TIMEOUT = 30  # When the replication lag is unknown
+GTID_WAIT_MIN_TIMEOUT = 5
+GTID_WAIT_MAX_TIMEOUT = 120
+GTID_WAIT_LAG_FACTOR = 3  # Multiplier of the replication lag
+# Replication lag in seconds from the pt-heartbeat table, written in UTC by the masters of the given datacenter
+HEARTBEAT_LAG_QUERY = ("SELECT TIMESTAMPDIFF(MICROSECOND, MAX(ts), UTC_TIMESTAMP(6)) / 1000000 "
+                       "FROM heartbeat.heartbeat WHERE datacenter = '{dc}'")
+# Parameters of the native MySQL backend, it's enabled only if present and PyMySQL is installed, see NativeClient
+NATIVE_CONFIG = get_global_config().get('mysql_native')
+MAX_NATIVE_POOL_SIZE = 20  # Maximum number of hosts queried concurrently with the native backend
+NATIVE_RETRY_ERRORS = (2006, 2013)  # MySQL server has gone away, Lost connection to MySQL server during query
+LAG_MONITOR_INTERVAL = 10  # Seconds between two samples of the LagMonitor
+LAG_MONITOR_WINDOW = 30  # Number of samples per shard kept by the LagMonitor
+LAG_MONITOR_MIN_SPEED = 0.01  # Minimum apply speed assumed by the LagMonitor, to bound the ETA of stalled replicas
+
+
+_native_client = None  # Lazily initialized NativeClient, see get_native_client()
+_lag_monitor = None  # The running LagMonitor, see start_lag_monitor()
 
 
 class MysqlError(SwitchdcError):
     """Custom exception class for errors of this module."""
 
 
+class ReadOnlyResult(namedtuple('ReadOnlyResult', ['host', 'dc', 'expected', 'read_only', 'rc'])):
+    """The read-only mode of a master: the read_only field is None if it was not possible to read it."""
+
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        """Whether the read-only mode of the master is the expected one."""
+        return self.rc == 0 and self.read_only == self.expected
+
+
+class ConnectionPool(object):
+    """Pool of native connections to a MySQL server."""
+
+    def __init__(self, host, size, **kwargs):
+        """ConnectionPool constructor.
+
+        Arguments:
+        host   -- the hostname of the MySQL server
+        size   -- the maximum number of idle connections to keep open
+        kwargs -- the additional keyword arguments to pass to pymysql.connect()
+        """
+        self.host = host
+        self.size = size
+        self._kwargs = kwargs
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def fill(self):
+        """Open new connections until the pool has size idle connections."""
+        with self._lock:
+            missing = self.size - len(self._idle)
+
+        connections = [self._connect() for _ in xrange(missing)]
+        with self._lock:
+            self._idle.extend(connections)
+
+    @contextmanager
+    def connection(self):
+        """Context manager that yields a connection, reusing an idle one if available.
+
+        The connection is returned to the pool when done, unless an error occurred.
+        """
+        with self._lock:
+            connection = self._idle.pop() if self._idle else None
+
+        if connection is None:
+            connection = self._connect()
+
+        try:
+            yield connection
+        except Exception:
+            self._close(connection)
+            raise
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append(connection)
+                return
+
+        self._close(connection)
+
+    def close(self):
+        """Close all the idle connections."""
+        with self._lock:
+            connections = self._idle
+            self._idle = []
+
+        for connection in connections:
+            self._close(connection)
+
+    def _connect(self):
+        """Open and return a new connection."""
+        return pymysql.connect(host=self.host, autocommit=True, **self._kwargs)
+
+    @staticmethod
+    def _close(connection):
+        """Close a connection ignoring any error.
+
+        Arguments:
+        connection -- the connection to close
+        """
+        try:
+            connection.close()
+        except Exception:
+            pass  # Already closed or broken
+
+
+class NativeClient(object):
+    """Client that executes queries directly with the MySQL protocol, with a pool of connections per host."""
+
+    def __init__(self, user, password, port=3306, pool_size=2, connect_timeout=5, **kwargs):
+        """NativeClient constructor.
+
+        Arguments:
+        user            -- the MySQL user
+        password        -- the MySQL password
+        port            -- the MySQL port. [optional, default: 3306]
+        pool_size       -- the number of connections to keep open to each host. [optional, default: 2]
+        connect_timeout -- the timeout in seconds to open a connection. [optional, default: 5]
+        kwargs          -- the additional keyword arguments to pass to pymysql.connect()
+        """
+        self.pool_size = pool_size
+        self._kwargs = dict(user=user, password=password, port=port, connect_timeout=connect_timeout, **kwargs)
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def pool(self, host):
+        """Return the connection pool of a host, creating it if needed.
+
+        Arguments:
+        host -- the hostname of the MySQL server
+        """
+        with self._lock:
+            if host not in self._pools:
+                self._pools[host] = ConnectionPool(host, self.pool_size, **self._kwargs)
+
+            return self._pools[host]
+
+    def preconnect(self, hosts):
+        """Open concurrently the pool of connections of each host, return the list of unreachable hosts.
+
+        Arguments:
+        hosts -- the list of hostnames of the MySQL servers
+        """
+        hosts = list(hosts)
+        if not hosts:
+            return []
+
+        def fill(host):
+            try:
+                self.pool(host).fill()
+                return None
+            except pymysql.Error as e:
+                logger.debug('Unable to connect to MySQL on host {host}: {e}'.format(host=host, e=e))
+                return host
+
+        pool = ThreadPool(min(len(hosts), MAX_NATIVE_POOL_SIZE))
+        try:
+            unreachable = pool.map(fill, hosts)
+        finally:
+            pool.close()
+            pool.join()
+
+        return sorted(host for host in unreachable if host is not None)
+
+    def query(self, host, *queries):
+        """Execute the queries in the same session and return the rows of the last one as a list of typed tuples.
+
+        A query that fails because of a broken connection is retried once on a new connection.
+
+        Arguments:
+        host     -- the hostname of the MySQL server
+        *queries -- the queries to execute
+        """
+        for attempt in xrange(2):
+            try:
+                with timed('mysql.query'), self.pool(host).connection() as connection:
+                    cursor = connection.cursor()
+                    for query in queries:
+                        cursor.execute(query)
+                    return list(cursor.fetchall())
+            except pymysql.OperationalError as e:
+                if attempt > 0 or e.args[0] not in NATIVE_RETRY_ERRORS:
+                    raise
+                logger.debug('Retrying query on host {host} after error: {e}'.format(host=host, e=e))
+
+    def close(self):
+        """Close all the connections of all the pools."""
+        with self._lock:
+            pools = self._pools.values()
+
+        for pool in pools:
+            pool.close()
+
+
+class NativeRun(object):
+    """Handle of an execution of queries with the NativeClient, with the same interface of RemoteRun."""
+
+    def __init__(self, hosts, pool, result, rows, success_threshold=1.0):
+        """NativeRun constructor.
+
+        Arguments:
+        hosts             -- the list of hosts on which the queries are executed
+        pool              -- the closed ThreadPool that runs the execution, joined once it is completed
+        result            -- the multiprocessing AsyncResult of the execution, with the return code of each host
+        rows              -- the dictionary of host: list of rows that is filled by the execution
+        success_threshold -- the threshold to consider the execution successful. [optional, default: 1.0]
+        """
+        self.hosts = hosts
+        self.rows = rows
+        self.success_threshold = success_threshold
+        self._pool = pool
+        self._result = result
+
+    def done(self):
+        """Return True if the execution is completed, False otherwise."""
+        if not self._result.ready():
+            return False
+
+        self._join()
+        return True
+
+    def wait(self, timeout=None):
+        """Wait for the execution to complete and return its return code, raise RemoteExecutionError if it failed.
+
+        Arguments:
+        timeout -- the maximum number of seconds to wait for. [optional, default: None]
+        """
+        self._result.wait(timeout)
+        if not self._result.ready():
+            logger.error("Queries on '{num}' hosts still running after {timeout} seconds".format(
+                num=len(self.hosts), timeout=timeout))
+            raise RemoteExecutionError(2)
+
+        self._join()
+        failed = len([rc for rc in self._result.get() if rc != 0])
+        if self.hosts and float(failed) / len(self.hosts) > 1.0 - self.success_threshold and not is_dry_run():
+            raise RemoteExecutionError(1)
+
+        return 0
+
+    @property
+    def results(self):
+        """Dictionary of host: output of the completed execution, formatted as the mysql client batch mode."""
+        if not self.done():
+            raise RemoteExecutionError(3)
+
+        return {host: format_rows(rows) for host, rows in self.rows.iteritems()}
+
+    def _join(self):
+        """Join the threads of the completed execution's pool, only the first time it's called."""
+        pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.join()
+
+
+class LagMonitor(object):
+    """Sample in background the replication lag of the core masters of a datacenter and estimate their catch-up time.
+
+    The lag is read from the pt-heartbeat table. The catch-up rate is the speed at which the lag decreases, estimated
+    with a linear regression on the samples of the rolling window, hence the replica applies 1 + rate seconds of
+    writes per second. Once the masters of dc_from are read-only the lag can't grow anymore, hence the catch-up time
+    of each shard is estimated as lag / max(LAG_MONITOR_MIN_SPEED, 1 + rate).
+    """
+
+    def __init__(self, dc_from, dc_to, interval=LAG_MONITOR_INTERVAL, window=LAG_MONITOR_WINDOW):
+        """LagMonitor constructor.
+
+        Arguments:
+        dc_from  -- the name of the datacenter of the masters that are replicated
+        dc_to    -- the name of the datacenter of the masters whose lag is monitored
+        interval -- the seconds between two samples. [optional, default: LAG_MONITOR_INTERVAL]
+        window   -- the number of samples per shard to keep. [optional, default: LAG_MONITOR_WINDOW]
+        """
+        self.dc_from = dc_from
+        self.dc_to = dc_to
+        self.interval = interval
+        self._samples = {shard: deque(maxlen=window) for shard in CORE_SHARDS}  # Shard: deque of (timestamp, lag)
+        self._shards = None  # Host: shard, lazily initialized
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        """Whether the background sampling is running."""
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        """Take a first sample and start the background sampling."""
+        self.sample()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='lag-monitor')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop the background sampling."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sample(self):
+        """Read the replication lag of all the monitored masters with a single execution."""
+        if self._shards is None:
+            remotes = get_db_remotes(self.dc_to, CORE_SHARDS, group='core', role='master')
+            self._shards = {host: shard for shard, host in _get_single_hosts(remotes).iteritems()}
+
+        def record(host, rc, output):
+            lag = _parse_lag(output) if rc == 0 else None
+            if lag is not None:
+                self.record(self._shards[host], time.time(), lag)
+
+        remote = Remote()
+        remote.select(set(self._shards.keys()))
+        try:
+            submit_query(remote, HEARTBEAT_LAG_QUERY.format(dc=self.dc_from), is_safe=True, success_threshold=0.0,
+                         on_result=record).wait()
+        except RemoteExecutionError:
+            pass  # The hosts that failed have no new sample
+
+    def record(self, shard, timestamp, lag):
+        """Record a sample of the replication lag of a shard.
+
+        Arguments:
+        shard     -- the name of the shard
+        timestamp -- the timestamp of the sample
+        lag       -- the replication lag in seconds
+        """
+        with self._lock:
+            self._samples[shard].append((timestamp, lag))
+
+    def lag(self, shard):
+        """Return the last sampled replication lag in seconds of a shard, None if there are no samples.
+
+        Arguments:
+        shard -- the name of the shard
+        """
+        with self._lock:
+            samples = list(self._samples[shard])
+
+        return samples[-1][1] if samples else None
+
+    def rate(self, shard):
+        """Return the catch-up rate of a shard in seconds of lag recovered per second, None if not enough samples.
+
+        Arguments:
+        shard -- the name of the shard
+        """
+        with self._lock:
+            samples = list(self._samples[shard])
+
+        if len(samples) < 2:
+            return None
+
+        mean_t = sum(t for t, _ in samples) / len(samples)
+        mean_lag = sum(lag for _, lag in samples) / len(samples)
+        variance = sum((t - mean_t) ** 2 for t, _ in samples)
+        if variance == 0:
+            return None
+
+        return -sum((t - mean_t) * (lag - mean_lag) for t, lag in samples) / variance
+
+    def eta(self, shard):
+        """Return the estimated catch-up time in seconds of a shard, None if there are no samples.
+
+        Arguments:
+        shard -- the name of the shard
+        """
+        lag = self.lag(shard)
+        if lag is None:
+            return None
+
+        return max(0.0, lag) / max(LAG_MONITOR_MIN_SPEED, 1 + (self.rate(shard) or 0.0))
+
+    def exceeding(self, budget):
+        """Return a dictionary of shard: estimated catch-up time for the shards that exceed the budget or are unknown.
+
+        Arguments:
+        budget -- the maximum catch-up time in seconds
+        """
+        etas = {shard: self.eta(shard) for shard in CORE_SHARDS}
+        return {shard: eta for shard, eta in etas.iteritems() if eta is None or eta > budget}
+
+    def report(self):
+        """Return a list of lines with the lag, catch-up rate and estimated catch-up time of each shard."""
+        lines = []
+        for shard in CORE_SHARDS:
+            lag = self.lag(shard)
+            if lag is None:
+                lines.append('{shard: <4} lag=unknown'.format(shard=shard))
+                continue
+
+            lines.append('{shard: <4} lag={lag:.3f}s, rate={rate}, eta={eta:.3f}s'.format(
+                shard=shard, lag=lag, rate=_format_optional(self.rate(shard), '{:+.3f}'), eta=self.eta(shard)))
+
+        return lines
+
+    def _loop(self):
+        """Sample the replication lag every interval seconds until stopped."""
+        while not self._stop.wait(self.interval):
+            try:
+                self.sample()
+            except Exception as e:
+                logger.debug('Failed to sample the replication lag: {e}'.format(e=e))
+
+
 def get_query_command(query, database=''):
     """Return the command to be executed for a given query.
 
@@ -21,6 +442,87 @@ def get_query_command(query, database=''):
         query=query, database=database).strip()
 
 
+def format_rows(rows):
+    """Return the rows of a query formatted as the output of the mysql client in batch mode without column names.
+
+    Arguments:
+    rows -- the list of rows as returned by NativeClient.query()
+    """
+    return '\n'.join('\t'.join('NULL' if value is None else str(value) for value in row) for row in rows)
+
+
+def get_native_client():
+    """Return the shared NativeClient instance, None if the native backend is not installed or not configured."""
+    global _native_client
+    if _native_client is None and pymysql is not None and NATIVE_CONFIG:
+        _native_client = NativeClient(**NATIVE_CONFIG)
+
+    return _native_client
+
+
+def submit_query(remote, *queries, **kwargs):
+    """Start the execution in the same session of the queries on the hosts of a Remote instance in background.
+
+    The native backend is used if available, otherwise the queries are executed with the mysql client through
+    Cumin. In both cases the on_result callback receives the output formatted as the mysql client batch mode.
+
+    Arguments:
+    remote            -- the Remote instance with the selected hosts
+    *queries          -- the queries to execute, double quotes must be already escaped
+    is_safe           -- the queries are read-only and safe to run also in dry-run mode. [optional, default: False]
+    success_threshold -- the threshold to consider the execution successful. [optional, default: 1.0]
+    on_result         -- a callable called with (host, rc, output) as soon as each host completes. With the native
+                         backend returning False doesn't abort the execution. [optional, default: None]
+
+    Returns:
+    a NativeRun instance with the native backend, a RemoteRun instance otherwise.
+    """
+    client = get_native_client()
+    if client is None:
+        return remote.submit(get_query_command('; '.join(queries)), **kwargs)
+
+    is_safe = kwargs.get('is_safe', False)
+    on_result = kwargs.get('on_result')
+    hosts = list(remote.hosts)
+    rows = {}
+    logger.debug("Executing natively queries {queries} on '{num}' hosts".format(queries=queries, num=len(hosts)))
+
+    def execute(host):
+        if is_dry_run() and not is_safe:
+            return 0
+
+        try:
+            rows[host] = client.query(host, *queries)
+            rc = 0
+        except pymysql.Error as e:
+            logger.error('Failed to execute queries on host {host}: {e}'.format(host=host, e=e))
+            rc = 1
+
+        if on_result is not None:
+            on_result(host, rc, format_rows(rows.get(host, [])))
+
+        return rc
+
+    pool = ThreadPool(max(1, min(len(hosts), MAX_NATIVE_POOL_SIZE)))
+    result = pool.map_async(execute, hosts)
+    pool.close()
+
+    return NativeRun(hosts, pool, result, rows, success_threshold=kwargs.get('success_threshold', 1.0))
+
+
+def get_db_query(**kwargs):
+    """Return the Cumin query to select hosts from Role::Mariadb::Groups.
+
+    Arguments:
+    kwargs -- a dictionary of key: value for the parameters to be filtered in the Role::Mariadb::Groups puppet class.
+    """
+    query = 'R:Class = Role::Mariadb::Groups'
+    for key, value in sorted(kwargs.iteritems()):
+        query += ' and R:Class%mysql_{key} = "{value}"'.format(key=key, value=value)
+
+    return query
+
+
 def get_db_remote(dc, **kwargs):
     """Return the Remote instance with selected hosts from Role::Mariadb::Groups to be used in Cumin.
 
@@ -29,14 +531,28 @@ def get_db_remote(dc, **kwargs):
     kwargs -- a dictionary of key: value for the parameters to be filtered in the Role::Mariadb::Groups puppet class.
     """
     remote = Remote(site=dc)
-    query = 'R:Class = Role::Mariadb::Groups'
-    for key, value in kwargs.iteritems():
-        query += ' and R:Class%mysql_{key} = "{value}"'.format(key=key, value=value)
-
-    remote.select(query)
+    remote.select(get_db_query(**kwargs))
     return remote
 
 
+def get_db_remotes(dc, shards, **kwargs):
+    """Return a dictionary of shard: Remote instance for each shard, fetching all the hosts in a single lookup.
+
+    Arguments:
+    dc     -- the name of the datacenter to filter for
+    shards -- the list of shards to select the hosts for
+    kwargs -- a dictionary of key: value for the parameters to be filtered in the Role::Mariadb::Groups puppet class.
+    """
+    queries = [get_db_query(shard=shard, **kwargs) for shard in shards]
+    remotes = {}
+    for shard, hosts in zip(shards, Remote.query_many(*queries)):
+        remote = Remote(site=dc)
+        remote.select(hosts)
+        remotes[shard] = remote
+
+    return remotes
+
+
 def set_core_masters_readonly(dc, ro):
     """Set the core masters in read-only or read-write mode.
 
@@ -58,48 +574,305 @@ def verify_core_masters_readonly(dc, ro):
     dc -- the name of the datacenter to filter for
     ro -- boolean to check whether the read-only mode should be set or not.
     """
-    logger.debug('Verifying core DB masters in {dc} have read-only={ro}'.format(dc=dc, ro=ro))
+    verify_all_core_masters_readonly({dc: ro})
 
-    remote = get_db_remote(dc, group='core', role='master')
-    remote.sync(get_query_command('SELECT @@global.read_only'), is_safe=True)
-    expected = str(int(ro))
-    failed = False
 
-    for nodeset, output in remote.worker.get_results():
-        if output.message() != expected:
-            logger.error("Expected output to be '{expected}', got '{output}' for hosts {hosts}".format(
-                expected=expected, output=output, hosts=list(nodeset)))
+def verify_all_core_masters_readonly(states):
+    """Verify concurrently that the core masters of multiple datacenters are in read-only or read-write mode.
+
+    Each host is checked as soon as it completes, failing fast on the first mismatch.
+
+    Arguments:
+    states -- a dictionary of datacenter: boolean to check whether the read-only mode should be set or not.
+    """
+    failed = []
+    runs = []
+    for dc, ro in states.iteritems():
+        logger.debug('Verifying core DB masters in {dc} have read-only={ro}'.format(dc=dc, ro=ro))
+        remote = get_db_remote(dc, group='core', role='master')
+        runs.append(remote.submit(get_query_command('SELECT @@global.read_only'), is_safe=True,
+                                  on_result=_get_output_checker(str(int(ro)), failed)))
+
+    try:
+        wait_all(runs)
+    except RemoteExecutionError:
+        if not failed:
+            raise
+
+    if failed and not is_dry_run():
+        raise MysqlError(1)
+
+
+def _get_output_checker(expected, failed):
+    """Return a Remote on_result callback that checks the output of each host as soon as it completes.
+
+    The callback aborts the execution on the first mismatch, unless in DRY-RUN mode.
+
+    Arguments:
+    expected -- the expected output of the command
+    failed   -- a list to which the hosts not matching the expected output are appended
+    """
+    def checker(host, rc, output):
+        if rc == 0 and output.strip() == expected:
+            return True
+
+        logger.error("Expected output to be '{expected}', got '{output}' (rc={rc}) for host {host}".format(
+            expected=expected, output=output.strip(), rc=rc, host=host))
+        failed.append(host)
+        return is_dry_run()
+
+    return checker
+
+
+def set_core_masters_readonly_and_verify(dc, ro, verify=None):
+    """Set the core masters in read-only or read-write mode and verify the ones of other datacenters concurrently.
+
+    The read-only mode is read back in the same session in which it is set, hence with a single execution per
+    datacenter. In DRY-RUN mode the read-only mode of dc is only read.
+
+    Arguments:
+    dc     -- the name of the datacenter in which to set the read-only mode
+    ro     -- boolean to decide whether the read-only mode should be set or removed.
+    verify -- a dictionary of datacenter: boolean to check whether the read-only mode of the core masters of other
+              datacenters should be set or not. [optional, default: None]
+
+    Returns:
+    a list of ReadOnlyResult, one per host.
+    """
+    results = []
+    runs = []
+    select = 'SELECT @@global.read_only'
+    states = [(dc, ro, ('SET GLOBAL read_only={ro}'.format(ro=int(ro)), select))]
+    if verify is not None:
+        states += [(verify_dc, verify_ro, (select,)) for verify_dc, verify_ro in verify.iteritems()]
+
+    for state_dc, state_ro, queries in states:
+        if is_dry_run():
+            queries = (select,)
+        is_safe = queries == (select,)
+        logger.debug('{action} core DB masters in {dc} have read-only={ro}'.format(
+            action='Verifying' if is_safe else 'Setting and verifying', dc=state_dc, ro=state_ro))
+        remote = get_db_remote(state_dc, group='core', role='master')
+        collector = _get_readonly_collector(state_dc, state_ro, results)
+        runs.append(submit_query(remote, *queries, is_safe=is_safe, success_threshold=0.0, on_result=collector))
+
+    wait_all(runs)
+
+    for (state_dc, state_ro, _), run in zip(states, runs):
+        missing = set(run.hosts) - {result.host for result in results if result.dc == state_dc}
+        results += [ReadOnlyResult(host, state_dc, state_ro, None, None) for host in sorted(missing)]
+
+    failed = False
+    for result in sorted(results):
+        if not result.ok:
             failed = True
+            logger.error('Expected read-only={expected}, got {read_only} (rc={rc}) for host {host} in {dc}'.format(
+                expected=result.expected, read_only=result.read_only, rc=result.rc, host=result.host, dc=result.dc))
 
     if failed and not is_dry_run():
         raise MysqlError(1)
 
+    return results
+
+
+def _get_readonly_collector(dc, ro, results):
+    """Return a Remote on_result callback that appends a ReadOnlyResult for each host to results.
+
+    Arguments:
+    dc      -- the name of the datacenter of the hosts
+    ro      -- the expected read-only mode
+    results -- the list to which to append the results
+    """
+    def collector(host, rc, output):
+        read_only = {'0': False, '1': True}.get(output.strip().split('\n')[-1].strip())
+        results.append(ReadOnlyResult(host, dc, ro, read_only, rc))
+
+    return collector
+
+
+def get_gtid_wait_timeout(lag):
+    """Return the timeout in seconds for MASTER_GTID_WAIT based on the replication lag of a master.
+
+    Arguments:
+    lag -- the replication lag in seconds or None if unknown
+    """
+    if lag is None:
+        return GTID_WAIT_DEFAULT_TIMEOUT
+
+    return int(min(GTID_WAIT_MAX_TIMEOUT, GTID_WAIT_MIN_TIMEOUT + math.ceil(max(0, lag) * GTID_WAIT_LAG_FACTOR)))
+
+
+def get_core_masters_positions(remotes_from, remotes_to, dc_from):
+    """Return the GTID position of the masters in remotes_from and the lag of the masters in remotes_to.
+
+    Both values are read concurrently with a single execution on all the masters of each datacenter.
+
+    Arguments:
+    remotes_from -- a dictionary of shard: Remote instance with the masters to read the GTID position from
+    remotes_to   -- a dictionary of shard: Remote instance with the masters to read the replication lag from
+    dc_from      -- the name of the datacenter of the masters in remotes_from
+
+    Returns:
+    a tuple of two dictionaries, shard: gtid_binlog_pos and shard: lag in seconds or None if unknown.
+    """
+    shards_from = _get_single_hosts(remotes_from)
+    shards_to = _get_single_hosts(remotes_to)
+
+    run_from = submit_query(_get_remote(shards_from), 'SELECT @@GLOBAL.gtid_binlog_pos', is_safe=True)
+    run_to = submit_query(_get_remote(shards_to), HEARTBEAT_LAG_QUERY.format(dc=dc_from), is_safe=True,
+                          success_threshold=0.0)
+    wait_all([run_from, run_to])
+
+    gtids = {}
+    results = run_from.results
+    for shard, host in shards_from.iteritems():
+        if not results.get(host):
+            logger.error('Unable to read the GTID position of host {host}'.format(host=host))
+            raise MysqlError(1)
+        gtids[shard] = results[host].strip()
+
+    lags = {}
+    results = run_to.results
+    for shard, host in shards_to.iteritems():
+        lags[shard] = _parse_lag(results.get(host, ''))
+        if lags[shard] is None:
+            logger.warning('Unable to read the replication lag of host {host}'.format(host=host))
+
+    return gtids, lags
+
 
 def ensure_core_masters_in_sync(dc_from, dc_to):
     """Ensure all core masters of dc_to are in sync with the core masters of dc_from.
 
+    All the shards are waited concurrently, each one with a timeout based on its replication lag.
+
     Arguments:
     dc_from -- the name of the datacenter from where to get the master positions
     dc_to   -- the name of the datacenter where to check that they are in sync
+
+    Returns:
+    a dictionary of shard: seconds that the master in dc_to took to catch up.
     """
     logger.debug('Waiting for the core DB masters in {dc_to} to catch up'.format(dc_to=dc_to))
+    remotes_from = get_db_remotes(dc_from, CORE_SHARDS, group='core', role='master')
+    remotes_to = get_db_remotes(dc_to, CORE_SHARDS, group='core', role='master')
+    gtids, lags = get_core_masters_positions(remotes_from, remotes_to, dc_from)
+
+    durations = {}
+    outputs = {}
+    runs = []
+    start = time.time()
     for shard in CORE_SHARDS:
-        gtid = ''
-        remote_from = get_db_remote(dc_from, group='core', role='master', shard=shard)
-        remote_from.sync(get_query_command('SELECT @@GLOBAL.gtid_binlog_pos'), is_safe=True)
-
-        for nodeset, output in remote_from.worker.get_results():
-            if list(nodeset) == remote_from.hosts:
-                gtid = output.message()
-                break
+        timeout = get_gtid_wait_timeout(lags[shard])
+
+        def record(host, rc, output, shard=shard):
+            durations[shard] = time.time() - start
+            outputs[shard] = output.strip() if rc == 0 else None
+
+        query = "SELECT MASTER_GTID_WAIT('{gtid}', {timeout})".format(gtid=gtids[shard], timeout=timeout)
+        runs.append(submit_query(remotes_to[shard], query, is_safe=True, on_result=record))
+
+    try:
+        wait_all(runs)
+    except RemoteExecutionError:
+        pass  # Failures are reported below
+
+    failed = False
+    for shard, remote in zip(CORE_SHARDS, runs):
+        lag = lags[shard]
+        message = '{shard: <4} {host}: lag={lag}, timeout={timeout}s, '.format(
+            shard=shard, host=remote.hosts[0], lag=_format_optional(lag, '{:.3f}s'),
+            timeout=get_gtid_wait_timeout(lag))
+        # See https://mariadb.com/kb/en/mariadb/master_gtid_wait/
+        if outputs.get(shard) == '0':
+            logger.info(message + 'caught up in {duration:.3f}s'.format(duration=durations[shard]))
         else:
+            failed = True
+            logger.error(message + 'GTID not in sync after timeout (output={output})'.format(
+                output=outputs.get(shard)))
+
+    if failed:
+        raise MysqlError(2)
+
+    return durations
+
+
+def start_lag_monitor(dc_from, dc_to):
+    """Start the background LagMonitor of the core masters in dc_to, stopping any previous one, and return it.
+
+    Arguments:
+    dc_from -- the name of the datacenter of the masters that are replicated
+    dc_to   -- the name of the datacenter of the masters whose lag is monitored
+    """
+    global _lag_monitor
+    stop_lag_monitor()
+    _lag_monitor = LagMonitor(dc_from, dc_to)
+    _lag_monitor.start()
+
+    return _lag_monitor
+
+
+def get_lag_monitor():
+    """Return the running LagMonitor, None if it was not started."""
+    if _lag_monitor is not None and _lag_monitor.running:
+        return _lag_monitor
+
+    return None
+
+
+def stop_lag_monitor():
+    """Stop the running LagMonitor, if any."""
+    global _lag_monitor
+    if _lag_monitor is not None:
+        _lag_monitor.stop()
+        _lag_monitor = None
+
+
+def _parse_lag(output):
+    """Return the replication lag in seconds from the output of HEARTBEAT_LAG_QUERY, None if unable to parse it.
+
+    Arguments:
+    output -- the output of the query
+    """
+    try:
+        return float(output)
+    except ValueError:
+        return None
+
+
+def _format_optional(value, template):
+    """Return the value formatted with the template or 'unknown' if None.
+
+    Arguments:
+    value    -- the value to format
+    template -- the format string with a single positional field
+    """
+    return 'unknown' if value is None else template.format(value)
+
+
+def _get_single_hosts(remotes):
+    """Return a dictionary of shard: host ensuring that each Remote instance has exactly one host selected.
+
+    Arguments:
+    remotes -- a dictionary of shard: Remote instance
+    """
+    hosts = {}
+    for shard, remote in remotes.iteritems():
+        if len(remote.hosts) != 1:
+            logger.error("Expected one master for shard {shard}, got '{num}': {hosts}".format(
+                shard=shard, num=len(remote.hosts), hosts=remote.hosts))
             raise MysqlError(1)
+        hosts[shard] = remote.hosts[0]
+
+    return hosts
+
 
-        remote_to = get_db_remote(dc_to, group='core', role='master', shard=shard)
-        query = "SELECT MASTER_GTID_WAIT('{gtid}', 30)".format(gtid=gtid)  # Wait for master is in sync, fail after 30
-        remote_to.sync(get_query_command(query), is_safe=True)
+def _get_remote(shards):
+    """Return a Remote instance with all the hosts of a dictionary of shard: host selected.
 
-        for nodeset, output in remote_to.worker.get_results():
-            if output.message() != '0':  # See https://mariadb.com/kb/en/mariadb/master_gtid_wait/
-                logger.error('GTID not in sync after timeout for host {host}'.format(host=list(nodeset)))
-                raise MysqlError(2)
+    Arguments:
+    shards -- a dictionary of shard: host
+    """
+    remote = Remote()
+    remote.select(set(shards.values()))
+    return remote
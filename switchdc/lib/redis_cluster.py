@@ -1,45 +1,178 @@
 import os
+import threading
+import time
 
-from collections import defaultdict
+from collections import defaultdict, namedtuple
+from multiprocessing.pool import ThreadPool
 
 import redis
 import yaml
 
 from switchdc import SwitchdcError
 from switchdc.dry_run import is_dry_run
+from switchdc.lib.governor import governor
+from switchdc.log import logger
+from switchdc.timing import timed
+
+
+MAX_POOL_SIZE = 20  # Maximum number of Redis instances contacted concurrently
+PARITY_TIMEOUT = 30  # Seconds to wait for the replicas to reach the replication offset of their masters
+PARITY_SLEEP_MIN = 0.1
+PARITY_SLEEP_MAX = 1
+CONNECT_TIMEOUT = 5  # Seconds to open a connection to a Redis instance
+BACKLOG_SAMPLE_INTERVAL = 5  # Seconds between the two samples of the replication offset to measure the write rate
+BACKLOG_INVERSION_WINDOW = 60  # Seconds of writes that the backlog should hold to be safe for the inversion
 
 
 class RedisSwitchError(SwitchdcError):
     """Custom exception class for Redis errors."""
 
 
+class ParityResult(namedtuple('ParityResult',
+                              ['shard', 'offset_delta', 'keys_delta', 'converged', 'elapsed', 'syncing'])):
+    """The replication parity of a shard: converged is None if the replica doesn't replicate from the master.
+
+    Syncing is True if the replica's link to the master is not up or a full synchronization is in progress, as it
+    happens right after the replication is (re)started.
+    """
+
+    __slots__ = ()
+
+
+class ConnectionRegistry(object):
+    """Registry of Redis connection pools keyed by (host, port, db), to share the connections across the stages."""
+
+    def __init__(self):
+        """ConnectionRegistry constructor."""
+        self._pools = {}
+        self._lock = threading.Lock()
+
+    def get_pool(self, host, port, db=0, password=None):
+        """Return the connection pool of a Redis instance, creating it if needed.
+
+        Arguments:
+        host     -- the hostname of the Redis instance
+        port     -- the port of the Redis instance
+        db       -- the database number. [optional, default: 0]
+        password -- the password of the Redis instance. [optional, default: None]
+        """
+        key = (host, port, db)
+        with self._lock:
+            if key not in self._pools:
+                self._pools[key] = redis.ConnectionPool(host=host, port=port, db=db, password=password,
+                                                        socket_connect_timeout=CONNECT_TIMEOUT)
+            return self._pools[key]
+
+    def health_check(self, instances):
+        """Open or check concurrently a connection to each instance, return the list of the unreachable ones.
+
+        The pool of an unreachable instance is disconnected so that the next command opens new connections.
+
+        Arguments:
+        instances -- the list of RedisInstance to check
+        """
+        instances = list(instances)
+        if not instances:
+            return []
+
+        def ping(instance):
+            try:
+                with governor.acquire('redis'), timed('redis.ping'):
+                    instance.client.ping()
+            except redis.RedisError as e:
+                logger.debug('Unable to connect to Redis instance {instance}: {e}'.format(instance=instance, e=e))
+                instance.client.connection_pool.disconnect()
+                return instance
+
+        pool = ThreadPool(min(len(instances), MAX_POOL_SIZE))
+        try:
+            unreachable = pool.map(ping, instances)
+        finally:
+            pool.close()
+            pool.join()
+
+        return [instance for instance in unreachable if instance is not None]
+
+    def clear(self):
+        """Disconnect and forget all the connection pools."""
+        with self._lock:
+            pools = self._pools.values()
+            self._pools = {}
+
+        for pool in pools:
+            pool.disconnect()
+
+
+class BacklogResult(namedtuple('BacklogResult', ['shard', 'backlog_size', 'backlog_histlen', 'offset_delta',
+                                                 'write_rate', 'required', 'psync'])):
+    """The prediction of a partial resync of a shard after the inversion, with the sizes in bytes."""
+
+    __slots__ = ()
+
+
 class RedisInstance(object):
 
-    def __init__(self, ip, port, db=0, password=None):
+    def __init__(self, ip, port, db=0, password=None, registry=None):
         self.host = ip
         self.port = port
         self.db = db
         self.password = password
         # The client will be lazily initialized once we need it
-        self.client = redis.StrictRedis(self.host, self.port, self.db, self.password)
+        if registry is None:
+            self.client = redis.StrictRedis(self.host, self.port, self.db, self.password)
+        else:
+            self.client = redis.StrictRedis(connection_pool=registry.get_pool(
+                self.host, self.port, self.db, self.password))
+        self._replication = None
+
+    @property
+    def replication(self):
+        """Snapshot of the replication info, taken on first access and updated by refresh() and the replica changes."""
+        if self._replication is None:
+            self.refresh()
+        return self._replication
+
+    def refresh(self):
+        """Take a new snapshot of the replication info and return it."""
+        with governor.acquire('redis'), timed('redis.info'):
+            self._replication = self.client.info('replication')
+        return self._replication
 
     @property
     def is_master(self):
-        return (self.client.info('replication')['role'] == 'master')
+        return (self.replication['role'] == 'master')
 
     @property
     def slave_of(self):
-        data = self.client.info('replication')
+        data = self.replication
         try:
             return '{}:{}'.format(data['master_host'], data['master_port'])
         except:
             return None
 
+    @property
+    def keys_count(self):
+        with governor.acquire('redis'), timed('redis.dbsize'):
+            return self.client.dbsize()
+
     def stop_replica(self):
-        self.client.slaveof()
+        self._slaveof()
 
     def start_replica(self, master):
-        self.client.slaveof(master.host, master.port)
+        self._slaveof(master.host, master.port)
+
+    def _slaveof(self, *args):
+        """Execute SLAVEOF and take a new snapshot of the replication info in the same round trip.
+
+        Arguments:
+        *args -- the host and port of the master, none to stop the replica
+        """
+        self._replication = None
+        with governor.acquire('redis'), timed('redis.slaveof'):
+            pipeline = self.client.pipeline(transaction=False)
+            pipeline.slaveof(*args)
+            pipeline.info('replication')
+            self._replication = pipeline.execute()[-1]
 
     def __str__(self):
         return "{}:{}".format(self.host, self.port)
@@ -55,15 +188,176 @@ class RedisInstance(object):
 
 
 class RedisShardsBase(object):
+    registry = ConnectionRegistry()  # Shared by all the instances for the whole run
 
     def __init__(self, cluster, config_dir, password):
+        self.cluster = cluster
         self.shards = defaultdict(dict)
         with open(os.path.join(config_dir, "{}.yaml".format(cluster))) as fh:
             data = yaml.safe_load(fh)
         self.dry_run = is_dry_run()
         for dc, shards in data.items():
             for shard, redis_data in shards.items():
-                self.shards[dc][shard] = RedisInstance(redis_data['host'], redis_data['port'], password=password)
+                self.shards[dc][shard] = RedisInstance(redis_data['host'], redis_data['port'], password=password,
+                                                       registry=self.registry)
+
+    def preconnect(self):
+        """Open the pooled connections to all the instances, return the list of the unreachable ones."""
+        return self.registry.health_check(
+            [instance for shards in self.shards.values() for instance in shards.values()])
+
+    def refresh(self, dc=None):
+        """Take concurrently a new snapshot of the replication info of the instances.
+
+        Arguments:
+        dc -- the name of the datacenter to limit the instances to, all the instances if None.
+              [optional, default: None]
+        """
+        if dc is None:
+            instances = [instance for shards in self.shards.values() for instance in shards.values()]
+        else:
+            instances = self.shards[dc].values()
+
+        if not instances:
+            return
+
+        pool = ThreadPool(min(len(instances), MAX_POOL_SIZE))
+        try:
+            pool.map(lambda instance: instance.refresh(), instances)
+        finally:
+            pool.close()
+            pool.join()
+
+    def map(self, func, dc):
+        """Call func(shard, instance) concurrently for all the shards of a datacenter, return the failures.
+
+        Arguments:
+        func -- the callable to call for each shard
+        dc   -- the name of the datacenter
+
+        Returns:
+        a dictionary of shard: exception raised by func, empty if all succeeded.
+        """
+        items = self.shards[dc].items()
+        if not items:
+            return {}
+
+        def call(item):
+            try:
+                func(*item)
+            except Exception as e:
+                return e
+
+        pool = ThreadPool(min(len(items), MAX_POOL_SIZE))
+        try:
+            errors = pool.map(call, items)
+        finally:
+            pool.close()
+            pool.join()
+
+        return {shard: error for (shard, _), error in zip(items, errors) if error is not None}
+
+    def check_parity(self, dc_master, dc_replica, timeout=PARITY_TIMEOUT):
+        """Wait concurrently for the replicas to reach the replication offset of their masters, within a deadline.
+
+        The offset of each master is read once, hence each replica is waited until it has replicated at least all the
+        writes received by its master before the check.
+
+        Arguments:
+        dc_master  -- the name of the datacenter of the masters
+        dc_replica -- the name of the datacenter of the replicas
+        timeout    -- the deadline in seconds for all the replicas. [optional, default: PARITY_TIMEOUT]
+
+        Returns:
+        a dictionary of shard: ParityResult.
+        """
+        deadline = time.time() + timeout
+        results = {}
+
+        def check(shard, replica):
+            results[shard] = self._check_shard_parity(shard, self.shards[dc_master][shard], replica, deadline)
+
+        for shard, error in self.map(check, dc_replica).iteritems():
+            logger.error('Unable to check the replication parity of shard {shard}: {e!r}'.format(shard=shard, e=error))
+            results[shard] = ParityResult(shard, None, None, False, None, False)
+
+        for shard, result in sorted(results.iteritems()):
+            logger.debug(('{cluster} {shard}: offset delta={offset}, keys delta={keys}, converged={converged}, '
+                          'syncing={syncing}').format(cluster=self.cluster, shard=shard, offset=result.offset_delta,
+                                                      keys=result.keys_delta, converged=result.converged,
+                                                      syncing=result.syncing))
+
+        return results
+
+    def check_backlog(self, dc_master, dc_replica, interval=BACKLOG_SAMPLE_INTERVAL, window=BACKLOG_INVERSION_WINDOW):
+        """Predict concurrently for each shard if the inverted replication will be served by a partial resync.
+
+        After the inversion the masters in dc_master become replicas of the instances in dc_replica, that can serve
+        them a partial resync (PSYNC) only if their replication backlog holds all the writes since the offset of the
+        new replica. The write rate of the masters is measured sampling their offset twice.
+
+        Arguments:
+        dc_master  -- the name of the datacenter of the current masters
+        dc_replica -- the name of the datacenter of the current replicas, that will be promoted
+        interval   -- the seconds between the two samples of the offset. [optional, default: BACKLOG_SAMPLE_INTERVAL]
+        window     -- the seconds of writes that the backlog should hold in addition to the current replication lag.
+                      [optional, default: BACKLOG_INVERSION_WINDOW]
+
+        Returns:
+        a dictionary of shard: BacklogResult.
+        """
+        results = {}
+
+        def check(shard, replica):
+            master = self.shards[dc_master][shard]
+            start = time.time()
+            first = master.refresh()['master_repl_offset']
+            time.sleep(interval)
+            last = master.refresh()['master_repl_offset']
+            write_rate = (last - first) / max(time.time() - start, 0.001)
+
+            data = replica.refresh()
+            offset_delta = max(0, last - data.get('slave_repl_offset', 0))
+            required = int(offset_delta + write_rate * window)
+            psync = bool(data.get('repl_backlog_active')) and data.get('repl_backlog_size', 0) >= required
+            results[shard] = BacklogResult(shard, data.get('repl_backlog_size', 0), data.get('repl_backlog_histlen', 0),
+                                           offset_delta, write_rate, required, psync)
+
+        for shard, error in self.map(check, dc_replica).iteritems():
+            logger.error('Unable to check the replication backlog of shard {shard}: {e!r}'.format(shard=shard, e=error))
+            results[shard] = BacklogResult(shard, None, None, None, None, None, False)
+
+        return results
+
+    @staticmethod
+    def _check_shard_parity(shard, master, replica, deadline):
+        """Wait for a replica to reach the replication offset of its master until the deadline, return a ParityResult.
+
+        A replica that is still synchronizing with its master is not considered converged, whatever its offset.
+
+        Arguments:
+        shard    -- the name of the shard
+        master   -- the RedisInstance of the master
+        replica  -- the RedisInstance of the replica
+        deadline -- the timestamp until which to wait
+        """
+        start = time.time()
+        if replica.refresh().get('role') != 'slave' or replica.slave_of != str(master):
+            return ParityResult(shard, None, None, None, 0.0, False)
+
+        target = master.refresh()['master_repl_offset']
+        sleep = PARITY_SLEEP_MIN
+        while True:
+            data = replica.refresh()
+            offset = data.get('slave_repl_offset', -1)
+            syncing = bool(data.get('master_sync_in_progress')) or data.get('master_link_status', 'up') != 'up'
+            if (offset >= target and not syncing) or time.time() >= deadline:
+                break
+            time.sleep(min(sleep, max(0, deadline - time.time())))
+            sleep = min(PARITY_SLEEP_MAX, sleep * 2)
+
+        return ParityResult(shard, target - offset, master.keys_count - replica.keys_count,
+                            offset >= target and not syncing, time.time() - start, syncing)
 
     @property
     def hosts(self):
@@ -1,4 +1,16 @@
-from collections import defaultdict
+import copy
+import gzip
+import hashlib
+import math
+import os
+import pipes
+import Queue
+import re
+import threading
+import time
+
+from collections import defaultdict, deque
+from multiprocessing.pool import ThreadPool
 
 import yaml
 
@@ -7,40 +19,514 @@ from ClusterShell.NodeSet import NodeSet
 from cumin.query import QueryBuilder
 from cumin.transport import Transport
 
-from switchdc import SwitchdcError
+from switchdc import get_global_config, SwitchdcError
 from switchdc.dry_run import is_dry_run
+from switchdc.lib.governor import governor
 from switchdc.log import logger
+from switchdc.timing import timed, timings
 
 
 # Load cumin's configuration
 with open('/etc/cumin/config.yaml', 'r') as f:
     cumin_config = yaml.safe_load(f)
 
+# Multiplex the SSH connections, so that the ones opened by the pre-warm phase are reused by all the later commands.
+# Options already present in Cumin's configuration take precedence, as SSH uses the first value it gets.
+SSH_CONTROL_PERSIST = get_global_config().get('ssh_control_persist', 3600)
+SSH_MULTIPLEXING_OPTIONS = [
+    '-o ControlMaster=auto',
+    '-o ControlPath=~/.ssh/switchdc-%C',
+    '-o ControlPersist={persist}'.format(persist=SSH_CONTROL_PERSIST),
+    '-o ServerAliveInterval=30',  # Keepalive of the master connections
+    '-o ServerAliveCountMax=3',
+]
+cumin_config.setdefault('clustershell', {}).setdefault('ssh_options', []).extend(SSH_MULTIPLEXING_OPTIONS)
+
+SITE_QUERY = 'R:Ganglia::Cluster%site = {site}'
+# Seconds after which a cached PuppetDB query result is considered stale
+INVENTORY_TTL = get_global_config().get('inventory_ttl', 300)
+# Maximum number of PuppetDB queries executed concurrently by Remote.query_many
+MAX_QUERY_POOL_SIZE = 10
+# Maximum number of Cumin executions running concurrently in background through Remote.submit
+MAX_RUN_POOL_SIZE = 10
+# Seconds to wait before sending SIGKILL to a command that was terminated for exceeding its per-host timeout
+HOST_TIMEOUT_KILL_AFTER = 10
+# Above this number of hosts only their number is logged for each execution
+MAX_LOGGED_HOSTS = 100
+# Directory where the full outputs of the executions with an OutputCollector are saved
+OUTPUT_DIR = get_global_config().get('output_dir', '/var/log/switchdc-outputs')
+# ClusterShell's task defaults that enable the buffering of the output, disabled by the OutputCollector executions
+MSGTREE_DEFAULTS = ('stdout_msgtree', 'stderr_msgtree')
+
 
 class RemoteExecutionError(SwitchdcError):
     """Custom exception class for errors of this module."""
 
 
+class Inventory(object):
+    """Cache of the hosts returned by PuppetDB queries, shared by all the Remote instances of a run."""
+
+    def __init__(self, ttl=INVENTORY_TTL):
+        """Inventory constructor.
+
+        Arguments:
+        ttl -- the number of seconds after which a cached query result expires. [optional, default: INVENTORY_TTL]
+        """
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._queries = {}  # Query string: (timestamp, hosts)
+        self._sites = {}  # Site name: (timestamp, hosts)
+        self._lock = threading.Lock()
+
+    def get(self, query_string):
+        """Return the cached hosts for the given query, None if not cached or expired.
+
+        Arguments:
+        query_string -- the Cumin query string
+        """
+        return self._lookup(self._queries, query_string)
+
+    def store(self, query_string, hosts):
+        """Cache the hosts returned by a query.
+
+        Arguments:
+        query_string -- the Cumin query string
+        hosts        -- the set of hosts returned by the query
+        """
+        with self._lock:
+            self._queries[query_string] = (time.time(), frozenset(hosts))
+
+    def site_hosts(self, site, count_miss=True):
+        """Return the indexed hosts of a site, None if the site is not indexed or expired.
+
+        Arguments:
+        site       -- the name of the site
+        count_miss -- whether to count a miss in the statistics. [optional, default: True]
+        """
+        return self._lookup(self._sites, site, count_miss=count_miss)
+
+    def index_site(self, site, hosts):
+        """Add the hosts of a site to the site index.
+
+        Arguments:
+        site  -- the name of the site
+        hosts -- the set of hosts that belong to the site
+        """
+        with self._lock:
+            self._sites[site] = (time.time(), frozenset(hosts))
+
+    def invalidate(self, query_string=None):
+        """Invalidate the cached results, the site index is invalidated too when no query is specified.
+
+        Arguments:
+        query_string -- the Cumin query string to invalidate, all of them if None. [optional, default: None]
+        """
+        with self._lock:
+            if query_string is None:
+                self._queries.clear()
+                self._sites.clear()
+            else:
+                self._queries.pop(query_string, None)
+
+    def _lookup(self, cache, key, count_miss=True):
+        """Return the cached hosts for the key in the given cache, updating hit and miss counters.
+
+        Arguments:
+        cache      -- the dictionary to look into
+        key        -- the key to look for
+        count_miss -- whether to count a miss in the statistics. [optional, default: True]
+        """
+        with self._lock:
+            entry = cache.get(key)
+            if entry is not None and time.time() - entry[0] < self.ttl:
+                self.hits += 1
+                return set(entry[1])
+
+            cache.pop(key, None)
+            if count_miss:
+                self.misses += 1
+            return None
+
+
+inventory = Inventory()
+_run_pool = None  # Lazily initialized thread pool for Remote.submit
+
+
+def wait_all(runs):
+    """Wait for the completion of all the given runs, raising the first error encountered once all are completed.
+
+    Arguments:
+    runs -- an iterable of RemoteRun instances
+    """
+    error = None
+    for run in runs:
+        try:
+            run.wait()
+        except Exception as e:
+            if error is None:
+                error = e
+
+    if error is not None:
+        raise error
+
+
+def get_timeout_command(command, timeout):
+    """Return the command wrapped to be terminated if it runs for longer than timeout seconds on a host.
+
+    The wrapped command exits with return code 124 when terminated, see timeout(1).
+
+    Arguments:
+    command -- the command to wrap
+    timeout -- the timeout in seconds
+    """
+    return 'timeout --kill-after={kill} {timeout} sh -c {command}'.format(
+        kill=HOST_TIMEOUT_KILL_AFTER, timeout=timeout, command=pipes.quote(command))
+
+
+def get_streaming_handler(base, on_result, on_line=None):
+    """Return a Cumin's event handler class that reports the result of each host as soon as it completes.
+
+    Arguments:
+    base      -- the Cumin's event handler class to extend
+    on_result -- a callable called with (host, rc, output) each time a host completes all the commands or fails one.
+                 If it returns False the whole execution is aborted.
+    on_line   -- a callable called with (host, line) for each line of output. When set the output is not buffered and
+                 on_result is called with an empty output. [optional, default: None]
+    """
+    class StreamingEventHandler(base):
+        """Cumin's event handler that calls on_result as each host completes."""
+
+        def __init__(self, *args, **kwargs):
+            super(StreamingEventHandler, self).__init__(*args, **kwargs)
+            self._stream_buffers = {}
+
+        def ev_read(self, worker):
+            super(StreamingEventHandler, self).ev_read(worker)
+            if on_line is None:
+                self._stream_buffers.setdefault(worker.current_node, []).append(str(worker.current_msg))
+            else:
+                on_line(worker.current_node, str(worker.current_msg))
+
+        def ev_hup(self, worker):
+            host = worker.current_node
+            rc = worker.current_rc
+            # Check it before calling the parent, that might schedule the next command for the host
+            completed = rc != 0 or self.nodes[host].running_command_index == len(self.commands) - 1
+            super(StreamingEventHandler, self).ev_hup(worker)
+
+            if completed:
+                output = '\n'.join(self._stream_buffers.pop(host, []))
+                if on_result(host, rc, output) is False:
+                    logger.debug('Aborting execution after the result of host {host}'.format(host=host))
+                    worker.task.abort()
+
+    return StreamingEventHandler
+
+
+class HostOutput(object):
+    """Bounded summary of the output of a host: a digest, the lines matching the patterns and the last lines."""
+
+    def __init__(self, patterns, tail_size, max_matches):
+        """HostOutput constructor.
+
+        Arguments:
+        patterns    -- the list of compiled regular expressions to look for
+        tail_size   -- the number of last lines to keep
+        max_matches -- the maximum number of matching lines to keep for each pattern
+        """
+        self.rc = None
+        self.lines = 0
+        self.tail = deque(maxlen=tail_size)
+        self.matches = defaultdict(list)  # Pattern string: list of matching lines
+        self._patterns = patterns
+        self._max_matches = max_matches
+        self._digest = hashlib.sha1()
+
+    def add_line(self, line):
+        """Add a line of output.
+
+        Arguments:
+        line -- the line to add
+        """
+        self.lines += 1
+        self.tail.append(line)
+        self._digest.update(line + '\n')
+        for pattern in self._patterns:
+            if len(self.matches[pattern.pattern]) < self._max_matches and pattern.search(line) is not None:
+                self.matches[pattern.pattern].append(line)
+
+    def matched(self, pattern):
+        """Return True if any line matched the given pattern.
+
+        Arguments:
+        pattern -- the pattern string, as passed to the OutputCollector
+        """
+        return bool(self.matches.get(pattern))
+
+    @property
+    def digest(self):
+        """The SHA1 hex digest of the whole output."""
+        return self._digest.hexdigest()
+
+
+class OutputCollector(object):
+    """Collect the output of an execution with bounded memory, streaming the full output to a compressed file.
+
+    Only a HostOutput summary is kept in memory for each host, while all the lines are written to a gzip file in the
+    '<host>: <line>' format. Cumin's own output buffering is disabled for the executions that use it, hence the
+    worker's get_results() doesn't return any result.
+    """
+
+    def __init__(self, patterns=(), tail_size=20, max_matches=10, output_dir=OUTPUT_DIR):
+        """OutputCollector constructor.
+
+        Arguments:
+        patterns    -- a list of regular expressions to look for in each line. [optional, default: ()]
+        tail_size   -- the number of last lines to keep for each host. [optional, default: 20]
+        max_matches -- the maximum number of matching lines to keep for each pattern and host.
+                       [optional, default: 10]
+        output_dir  -- the directory where to save the full output. [optional, default: OUTPUT_DIR]
+        """
+        self.hosts = {}  # Host: HostOutput
+        self.path = os.path.join(output_dir, '{time}-{pid}-{id}.log.gz'.format(
+            time=time.strftime('%Y%m%d%H%M%S'), pid=os.getpid(), id=id(self)))
+        self._patterns = [re.compile(pattern) for pattern in patterns]
+        self._tail_size = tail_size
+        self._max_matches = max_matches
+        self._file = None
+        self._lock = threading.Lock()  # The hosts of the adaptive batching mode are executed concurrently
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+
+    def add_line(self, host, line):
+        """Add a line of output of a host.
+
+        Arguments:
+        host -- the host that generated the line
+        line -- the line of output
+        """
+        self.get(host).add_line(line)
+        with self._lock:
+            if self._file is None:
+                self._file = gzip.open(self.path, 'ab')  # Appending allows to reuse it across executions
+
+            self._file.write('{host}: {line}\n'.format(host=host, line=line))
+
+    def complete(self, host, rc):
+        """Record the completion of a host and return its last lines of output.
+
+        Arguments:
+        host -- the host that completed
+        rc   -- the return code of the host
+        """
+        output = self.get(host)
+        output.rc = rc
+        return '\n'.join(output.tail)
+
+    def get(self, host):
+        """Return the HostOutput of a host.
+
+        Arguments:
+        host -- the host to get the output for
+        """
+        if host not in self.hosts:
+            self.hosts[host] = HostOutput(self._patterns, self._tail_size, self._max_matches)
+
+        return self.hosts[host]
+
+    def close(self):
+        """Close the file with the full output."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+    def read(self, host):
+        """Generator that yields the full output of a host, reading it from the saved file.
+
+        Arguments:
+        host -- the host to read the output for
+        """
+        prefix = '{host}: '.format(host=host)
+        with gzip.open(self.path, 'rb') as fh:
+            for line in fh:
+                if line.startswith(prefix):
+                    yield line[len(prefix):].rstrip('\n')
+
+
+class AdaptiveBatch(object):
+    """Configuration and timeline of the adaptive batching mode of Remote executions.
+
+    The hosts are processed in consecutive batches, starting from the initial size. The size grows while the
+    completion latency and the failure ratio of each batch stay within the limits and shrinks when they don't, without
+    ever taking out of service more hosts than allowed by the min_pooled ratio.
+    """
+
+    def __init__(self, initial=1, max_latency=60.0, max_failure_ratio=0.0, min_pooled=0.9, growth_factor=2,
+                 max_batch=None):
+        """AdaptiveBatch constructor.
+
+        Arguments:
+        initial           -- the size of the first batch. [optional, default: 1]
+        max_latency       -- the maximum completion latency in seconds of the slowest host of a batch to consider it
+                             healthy. [optional, default: 60.0]
+        max_failure_ratio -- the maximum ratio of failed hosts in a batch to consider it healthy. A float between 0.0
+                             and 1.0. [optional, default: 0.0]
+        min_pooled        -- the minimum ratio of hosts that must not be part of the current batch, to guarantee the
+                             pooled capacity. A float between 0.0 and 1.0. [optional, default: 0.9]
+        growth_factor     -- the factor by which the batch size is multiplied or divided. [optional, default: 2]
+        max_batch         -- the maximum batch size, for the executions whose hosts must not run all at the same
+                             moment regardless of the pooled capacity. [optional, default: None]
+        """
+        self.initial = initial
+        self.max_latency = max_latency
+        self.max_failure_ratio = max_failure_ratio
+        self.min_pooled = min_pooled
+        self.growth_factor = growth_factor
+        self.max_batch = max_batch
+        self.timeline = []  # List of (batch_size, latency, failure_ratio) tuples
+
+    def max_size(self, num_hosts):
+        """Return the maximum batch size allowed by the pooled capacity floor and by max_batch.
+
+        Arguments:
+        num_hosts -- the total number of hosts
+        """
+        size = num_hosts - int(math.ceil(num_hosts * self.min_pooled))
+        if self.max_batch is not None:
+            size = min(size, self.max_batch)
+
+        return max(1, size)
+
+    def next_size(self, size, num_hosts, latency, failure_ratio):
+        """Record the outcome of a batch in the timeline and return the size of the next one.
+
+        Arguments:
+        size          -- the size of the completed batch
+        num_hosts     -- the total number of hosts
+        latency       -- the completion latency in seconds of the slowest host of the batch
+        failure_ratio -- the ratio of failed hosts in the batch
+        """
+        self.timeline.append((size, latency, failure_ratio))
+        if latency <= self.max_latency and failure_ratio <= self.max_failure_ratio:
+            size *= self.growth_factor
+        else:
+            size //= self.growth_factor
+
+        return min(max(1, size), self.max_size(num_hosts))
+
+
+class RemoteRun(object):
+    """Handle of a Cumin's execution started in background by Remote.submit."""
+
+    def __init__(self, remote, result):
+        """RemoteRun constructor.
+
+        Arguments:
+        remote -- the Remote instance that executes the commands
+        result -- the multiprocessing AsyncResult of the execution
+        """
+        self.remote = remote
+        self._result = result
+
+    def done(self):
+        """Return True if the execution is completed, False otherwise."""
+        return self._result.ready()
+
+    def wait(self, timeout=None):
+        """Wait for the execution to complete and return its return code. Re-raise any error of the execution.
+
+        Arguments:
+        timeout -- the maximum number of seconds to wait for. [optional, default: None]
+        """
+        self._result.wait(timeout)
+        if not self._result.ready():
+            logger.error("Execution on '{num}' hosts still running after {timeout} seconds".format(
+                num=len(self.remote.hosts), timeout=timeout))
+            raise RemoteExecutionError(2)
+
+        return self._result.get()
+
+    @property
+    def hosts(self):
+        return self.remote.hosts
+
+    @property
+    def results(self):
+        """Dictionary of host: output of the completed execution."""
+        if not self.done():
+            raise RemoteExecutionError(3)
+
+        return self.remote.results
+
+
 class Remote(object):
 
     def __init__(self, site=None):
         if site is None:
             self._site = None
         else:
-            self._site = Remote.query('R:Ganglia::Cluster%site = {}'.format(site))
+            self._site = Remote.site_hosts(site)
             logger.debug('Filtering host selection for site: {site}'.format(site=site))
 
         self._hosts = []
+        self._results = {}  # Host: output of the last execution, see _run()
+        self._failures = defaultdict(list)  # Index of the failed command: hosts of the last execution, see _run()
         self.worker = None
+        self.stragglers = []
 
     @staticmethod
     def query(query_string):
-        query = QueryBuilder(query_string, cumin_config, logger).build()
-        hosts = set(query.execute())
+        hosts = inventory.get(query_string)
+        if hosts is not None:
+            logger.debug('Cached hosts for query: {query}'.format(query=query_string))
+            return hosts
+
+        with governor.acquire('puppetdb'), timed('puppetdb.query'):
+            query = QueryBuilder(query_string, cumin_config, logger).build()
+            hosts = set(query.execute())
+        inventory.store(query_string, hosts)
         logger.debug('Fetched hosts for query: {query}'.format(query=query_string))
 
         return hosts
 
+    @staticmethod
+    def query_many(*query_strings):
+        """Execute multiple queries concurrently, return a list with the set of hosts for each query, in order.
+
+        Duplicated queries are executed only once and cached results don't hit PuppetDB.
+
+        Arguments:
+        *query_strings -- the Cumin query strings to execute
+        """
+        unique = list(set(query_strings))
+        if not unique:
+            return []
+
+        pool = ThreadPool(min(len(unique), MAX_QUERY_POOL_SIZE))
+        try:
+            results = dict(zip(unique, pool.map(Remote.query, unique)))
+        finally:
+            pool.close()
+            pool.join()
+
+        return [set(results[query_string]) for query_string in query_strings]
+
+    @staticmethod
+    def site_hosts(site):
+        """Return the set of hosts of a site, using the site index of the inventory when available.
+
+        Arguments:
+        site -- the name of the site
+        """
+        hosts = inventory.site_hosts(site, count_miss=False)  # On miss the fallback query counts it
+        if hosts is None:
+            hosts = Remote.query(SITE_QUERY.format(site=site))
+            inventory.index_site(site, hosts)
+
+        return hosts
+
     def select(self, q):
         if type(q) is set:
             host_list = q
@@ -58,7 +544,31 @@ class Remote(object):
     def sync(self, *commands, **kwargs):
         return self._run('sync', commands, **kwargs)
 
-    def _run(self, mode, commands, success_threshold=1.0, batch_size=None, batch_sleep=0, is_safe=False):
+    def submit(self, *commands, **kwargs):
+        """Start the execution of the commands in background and return a RemoteRun handle.
+
+        The execution is done on a copy of this instance, so that multiple executions can be submitted from the same
+        instance. Accept the same keyword arguments of _run.
+
+        Arguments:
+        *commands -- the list of commands to execute on the selected hosts
+        mode      -- the Cumin's mode of execution. Accepted values: sync, async. [optional, default: sync]
+        """
+        global _run_pool
+        if _run_pool is None:
+            _run_pool = ThreadPool(MAX_RUN_POOL_SIZE)
+
+        mode = kwargs.pop('mode', 'sync')
+        remote = copy.copy(self)
+        remote.worker = None
+        remote._results = {}
+        remote._failures = defaultdict(list)
+
+        return RemoteRun(remote, _run_pool.apply_async(remote._run, (mode, commands), kwargs))
+
+    def _run(self, mode, commands, success_threshold=1.0, batch_size=None, batch_sleep=0, is_safe=False,
+             on_result=None, timeout=None, host_timeout=None, early_completion=False, keep_stragglers=False,
+             output=None):
         """Lower level Cumin's execution of commands on a list o hosts.
 
         Arguments:
@@ -66,41 +576,334 @@ class Remote(object):
         commands          -- the list of commands to execute on the matching hosts
         success_threshold -- the threshold to consider the execution still successful. A float between 0.0 and 1.0.
                              [optional, default: 1.0]
-        batch_size        -- the batch size to use in cumin. [optional, default: None]
+        batch_size        -- the batch size to use in cumin or an AdaptiveBatch instance to use the adaptive batching
+                             mode. [optional, default: None]
         batch_sleep       -- the batch sleep in seconds to use in Cumin before scheduling the next host.
                              [optional, default: 0]
         is_safe           -- the command is safe to run also in dry-run mode because it's a read-only command that
                              don't change the state. [optional, default: False]
+        on_result         -- a callable called with (host, rc, output) as soon as each host completes all the commands
+                             or fails one of them. If it returns False the execution is aborted. See
+                             get_streaming_handler(). [optional, default: None]
+        timeout           -- the timeout in seconds for the whole execution in Cumin. [optional, default: None]
+        host_timeout      -- the timeout in seconds of each command on each host, see get_timeout_command().
+                             [optional, default: None]
+        early_completion  -- return as soon as the success_threshold is met, without waiting for the remaining hosts
+                             that are reported as stragglers. [optional, default: False]
+        keep_stragglers   -- with early_completion, let the stragglers complete in background instead of aborting
+                             their execution. [optional, default: False]
+        output            -- an OutputCollector instance to keep the output with bounded memory. The output passed to
+                             on_result is then limited to the last lines of each host. [optional, default: None]
         """
+        self._results = {}
+        self._failures = defaultdict(list)
+        if host_timeout is not None:
+            commands = [get_timeout_command(command, host_timeout) for command in commands]
+
+        if early_completion:
+            return self._run_early(mode, commands, keep_stragglers, success_threshold=success_threshold,
+                                   batch_size=batch_size, batch_sleep=batch_sleep, is_safe=is_safe,
+                                   on_result=on_result, timeout=timeout, output=output)
+
+        if isinstance(batch_size, AdaptiveBatch):
+            return self._run_adaptive(mode, commands, batch_size, success_threshold=success_threshold,
+                                      batch_sleep=batch_sleep, is_safe=is_safe, on_result=on_result, timeout=timeout,
+                                      output=output)
+
         self.worker = Transport.new(cumin_config, logger)
         self.worker.hosts = self.hosts
         self.worker.commands = list(commands)
         self.worker.handler = mode
+
+        def record(host, rc, host_output):
+            # Completion time of each host since the start of the execution
+            timings.record('remote.host', time.time() - start, host=host)
+            if output is not None:
+                host_output = output.complete(host, rc)
+            if on_result is not None:
+                return on_result(host, rc, host_output)
+
+        if output is None:
+            self.worker.handler = get_streaming_handler(self.worker.handler, record)
+        else:
+            self.worker.handler = get_streaming_handler(self.worker.handler, record, on_line=output.add_line)
         self.worker.success_threshold = success_threshold
         self.worker.batch_size = batch_size
         if batch_sleep > 0:
             self.worker.batch_sleep = batch_sleep
+        if timeout is not None:
+            self.worker.timeout = timeout
 
-        logger.debug("Executing commands {commands} on '{num}' hosts: {hosts}".format(
-            commands=commands, num=len(self.hosts), hosts=NodeSet.fromlist(self.hosts)))
+        if len(self.hosts) > MAX_LOGGED_HOSTS:
+            logger.debug("Executing commands {commands} on '{num}' hosts".format(
+                commands=commands, num=len(self.hosts)))
+        else:
+            logger.debug("Executing commands {commands} on '{num}' hosts: {hosts}".format(
+                commands=commands, num=len(self.hosts), hosts=NodeSet.fromlist(self.hosts)))
 
         if is_dry_run() and not is_safe:
             return 0
 
-        rc = self.worker.execute()
+        task = self.worker.task  # ClusterShell's task of the current thread, shared by all its executions
+        msgtree = {key: task.default(key) for key in MSGTREE_DEFAULTS}
+        try:
+            if output is not None:
+                # Disable ClusterShell's buffering of the whole output for this execution only
+                for key in MSGTREE_DEFAULTS:
+                    task.set_default(key, False)
+
+            with governor.acquire('hosts', min(len(self.hosts), batch_size or len(self.hosts))):
+                start = time.time()  # Don't count the time spent waiting for the governor
+                with timed('remote.run'):
+                    rc = self.worker.execute()
+        finally:
+            # Snapshot the results, ClusterShell resets the thread's task buffers at the start of its next execution
+            self._failures = self._get_worker_failures()
+            if output is None:
+                self._results = self._get_worker_results()
+            else:
+                for key in MSGTREE_DEFAULTS:
+                    task.set_default(key, msgtree[key])
+                output.close()
+                logger.debug('Full output of the execution saved in {path}'.format(path=output.path))
 
         if rc != 0 and not is_dry_run():
             raise RemoteExecutionError(rc)
 
         return 0
 
+    def prewarm(self):
+        """Open the persistent multiplexed SSH connections to the selected hosts, return the unreachable ones."""
+        logger.debug("Pre-connecting to '{num}' hosts".format(num=len(self.hosts)))
+        try:
+            self.sync('true', success_threshold=0.0, is_safe=True)
+        except RemoteExecutionError:
+            pass  # The unreachable hosts are reported below
+
+        connected = set()
+        if self.worker is not None and self.worker._handler_instance is not None:
+            connected = {node.name for node in self.worker._handler_instance.nodes.itervalues()
+                         if node.state.is_success}
+
+        return sorted(set(self.hosts) - connected)
+
+    def _run_adaptive(self, mode, commands, batch, success_threshold=1.0, batch_sleep=0, is_safe=False,
+                      on_result=None, timeout=None, output=None):
+        """Execute the commands in a sliding window of hosts whose size is adapted to the outcome of the completed ones.
+
+        A host is started as soon as a slot of the window is free. Each time as many hosts as the window size have
+        completed, the window is resized according to their slowest latency and their failure ratio. The hosts are
+        executed in a dedicated thread pool, separated from the one of Remote.submit.
+
+        Arguments:
+        mode              -- the Cumin's mode of execution. Accepted values: sync, async
+        commands          -- the list of commands to execute on the matching hosts
+        batch             -- the AdaptiveBatch instance with the limits to use
+        success_threshold -- the threshold to consider the execution still successful. A float between 0.0 and 1.0.
+                             [optional, default: 1.0]
+        batch_sleep       -- the sleep in seconds before starting the next host. [optional, default: 0]
+        is_safe           -- the command is safe to run also in dry-run mode. [optional, default: False]
+        on_result         -- a callable called with (host, rc, output) as each host completes. [optional, default: None]
+        timeout           -- the timeout in seconds for the execution of each host. [optional, default: None]
+        output            -- an OutputCollector instance to keep the output with bounded memory.
+                             [optional, default: None]
+        """
+        hosts = list(self.hosts)
+        size = min(max(1, batch.initial), batch.max_size(len(hosts)))
+        if is_dry_run() and not is_safe:
+            logger.debug("Executing commands {commands} on '{num}' hosts in adaptive batches from {size}".format(
+                commands=commands, num=len(hosts), size=size))
+            return 0
+
+        completions = Queue.Queue()  # (latency, rc, Remote instance) of each completed host
+
+        def execute(host):
+            remote = copy.copy(self)
+            remote._hosts = [host]
+            remote.worker = None
+            rcs = {}
+            start = time.time()
+
+            def collect(host, rc, host_output):
+                rcs[host] = rc
+                if on_result is not None:
+                    return on_result(host, rc, host_output)
+
+            try:
+                remote._run(mode, commands, success_threshold=0.0, is_safe=is_safe, on_result=collect, timeout=timeout,
+                            output=output)
+            except RemoteExecutionError:
+                pass  # Failures are counted below
+            except Exception as e:
+                logger.error('Failed to execute commands on host {host}: {e!r}'.format(host=host, e=e))
+            finally:
+                completions.put((time.time() - start, rcs.get(host, 1), remote))
+
+        pool = ThreadPool(batch.max_size(len(hosts)))
+        window = []  # (latency, rc) of the hosts completed since the last resize
+        failed = 0
+        started = 0
+        running = 0
+        aborted = False
+        try:
+            while started < len(hosts) or running > 0:
+                while not aborted and running < size and started < len(hosts):
+                    if started > 0 and batch_sleep > 0:
+                        time.sleep(batch_sleep)
+                    pool.apply_async(execute, (hosts[started],))
+                    started += 1
+                    running += 1
+
+                if running == 0:
+                    break  # Aborted
+
+                latency, rc, remote = completions.get()
+                running -= 1
+                self.worker = remote.worker
+                self._results.update(remote.results)
+                for index, failed_hosts in remote.failures.iteritems():
+                    self._failures[index].extend(failed_hosts)
+
+                window.append((latency, rc))
+                if rc != 0:
+                    failed += 1
+                if not aborted and float(failed) / len(hosts) > 1.0 - success_threshold:
+                    logger.error("Aborting adaptive execution after '{failed}' failures on '{done}/{num}' hosts, "
+                                 "waiting for the '{running}' running ones".format(
+                                     failed=failed, done=started - running, num=len(hosts), running=running))
+                    aborted = True
+
+                if len(window) >= size or (running == 0 and window):
+                    size = batch.next_size(len(window), len(hosts), max(item[0] for item in window),
+                                           float(len([item for item in window if item[1] != 0])) / len(window))
+                    window = []
+        finally:
+            pool.close()
+            pool.join()
+
+        self._log_adaptive_timeline(batch)
+        if aborted:
+            raise RemoteExecutionError(1)
+
+        return 0
+
+    def _run_early(self, mode, commands, keep_stragglers, success_threshold=1.0, on_result=None, **kwargs):
+        """Execute the commands returning as soon as the success threshold is met.
+
+        The hosts not yet completed at that moment are stored in the stragglers attribute. The execution runs on a
+        dedicated thread, so that the stragglers can be left running in background, while their abort is requested
+        from the execution itself. Accept the same keyword arguments of _run.
+
+        Arguments:
+        mode              -- the Cumin's mode of execution. Accepted values: sync, async
+        commands          -- the list of commands to execute on the matching hosts
+        keep_stragglers   -- whether to let the stragglers complete in background instead of aborting them
+        success_threshold -- the threshold to consider the execution successful. [optional, default: 1.0]
+        on_result         -- a callable called with (host, rc, output) as each host completes. [optional, default: None]
+        """
+        required = int(math.ceil(len(self.hosts) * success_threshold))
+        completed = set()
+        succeeded = set()
+        threshold_met = threading.Event()
+        finished = threading.Event()
+        outcome = {}
+
+        def track(host, rc, output):
+            completed.add(host)
+            if rc == 0:
+                succeeded.add(host)
+                if len(succeeded) >= required:
+                    threshold_met.set()
+
+            ret = None
+            if on_result is not None:
+                ret = on_result(host, rc, output)
+            if threshold_met.is_set() and not keep_stragglers and len(completed) < len(self.hosts):
+                return False  # Abort the stragglers
+
+            return ret
+
+        remote = copy.copy(self)
+        remote.worker = None
+
+        def execute():
+            try:
+                outcome['rc'] = remote._run(mode, commands, success_threshold=success_threshold, on_result=track,
+                                            **kwargs)
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                finished.set()
+
+        thread = threading.Thread(target=execute)
+        thread.daemon = True  # Don't block the exit on the stragglers left running in background
+        thread.start()
+        while not finished.is_set() and not threshold_met.wait(0.5):
+            pass
+
+        if not keep_stragglers or not threshold_met.is_set():
+            thread.join()
+
+        self.worker = remote.worker
+        self._results = remote._results
+        self._failures = remote._failures
+        if not threshold_met.is_set():
+            self.stragglers = []
+            if 'error' in outcome:
+                raise outcome['error']
+            return outcome['rc']
+
+        self.stragglers = sorted(set(self.hosts) - completed)
+        if self.stragglers:
+            logger.warning("Success threshold met, '{num}' stragglers {action}: {hosts}".format(
+                num=len(self.stragglers), action='left running in background' if keep_stragglers else 'aborted',
+                hosts=NodeSet.fromlist(self.stragglers)))
+
+        return 0
+
+    @staticmethod
+    def _log_adaptive_timeline(batch):
+        """Log the batch size timeline chosen by the adaptive batching mode.
+
+        Arguments:
+        batch -- the AdaptiveBatch instance
+        """
+        logger.info('Adaptive batch sizes: {sizes}'.format(sizes=', '.join(
+            '{size} ({latency:.1f}s, {failures:.0%} failed)'.format(size=size, latency=latency, failures=ratio)
+            for size, latency, ratio in batch.timeline)))
+
     @property
     def hosts(self):
         return self._hosts
 
+    @property
+    def results(self):
+        """Dictionary of host: output message of the last execution."""
+        return dict(self._results)
+
+    def _get_worker_results(self):
+        """Return the dictionary of host: output message read from the worker of the last execution."""
+        results = {}
+        if self.worker is None:
+            return results
+
+        for nodeset, output in self.worker.get_results():
+            for host in nodeset:
+                results[host] = output.message()
+
+        return results
+
     @property
     def failures(self):
+        """Dictionary of index of the failed command: list of hosts of the last execution."""
+        return defaultdict(list, {index: list(hosts) for index, hosts in self._failures.iteritems()})
+
+    def _get_worker_failures(self):
+        """Return the dictionary of index of the failed command: list of hosts read from the worker."""
         failed_commands = defaultdict(list)
+        if self.worker is None or self.worker._handler_instance is None:
+            return failed_commands
+
         for node in self.worker._handler_instance.nodes.itervalues():
             if node.state.is_failed:
                 failed_commands[node.running_command_index].append(node.name)
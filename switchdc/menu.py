@@ -1,5 +1,7 @@
 from switchdc import SwitchdcError
+from switchdc.lib.remote import inventory
 from switchdc.log import log_task_end, log_task_start, logger
+from switchdc.timing import timings
 
 
 class Menu(object):
@@ -125,6 +127,8 @@ class Item(object):
     def run(self):
         """Run the item, calling the configured function."""
         log_task_start(self.title)
+        hits, misses = inventory.hits, inventory.misses
+        timings.reset()
 
         try:
             self.function(*self.args, **self.kwargs)
@@ -140,6 +144,10 @@ class Item(object):
         else:
             self.status = self.failed
 
+        logger.debug('PuppetDB inventory cache for task {task}: {hits} hits, {misses} misses'.format(
+            task=self.name, hits=inventory.hits - hits, misses=inventory.misses - misses))
+        for line in timings.summary():
+            logger.info('Latency of task {task}: {line}'.format(task=self.name, line=line))
         log_task_end(self.status, self.title)
 
         return retval
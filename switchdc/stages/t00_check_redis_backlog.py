@@ -0,0 +1,46 @@
+from switchdc.lib.redis_cluster import RedisShardsBase
+from switchdc.log import logger
+from switchdc.stages import get_module_config, get_module_config_dir
+
+__title__ = 'Check that the Redis replication backlogs in {dc_to} are large enough for a partial resync'
+
+dirname = 't06_redis'
+config = get_module_config(dirname)
+config_dir = get_module_config_dir(dirname)
+REDIS_PASSWORD = config.get('redis_password', None)
+# Seconds of writes that the backlog should hold to cover the replication inversion of t06_redis
+INVERSION_WINDOW = config.get('backlog_inversion_window', 60)
+# The jobqueue instances in dc_to are restarted by t04_resync_redis, that resets their backlog
+CLUSTERS = ('sessions',)
+
+
+def execute(dc_from, dc_to):
+    """Predict if the instances in dc_from will be served by a partial resync once they replicate from dc_to.
+
+    Without it they fall back to a full sync after the replication is inverted in t06_redis. The shards at risk are
+    only reported, as a full sync is slower but not harmful.
+    """
+    at_risk = []
+    for cluster in CLUSTERS:
+        servers = RedisShardsBase(cluster, config_dir, REDIS_PASSWORD)
+        results = servers.check_backlog(dc_from, dc_to, window=INVERSION_WINDOW)
+        for shard, result in sorted(results.iteritems()):
+            if result.required is None:
+                at_risk.append('{cluster}/{shard}'.format(cluster=cluster, shard=shard))
+                continue
+
+            message = ('{cluster} {shard}: backlog size={size}, histlen={histlen}, offset delta={delta}, '
+                       'write rate={rate:.0f}B/s, required={required}').format(
+                cluster=cluster, shard=shard, size=result.backlog_size, histlen=result.backlog_histlen,
+                delta=result.offset_delta, rate=result.write_rate, required=result.required)
+            if result.psync:
+                logger.debug(message)
+            else:
+                logger.warning(message + ', at risk of a full sync')
+                at_risk.append('{cluster}/{shard}'.format(cluster=cluster, shard=shard))
+
+    if at_risk:
+        logger.warning('Redis shards at risk of a full sync after the inversion: {shards}'.format(
+            shards=', '.join(at_risk)))
+    else:
+        logger.info('All the Redis shards are expected to be served by a partial resync')
@@ -0,0 +1,64 @@
+from ClusterShell.NodeSet import NodeSet
+
+from switchdc.lib import mysql
+from switchdc.lib.redis_cluster import RedisShardsBase
+from switchdc.lib.remote import Remote
+from switchdc.log import logger
+from switchdc.stages import get_module_config, get_module_config_dir
+
+__title__ = 'Open persistent SSH connections to the hosts used during the read-only window in {dc_from} and {dc_to}'
+
+# TODO: move files to a common config dir?
+redis_dirname = 't06_redis'
+redis_config_dir = get_module_config_dir(redis_dirname)
+REDIS_PASSWORD = get_module_config(redis_dirname).get('redis_password', None)
+
+
+def execute(dc_from, dc_to):
+    """Pre-connect to all the hosts that will be reached by the tasks of stages 02 to 08.
+
+    The multiplexed SSH connections are kept open by SSH itself for the configured ssh_control_persist seconds, hence
+    this task should be run shortly before the read-only window starts. The same applies to the connections to the
+    core DB masters of the native MySQL backend, if enabled. The pooled connections to the Redis instances are kept
+    for the whole run.
+    """
+    # Exclude *.wikimedia.org hosts, all production cache hosts are *.$dc.wmnet with the exclusion of
+    # cp1008.wikimedia.org which is a special system used for testing.
+    dc_query = ('R:class = profile::cumin::target and R:class%site = {site} and R:class%cluster = cache_text and '
+                'not *.wikimedia.org')
+    deployment, masters, memcached, webservers, jobqueues, to_caches, from_caches = Remote.query_many(
+        'R:Class = Deployment::Rsync and R:Class%cron_ensure = absent',  # scap sync-file in t02 and t08
+        mysql.get_db_query(group='core', role='master'),  # t03, t04 and t07
+        'R:class = role::memcached',  # t04_cache_wipe
+        'R:class = role::mediawiki::webserver',  # t04_cache_wipe
+        'R:class = role::jobqueue_redis::master',  # t04_resync_redis
+        dc_query.format(site=dc_to), dc_query.format(site=dc_from))  # t05_switch_traffic
+
+    to_hosts = (memcached | webservers | jobqueues) & Remote.site_hosts(dc_to)
+    remote = Remote()
+    remote.select(deployment | masters | to_hosts | to_caches | from_caches)
+
+    logger.info('Opening persistent SSH connections to {num} hosts'.format(num=len(remote.hosts)))
+    unreachable = remote.prewarm()
+    if unreachable:
+        logger.warning('Unable to pre-connect to {num} hosts, they will connect on demand: {hosts}'.format(
+            num=len(unreachable), hosts=NodeSet.fromlist(unreachable)))
+    else:
+        logger.info('Pre-connected to all the {num} hosts'.format(num=len(remote.hosts)))
+
+    client = mysql.get_native_client()
+    if client is not None:
+        logger.info('Opening native MySQL connections to {num} core DB masters'.format(num=len(masters)))
+        unreachable = client.preconnect(masters)
+        if unreachable:
+            logger.warning('Unable to connect natively to {num} core DB masters: {hosts}'.format(
+                num=len(unreachable), hosts=NodeSet.fromlist(unreachable)))
+
+    for cluster in ('jobqueue', 'sessions'):  # t04_resync_redis and t06_redis
+        servers = RedisShardsBase(cluster, redis_config_dir, REDIS_PASSWORD)
+        unreachable = servers.preconnect()
+        if unreachable:
+            logger.warning('Unable to connect to {num} Redis instances of cluster {cluster}: {instances}'.format(
+                num=len(unreachable), cluster=cluster, instances=', '.join(str(i) for i in unreachable)))
+        else:
+            logger.info('Connected to all the Redis instances of cluster {cluster}'.format(cluster=cluster))
@@ -1,5 +1,3 @@
-import time
-
 from switchdc.lib.dnsdisc import Discovery
 
 __title__ = 'Reduce the TTL of all the MediaWiki read-write discovery records'
@@ -9,6 +7,5 @@ def execute(dc_from, dc_to):
     """Reduce the ttl on all appservers rw discovery entries."""
     ttl = Discovery('appservers-rw', 'api-rw', 'imagescaler-rw')
     ttl.update_ttl(10)
-    # Verify
-    time.sleep(5)
+    # Verify, waiting for all the authdns servers to converge
     ttl.check_ttl(10)
@@ -0,0 +1,15 @@
+from switchdc.lib import mysql
+from switchdc.log import logger
+
+__title__ = 'Start monitoring the replication lag of the core DB masters in {dc_to}'
+
+
+def execute(dc_from, dc_to):
+    """Start the background monitor of the replication lag of the core DB masters in dc_to.
+
+    The monitor is used by t02_start_mediawiki_readonly to refuse to start the read-only period if the estimated
+    catch-up time exceeds the configured budget. It runs until the core DB masters are in sync in t04_cache_wipe.
+    """
+    monitor = mysql.start_lag_monitor(dc_from, dc_to)
+    for line in monitor.report():
+        logger.info('Replication lag in {dc_to}: {line}'.format(dc_to=dc_to, line=line))
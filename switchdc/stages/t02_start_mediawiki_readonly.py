@@ -2,11 +2,16 @@ from datetime import datetime
 
 from switchdc import SwitchdcError
 from switchdc.dry_run import is_dry_run
-from switchdc.lib import mediawiki
+from switchdc.lib import mediawiki, mysql
 from switchdc.log import irc_logger, logger
+from switchdc.stages import get_module_config
 
 __title__ = 'Set MediaWiki in read-only mode in {dc_from} (db-{dc_from} config already merged and git pulled)'
 
+config = get_module_config('t02_start_mediawiki_readonly')
+# Maximum estimated catch-up time in seconds of the core DB masters in dc_to to start the read-only period
+MAX_CATCHUP_ETA = config.get('max_catchup_eta')
+
 
 def execute(dc_from, dc_to):
     """Deploy the MediaWiki DB config for dc_from to set MediaWiki in read-only mode.
@@ -26,6 +31,9 @@ def execute(dc_from, dc_to):
 ],"""  # noqa: E501
 
     if not mediawiki.check_config_line(filename, expected):
+        if MAX_CATCHUP_ETA is not None:
+            check_catchup_eta(dc_from, dc_to)
+
         log_message = 'MediaWiki read-only period starts at: {now}'.format(now=datetime.utcnow())
         logger.info(log_message)
         irc_logger.info(log_message)
@@ -34,3 +42,28 @@ def execute(dc_from, dc_to):
             logger.error('Read-only mode not changed in the MediaWiki config {filename}?'.format(
                 filename=filename))
             raise SwitchdcError(1)
+
+
+def check_catchup_eta(dc_from, dc_to):
+    """Ensure that the estimated catch-up time of the core DB masters in dc_to is within MAX_CATCHUP_ETA seconds.
+
+    The running replication lag monitor is used if started by t00_start_lag_monitor, a single sample is taken
+    otherwise.
+
+    Arguments:
+    dc_from -- the name of the datacenter to switch from
+    dc_to   -- the name of the datacenter to switch to
+    """
+    monitor = mysql.get_lag_monitor()
+    if monitor is None:
+        monitor = mysql.LagMonitor(dc_from, dc_to)
+        monitor.sample()
+
+    exceeding = monitor.exceeding(MAX_CATCHUP_ETA)
+    for line in monitor.report():
+        logger.info('Replication lag in {dc_to}: {line}'.format(dc_to=dc_to, line=line))
+
+    if exceeding and not is_dry_run():
+        logger.error('Estimated catch-up time of shards {shards} exceeds {budget}s or is unknown'.format(
+            shards=', '.join(sorted(exceeding)), budget=MAX_CATCHUP_ETA))
+        raise SwitchdcError(2)
@@ -8,9 +8,7 @@ __title__ = 'Set core DB masters in read-only mode in {dc_from}, ensure all mast
 def execute(dc_from, dc_to):
     """Set all core DB masters (shards: s1-s7, x1, es2-es3) in read-only mode."""
     try:
-        mysql.set_core_masters_readonly(dc_from, True)
-        mysql.verify_core_masters_readonly(dc_from, True)
-        mysql.verify_core_masters_readonly(dc_to, True)
+        mysql.set_core_masters_readonly_and_verify(dc_from, True, verify={dc_to: True})
     except mysql.MysqlError:
         raise
     except Exception as e:
@@ -1,5 +1,5 @@
 from switchdc.lib import mysql
-from switchdc.lib.remote import Remote, RemoteExecutionError
+from switchdc.lib.remote import AdaptiveBatch, Remote, RemoteExecutionError
 from switchdc.log import logger
 from switchdc.stages import get_module_config
 
@@ -11,6 +11,7 @@ config = get_module_config('t03_cache_wipe')
 def execute(dc_from, dc_to):
     """Wipes out the caches in the inactive datacenter, and then warms them up."""
     mysql.ensure_core_masters_in_sync(dc_from, dc_to)
+    mysql.stop_lag_monitor()  # Not needed anymore once in sync
 
     logger.info('Replicas in {} are now in sync'.format(dc_to))
     logger.info('Wiping out the MediaWiki caches in {dc_to}'.format(dc_to=dc_to))
@@ -18,7 +19,9 @@ def execute(dc_from, dc_to):
     to.select('R:class = role::memcached')
     to.sync('service memcached restart')
     to.select('R:class = role::mediawiki::webserver')
-    to.sync('service hhvm restart', batch_size=25)
+    # Keep at least 80% of the appservers serving while restarting, growing the batch while restarts are fast
+    to.sync('service hhvm restart', batch_size=AdaptiveBatch(
+        initial=5, max_latency=30.0, max_failure_ratio=0.05, min_pooled=0.8))
 
     logger.info('Running the global warmup job in {dc_to}'.format(dc_to=dc_to))
     warmup_dir = config.get('warmup_dir', '/var/lib/mediawiki-cache-warmup')
@@ -1,13 +1,18 @@
+import socket
+import threading
 import time
 
+from collections import defaultdict
 from multiprocessing.pool import ThreadPool
 
 import redis
 
-from switchdc.lib.remote import Remote
+from switchdc.lib.remote import Remote, wait_all
 from switchdc.log import logger
+from switchdc.lib.governor import governor
 from switchdc.lib.redis_cluster import RedisShardsBase, RedisSwitchError
 from switchdc.stages import get_module_config, get_module_config_dir
+from switchdc.timing import timed
 
 
 __title__ = 'Resync the redis for jobqueues in {dc_to} with the masters in {dc_from}'
@@ -18,25 +23,86 @@ dirname = 't06_redis'
 config = get_module_config(dirname)
 config_dir = get_module_config_dir(dirname)
 REDIS_PASSWORD = config.get('redis_password', None)
+# Restart the instances in waves instead of all at once, see RedisShards.rolling_restart()
+ROLLING_RESTART = config.get('resync_rolling_restart', False)
+# Maximum concurrent full syncs served by each host of the masters, including the BGSAVEs already in progress
+MAX_SYNCS_PER_HOST = config.get('resync_max_syncs_per_host', 2)
 
 MAX_FAILURES = 3
-SLEEP = 2
-# Will timeout in less than 5 minutes
-MAX_ATTEMPTS = 120
+CONNECTION_RETRY_SLEEP = 2  # Fixed seconds between the retries after a connection failure, regardless of the backoff
+# Polling starts fine-grained and backs off exponentially up to SLEEP_MAX seconds
+SLEEP_MIN = 0.1
+SLEEP_MAX = 5
+SLEEP_FACTOR = 1.5
+TIMEOUT = 300  # Will timeout in 5 minutes
+STALL_TIMEOUT = 30  # Seconds without any new transferred byte, after the first one, to consider a sync stalled
+PROGRESS_INTERVAL = 10  # Seconds between the reports of the aggregate progress
+
+
+class SyncProgress(object):
+    """Aggregate progress of the sync of multiple instances with their masters."""
+
+    def __init__(self):
+        """SyncProgress constructor."""
+        self._lock = threading.Lock()
+        self._status = {}  # Instance: (synced, read bytes, left bytes, throughput, ETA)
+
+    def reset(self):
+        """Discard the progress of all the instances."""
+        with self._lock:
+            self._status.clear()
+
+    def update(self, instance, synced=False, read_bytes=0, left_bytes=-1, throughput=0.0, eta=None):
+        """Update the progress of an instance.
+
+        Arguments:
+        instance   -- the instance that is syncing
+        synced     -- whether the instance is synced. [optional, default: False]
+        read_bytes -- the bytes transferred so far. [optional, default: 0]
+        left_bytes -- the bytes left to transfer, -1 if unknown. [optional, default: -1]
+        throughput -- the transfer rate in bytes per second. [optional, default: 0.0]
+        eta        -- the estimated seconds to complete the transfer, None if unknown. [optional, default: None]
+        """
+        with self._lock:
+            self._status[str(instance)] = (synced, read_bytes, left_bytes, throughput, eta)
+
+    def summary(self, total):
+        """Return a line with the aggregate progress.
+
+        Arguments:
+        total -- the total number of instances to sync
+        """
+        with self._lock:
+            status = self._status.values()
+
+        etas = [eta for synced, _, _, _, eta in status if not synced and eta is not None]
+        return ('synced {synced}/{total}, transferred {read:.1f}MB, left {left:.1f}MB, throughput {rate:.1f}MB/s, '
+                'max ETA {eta}').format(
+            synced=len([item for item in status if item[0]]), total=total,
+            read=sum(item[1] for item in status) / 1024.0 ** 2,
+            left=sum(item[2] for item in status if item[2] > 0) / 1024.0 ** 2,
+            rate=sum(item[3] for item in status if not item[0]) / 1024.0 ** 2,
+            eta='{eta:.0f}s'.format(eta=max(etas)) if etas else 'unknown')
+
+
+progress = SyncProgress()
 
 
 def wait_for_master(instance):
     failures = 0
-    attempts = 0
     success = False
-    while failures < MAX_FAILURES and attempts < MAX_ATTEMPTS:
-        attempts += 1
+    sleep = SLEEP_MIN
+    start = time.time()
+    transfer_start = None  # Timestamp and read bytes of the first sample with transferred bytes
+    last_read = None
+    last_transfer = None  # Timestamp of the last sample in which the read bytes increased
+    while failures < MAX_FAILURES and time.time() - start < TIMEOUT:
         try:
             replica = instance.client.info('replication')
         except redis.ConnectionError:
             logger.warning("Failure fetching replication info from {i}".format(i=instance))
             failures += 1
-            time.sleep(SLEEP)
+            time.sleep(CONNECTION_RETRY_SLEEP)
             continue
 
         if replica['role'] != 'slave':
@@ -45,14 +111,43 @@ def wait_for_master(instance):
             break
 
         if replica['master_link_status'] == 'up' and replica['master_sync_in_progress'] == 0:
-            logger.info("Instance {i} has synced with its master".format(i=instance))
+            logger.info("Instance {i} has synced with its master in {s:.1f}s".format(
+                i=instance, s=time.time() - start))
+            progress.update(instance, synced=True, read_bytes=last_read or 0)
             success = True
             break
+
+        if replica['master_sync_in_progress']:
+            now = time.time()
+            read_bytes = replica.get('master_sync_read_bytes', 0)
+            left_bytes = replica.get('master_sync_left_bytes', -1)  # -1 when the size is unknown (diskless)
+            # No byte is transferred while the master is still generating the RDB with BGSAVE, that can be long
+            if read_bytes > 0 and (last_read is None or read_bytes > last_read):
+                if transfer_start is None:
+                    transfer_start = (now, read_bytes)
+                last_read = read_bytes
+                last_transfer = now
+
+            throughput = 0.0
+            if transfer_start is not None and now > transfer_start[0]:
+                throughput = (read_bytes - transfer_start[1]) / (now - transfer_start[0])
+            eta = left_bytes / throughput if throughput > 0 and left_bytes >= 0 else None
+            progress.update(instance, read_bytes=read_bytes, left_bytes=left_bytes, throughput=throughput, eta=eta)
+            logger.debug('{i} - sync transferred {r} bytes, left {l} bytes, {t:.0f} bytes/s, ETA {e}'.format(
+                i=instance, r=read_bytes, l=left_bytes, t=throughput,
+                e='unknown' if eta is None else '{eta:.1f}s'.format(eta=eta)))
+
+            if (replica.get('master_sync_last_io_seconds_ago', 0) > STALL_TIMEOUT or
+                    (last_transfer is not None and now - last_transfer > STALL_TIMEOUT)):
+                logger.error("Sync of instance {i} with its master stalled at {r} bytes".format(
+                    i=instance, r=read_bytes))
+                break
         else:
             logger.debug(
                 '{i} - master link status: {s}, master_sync_in_progress: {p}'.format(
                     i=instance, s=replica['master_link_status'], p=replica['master_sync_in_progress']))
-        time.sleep(SLEEP)
+        time.sleep(sleep)
+        sleep = min(SLEEP_MAX, sleep * SLEEP_FACTOR)
     if not success:
         logger.error("Instance {i} is unreachable or waiting for master timed out".format(i=instance))
     return (instance, success)
@@ -61,24 +156,152 @@ def wait_for_master(instance):
 class RedisShards(RedisShardsBase):
     MAX_POOL_SIZE = 20
 
-    def check_parallel(self, dc):
-        instances = self.shards[dc].values()
+    def check_parallel(self, dc, instances=None):
+        if instances is None:
+            instances = self.shards[dc].values()
+        progress.reset()
+        done = threading.Event()
+        reporter = threading.Thread(target=self._report_progress, args=(done, len(instances)))
+        reporter.daemon = True
+        reporter.start()
+
         pool = ThreadPool(min(len(instances), self.MAX_POOL_SIZE))
-        results = pool.map(wait_for_master, instances)
+        try:
+            results = pool.map(wait_for_master, instances)
+        finally:
+            pool.close()
+            pool.join()
+            done.set()
+            reporter.join()
+
+        logger.info('Redis sync progress in {dc}: {summary}'.format(dc=dc, summary=progress.summary(len(instances))))
         return [str(result[0]) for result in results if not result[1]]
 
+    def rolling_restart(self, dc, dc_master):
+        """Restart the instances of a datacenter in waves sized to the spare capacity of the hosts of their masters.
 
-def execute(dc_from, dc_to):
-    """Resync the Redises for jobqueues before inverting replication"""
-    # Restart all redis instances for jobqueues
-    logger.info("Restarting all redises for jobqueues in {dc}".format(dc=dc_to))
-    remote = Remote(site=dc_to)
+        Each wave is waited to be in sync before starting the next one. Return the list of instances not in sync.
+
+        Arguments:
+        dc        -- the name of the datacenter of the instances to restart
+        dc_master -- the name of the datacenter of their masters
+        """
+        pending = sorted(self.shards[dc].items())
+        hosts = get_redis_hosts(dc)
+        failed = []
+        waves = 0
+        while pending:
+            wave = self._next_wave(pending, dc_master)
+            waves += 1
+            instances = [instance for _, instance in wave]
+            logger.info('Restarting wave {n} of {num} redis instances in {dc}: {instances}'.format(
+                n=waves, num=len(instances), dc=dc, instances=', '.join(str(instance) for instance in instances)))
+            restart_instances(dc, instances, hosts)
+            failed += self.check_parallel(dc, instances=instances)
+            pending = [item for item in pending if item not in wave]
+
+        logger.info('Restarted {num} redis instances in {dc} in {waves} waves'.format(
+            num=len(self.shards[dc]), dc=dc, waves=waves))
+        return failed
+
+    def _next_wave(self, pending, dc_master):
+        """Return the list of (shard, instance) to restart in the next wave, at least one.
+
+        Arguments:
+        pending   -- the list of (shard, instance) still to restart
+        dc_master -- the name of the datacenter of their masters
+        """
+        busy = defaultdict(int)  # Host: number of BGSAVEs in progress
+
+        def count_bgsave(shard, master):
+            with governor.acquire('redis'), timed('redis.info'):
+                if master.client.info('persistence')['rdb_bgsave_in_progress']:
+                    busy[master.host] += 1
+
+        for shard, error in self.map(count_bgsave, dc_master).iteritems():
+            logger.warning('Unable to check the BGSAVE of shard {shard}: {e!r}'.format(shard=shard, e=error))
+
+        slots = {}
+        wave = []
+        for shard, instance in pending:
+            host = self.shards[dc_master][shard].host
+            if host not in slots:
+                slots[host] = max(0, MAX_SYNCS_PER_HOST - busy[host])
+            if slots[host] > 0:
+                slots[host] -= 1
+                wave.append((shard, instance))
+
+        return wave or pending[:1]
+
+    @staticmethod
+    def _report_progress(done, total):
+        """Log the aggregate progress every PROGRESS_INTERVAL seconds until done is set.
+
+        Arguments:
+        done  -- the threading.Event that signals the completion
+        total -- the total number of instances to sync
+        """
+        while not done.wait(PROGRESS_INTERVAL):
+            logger.info('Redis sync progress: {summary}'.format(summary=progress.summary(total)))
+
+
+def get_redis_hosts(dc):
+    """Return a dictionary of IP address: FQDN of the jobqueue redis hosts of a datacenter.
+
+    Arguments:
+    dc -- the name of the datacenter
+    """
+    remote = Remote(site=dc)
     remote.select('R:class = role::jobqueue_redis::master')
-    remote.sync('systemctl restart redis-instance-*')
+    hosts = {}
+    for host in remote.hosts:
+        with governor.acquire('dns'), timed('dns.query'):
+            hosts[socket.gethostbyname(host)] = host
+
+    return hosts
 
-    # Verify
+
+def restart_instances(dc, instances, hosts):
+    """Restart the given redis instances, concurrently on each host.
+
+    Arguments:
+    dc        -- the name of the datacenter of the instances
+    instances -- the list of RedisInstance to restart
+    hosts     -- the dictionary of IP address: FQDN of the redis hosts, see get_redis_hosts()
+    """
+    units = defaultdict(list)
+    for instance in instances:
+        if instance.host not in hosts:
+            logger.error('Unable to find the jobqueue redis host in {dc} of instance {i}'.format(dc=dc, i=instance))
+            raise RedisSwitchError(1)
+        units[hosts[instance.host]].append('redis-instance-tcp_{port}'.format(port=instance.port))
+
+    runs = []
+    for host, host_units in units.iteritems():
+        remote = Remote(site=dc)
+        remote.select({host})
+        runs.append(remote.submit('systemctl restart {units}'.format(units=' '.join(sorted(host_units)))))
+
+    wait_all(runs)
+
+
+def execute(dc_from, dc_to):
+    """Resync the Redises for jobqueues before inverting replication"""
+    start = time.time()
     servers = RedisShards('jobqueue', config_dir, REDIS_PASSWORD)
-    failed = servers.check_parallel(dc_to)
+    if ROLLING_RESTART:
+        failed = servers.rolling_restart(dc_to, dc_from)
+    else:
+        # Restart all redis instances for jobqueues
+        logger.info("Restarting all redises for jobqueues in {dc}".format(dc=dc_to))
+        remote = Remote(site=dc_to)
+        remote.select('R:class = role::jobqueue_redis::master')
+        remote.sync('systemctl restart redis-instance-*')
+
+        # Verify
+        failed = servers.check_parallel(dc_to)
+
+    logger.info('Redises for jobqueues in {dc} resynced in {s:.1f}s'.format(dc=dc_to, s=time.time() - start))
     if failed:
-        logger.error("The following instances are still not in sync: {i}".format(', '.join(failed)))
+        logger.error("The following instances are still not in sync: {i}".format(i=', '.join(failed)))
         raise RedisSwitchError(1)
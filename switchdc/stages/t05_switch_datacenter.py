@@ -39,6 +39,8 @@ def execute(dc_from, dc_to):
 
     # 4: verify that the IP of the records matches the expected one
     dns = Discovery('appservers-rw', 'api-rw', 'imagescaler-rw')
-    dns.check_record('appservers-rw', 'appservers.svc.{dc_to}.wmnet'.format(dc_to=dc_to))
-    dns.check_record('api-rw', 'api.svc.{dc_to}.wmnet'.format(dc_to=dc_to))
-    dns.check_record('imagescaler-rw', 'rendering.svc.{dc_to}.wmnet'.format(dc_to=dc_to))
+    dns.check_records({
+        'appservers-rw': 'appservers.svc.{dc_to}.wmnet'.format(dc_to=dc_to),
+        'api-rw': 'api.svc.{dc_to}.wmnet'.format(dc_to=dc_to),
+        'imagescaler-rw': 'rendering.svc.{dc_to}.wmnet'.format(dc_to=dc_to),
+    })
@@ -1,11 +1,12 @@
-import re
-
 from switchdc import ask_confirmation, get_reason
-from switchdc.lib.remote import Remote
+from switchdc.lib.remote import OutputCollector, Remote
 from switchdc.log import logger
 
 __title__ = 'Switch traffic flow to the appservers from {dc_from} to {dc_to}'
 
+BACKENDS = ('api', 'appservers', 'rendering')
+PUPPET_TIMEOUT = 900  # Maximum seconds of a puppet run on a single host
+
 
 def execute(dc_from, dc_to):
     """Switch traffic from active in dc_from to active in dc_to, cycling through an active-active status."""
@@ -17,45 +18,62 @@ def execute(dc_from, dc_to):
     # cp1008.wikimedia.org which is a special system used for testing.
     dc_query = ('R:class = profile::cumin::target and R:class%site = {site} and R:class%cluster = cache_text and '
                 'not *.wikimedia.org')
-    to_servers = Remote.query(dc_query.format(site=dc_to))
-    from_servers = Remote.query(dc_query.format(site=dc_from))
+    to_servers, from_servers = Remote.query_many(dc_query.format(site=dc_to), dc_query.format(site=dc_from))
 
     remote.select(to_servers)
     logger.info('Running puppet on text caches in {dc_to}'.format(dc_to=dc_to))
-    remote.sync('run-puppet-agent --enable "{message}"'.format(message=get_reason()))
-    verify_changes(remote.worker, expected_dc_to, dc_from, dc_to)
+    run_puppet(remote, expected_dc_to, dc_from, dc_to)
 
     logger.info('Text caches traffic is now active-active, running puppet in {dc_from}'.format(dc_from=dc_from))
 
     remote.select(from_servers)
-    remote.sync('run-puppet-agent --enable "{message}"'.format(message=get_reason()))
-    verify_changes(remote.worker, expected_dc_from, dc_from, dc_to)
+    run_puppet(remote, expected_dc_from, dc_from, dc_to)
 
     logger.info('Text caches traffic is now active only in {dc_to}'.format(dc_to=dc_to))
 
 
-def verify_changes(worker, expected, dc_from, dc_to):
-    """Verify that the command output contains the given messages. Fallback to manual confirmation on failure.
+def run_puppet(remote, expected, dc_from, dc_to):
+    """Run puppet on the selected hosts and verify the changes. Fallback to manual confirmation on failure.
+
+    The full puppet outputs are saved to disk, only the lines matching the expected messages are kept in memory.
 
     Arguments:
-    worker   -- a Cumin's worker to check the results from
+    remote   -- the Remote instance with the selected hosts
     expected -- the expected message pattern, that will be expanded for the list of backends and in which dc_from and
                 dc_to will be replaced by their values.
     dc_from  -- the name of the datacenter to switch from
     dc_to    -- the name of the datacenter to switch to
     """
-    backends = ('api', 'appservers', 'rendering')
-    failed = False
-
-    for nodeset, output in worker.get_results():
-        for backend in backends:
-            expected_message = expected.format(backend=backend, dc_from=dc_from, dc_to=dc_to)
-            if re.search(expected_message, output.message()) is None:
-                failed = True
-                logger.error("Unable to verify that message '{msg}' is in the output of nodeset '{nodeset}'".format(
-                    msg=expected_message, nodeset=nodeset))
+    messages = [expected.format(backend=backend, dc_from=dc_from, dc_to=dc_to) for backend in BACKENDS]
+    output = OutputCollector(patterns=messages)
+    failed = []
+    remote.sync('run-puppet-agent --enable "{message}"'.format(message=get_reason()), host_timeout=PUPPET_TIMEOUT,
+                output=output, on_result=get_changes_verifier(messages, output, failed))
 
     if failed:
+        logger.error('Full puppet outputs saved in {path}'.format(path=output.path))
         ask_confirmation('Please manually verify that the puppet run was applied with the expected changes')
     else:
         logger.info("Expected message '{expected}' found on all hosts for all backends".format(expected=expected))
+
+
+def get_changes_verifier(messages, output, failed):
+    """Return a Remote on_result callback that verifies that each host output contains the given messages.
+
+    Each host is verified as soon as its puppet run completes, while the other hosts are still running.
+
+    Arguments:
+    messages -- the list of expected message patterns, as passed to the OutputCollector
+    output   -- the OutputCollector instance of the execution
+    failed   -- a list to which the hosts that failed the verification are appended, once each
+    """
+    def verifier(host, rc, tail):
+        missing = [message for message in messages if not output.get(host).matched(message)]
+        for message in missing:
+            logger.error("Unable to verify that message '{msg}' is in the output of host '{host}'".format(
+                msg=message, host=host))
+
+        if missing:
+            failed.append(host)
+
+    return verifier
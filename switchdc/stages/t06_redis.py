@@ -1,3 +1,5 @@
+from multiprocessing.pool import ThreadPool
+
 from switchdc import SwitchdcError
 from switchdc.log import logger
 from switchdc.lib.redis_cluster import RedisShardsBase, RedisSwitchError
@@ -10,70 +12,156 @@ config = get_module_config(dirname)
 config_dir = get_module_config_dir(dirname)
 
 REDIS_PASSWORD = config.get('redis_password', None)
+CLUSTERS = ('jobqueue', 'sessions')
 
 
 class RedisShards(RedisShardsBase):
 
     def stop_replica(self, dc):
-        for instance in self.shards[dc].values():
-            if instance.is_master:
-                logger.debug("Instance %s is already master, doing nothing", instance)
-                continue
-            try:
-                logger.debug("Stopping replica on {instance}".format(instance=instance))
-                if not self.dry_run:
-                    instance.stop_replica()
-            except Exception as e:
-                logger.exception("Generic failure while stopping replica on %s: %s", instance, e)
-                raise
-
-            if not instance.is_master and not self.dry_run:
-                logger.exception("Instance %s is still a slave of %s, aborting", instance, instance.slave_of)
-                raise RedisSwitchError(1)
+        self.refresh(dc)
+        self._check_failures(self.map(self._stop_instance_replica, dc), 1)
 
     def start_replica(self, dc, dc_master):
-        for shard, instance in self.shards[dc].items():
-            master = self.shards[dc_master][shard]
-            if instance.slave_of == str(master):
-                logger.debug('Replica already configured on {instance}'.format(instance=instance))
-            else:
-                logger.debug('Starting replica {master} => {local}'.format(master=master, local=instance))
-                if not self.dry_run:
-                    instance.start_replica(master)
+        self.refresh(dc)
+        self._check_failures(self.map(
+            lambda shard, instance: self._start_instance_replica(instance, self.shards[dc_master][shard]), dc), 2)
+
+    def verify_parity(self, dc_master, dc_replica, strict=True):
+        """Ensure that all the replicas in dc_replica have reached the replication offset of their masters.
+
+        Arguments:
+        dc_master  -- the name of the datacenter of the masters
+        dc_replica -- the name of the datacenter of the replicas
+        strict     -- whether to abort if any replica is not in sync, or just warn. [optional, default: True]
+        """
+        results = self.check_parity(dc_master, dc_replica)
+        for shard, result in sorted(results.iteritems()):
+            if result.converged is None:
+                logger.warning('Replica of shard {shard} in {dc}, cluster {cluster} is not replicating from '
+                               '{master}'.format(shard=shard, dc=dc_replica, cluster=self.cluster,
+                                                 master=self.shards[dc_master][shard]))
+            elif result.converged:
+                logger.debug('Replica of shard {shard} in {dc}, cluster {cluster} in sync in {s:.3f}s, '
+                             'keys delta {keys}'.format(shard=shard, dc=dc_replica, cluster=self.cluster,
+                                                        s=result.elapsed, keys=result.keys_delta))
+
+        failed = sorted(shard for shard, result in results.iteritems() if result.converged is False)
+        if failed:
+            log = logger.error if strict else logger.warning
+            log('Replicas in {dc}, cluster {cluster} not in sync: {shards}'.format(
+                dc=dc_replica, cluster=self.cluster, shards=', '.join(
+                    '{shard} ({state}, offset delta {offset}, keys delta {keys})'.format(
+                        shard=shard, state='still syncing' if results[shard].syncing else 'lagging',
+                        offset=results[shard].offset_delta, keys=results[shard].keys_delta)
+                    for shard in failed)))
+            if strict and not self.dry_run:
+                raise RedisSwitchError(3)
+
+    def _stop_instance_replica(self, shard, instance):
+        if instance.is_master:
+            logger.debug("Instance %s is already master, doing nothing", instance)
+            return
+        try:
+            logger.debug("Stopping replica on {instance}".format(instance=instance))
+            if not self.dry_run:
+                instance.stop_replica()
+        except Exception as e:
+            logger.exception("Generic failure while stopping replica on %s: %s", instance, e)
+            raise
+
+        if not instance.is_master and not self.dry_run:
+            logger.error("Instance %s is still a slave of %s, aborting", instance, instance.slave_of)
+            raise RedisSwitchError(1)
+
+    def _start_instance_replica(self, instance, master):
+        if instance.slave_of == str(master):
+            logger.debug('Replica already configured on {instance}'.format(instance=instance))
+        else:
+            logger.debug('Starting replica {master} => {local}'.format(master=master, local=instance))
+            if not self.dry_run:
+                instance.start_replica(master)
+
+        if instance.slave_of != str(master) and not self.dry_run:
+            logger.error("Replica on %s is not correctly configured", instance)
+            raise RedisSwitchError(2)
+
+    def _check_failures(self, failures, code):
+        """Report all the failed shards, re-raise the first generic error if any or raise RedisSwitchError(code).
+
+        Arguments:
+        failures -- a dictionary of shard: exception as returned by map()
+        code     -- the RedisSwitchError code to raise if there are only Redis failures
+        """
+        if not failures:
+            return
+
+        logger.error('Failed shards for cluster {cluster}: {shards}'.format(
+            cluster=self.cluster, shards=', '.join(sorted(failures))))
+        for error in failures.values():
+            if not isinstance(error, RedisSwitchError):
+                raise error
+
+        raise RedisSwitchError(code)
 
-            if instance.slave_of != str(master) and not self.dry_run:
-                logger.error("Replica on %s is not correctly configured", instance)
-                raise RedisSwitchError(2)
+
+def run_parallel(func, servers, code):
+    """Call func(servers) concurrently for each cluster, raise after all are completed if any failed.
+
+    Arguments:
+    func    -- the callable to call for each RedisShards instance
+    servers -- the list of RedisShards instances
+    code    -- the SwitchdcError code to raise for generic failures
+    """
+    def call(shards):
+        try:
+            func(shards)
+        except Exception as e:
+            return e
+
+    pool = ThreadPool(len(servers))
+    try:
+        errors = pool.map(call, servers)
+    finally:
+        pool.close()
+        pool.join()
+
+    failed = [(shards, error) for shards, error in zip(servers, errors) if error is not None]
+    for shards, error in failed:
+        if not isinstance(error, RedisSwitchError):
+            logger.error('Generic failure for cluster {cluster}: {e!r}'.format(cluster=shards.cluster, e=error))
+
+    for _, error in failed:
+        if isinstance(error, RedisSwitchError):
+            raise error
+
+    if failed:
+        raise SwitchdcError(code)
 
 
 def execute(dc_from, dc_to):
-    """Switches the replication for both redis clusters for mediawiki (jobqueue and sessions)."""
-    for cluster in ('jobqueue', 'sessions'):
+    """Switches the replication for both redis clusters for mediawiki (jobqueue and sessions) concurrently."""
+    servers = []
+    for cluster in CLUSTERS:
         try:
-            servers = RedisShards(cluster, config_dir, REDIS_PASSWORD)
+            servers.append(RedisShards(cluster, config_dir, REDIS_PASSWORD))
         except Exception, e:
             logger.error("Failed loading redis data: %s", e, exc_info=True)
             raise SwitchdcError(1)
 
-        # Now let's disable replication
-        logger.info('Stopping replication for all instances in {dc}, cluster {cluster}'.format(
-            dc=dc_to, cluster=cluster))
-        try:
-            servers.stop_replica(dc_to)
-        except RedisSwitchError:
-            raise
-        except Exception as e:
-            logger.exception('Failed to stop replication for all instances in %s, cluster %s: %s',
-                             dc_to, cluster, e.message)
-            raise SwitchdcError(3)
+    logger.info('Checking the replication parity of all instances in {dc}, clusters {clusters}'.format(
+        dc=dc_to, clusters=', '.join(CLUSTERS)))
+    run_parallel(lambda shards: shards.verify_parity(dc_from, dc_to), servers, 5)
 
-        logger.info('Starting replication for all instances in {dc}, cluster {cluster}'.format(
-            dc=dc_from, cluster=cluster))
-        try:
-            servers.start_replica(dc_from, dc_to)
-        except RedisSwitchError:
-            raise
-        except Exception:
-            logger.exception('Failed to start replication for all instances in %s, cluster %s',
-                             dc_to, cluster, e.message)
-            raise SwitchdcError(4)
+    # Now let's disable replication
+    logger.info('Stopping replication for all instances in {dc}, clusters {clusters}'.format(
+        dc=dc_to, clusters=', '.join(CLUSTERS)))
+    run_parallel(lambda shards: shards.stop_replica(dc_to), servers, 3)
+
+    logger.info('Starting replication for all instances in {dc}, clusters {clusters}'.format(
+        dc=dc_from, clusters=', '.join(CLUSTERS)))
+    run_parallel(lambda shards: shards.start_replica(dc_from, dc_to), servers, 4)
+
+    logger.info('Checking the replication parity of all instances in {dc}, clusters {clusters}'.format(
+        dc=dc_from, clusters=', '.join(CLUSTERS)))
+    # The inverted replicas may still be performing a full synchronization: just warn, as there's nothing to roll back
+    run_parallel(lambda shards: shards.verify_parity(dc_to, dc_from, strict=False), servers, 6)
@@ -8,9 +8,7 @@ __title__ = 'Set core DB masters in read-write mode in {dc_to}, ensure masters i
 def execute(dc_from, dc_to):
     """Set all core DB masters (shards: s1-s7, x1, es2-es3) in read-write mode."""
     try:
-        mysql.set_core_masters_readonly(dc_to, False)
-        mysql.verify_core_masters_readonly(dc_to, False)
-        mysql.verify_core_masters_readonly(dc_from, True)
+        mysql.set_core_masters_readonly_and_verify(dc_to, False, verify={dc_from: True})
     except SwitchdcError:
         raise
     except Exception as e:
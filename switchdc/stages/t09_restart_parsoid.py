@@ -1,12 +1,16 @@
-from switchdc.lib.remote import Remote
+from switchdc.lib.remote import AdaptiveBatch, Remote, wait_all
 
 __title__ = 'Rolling restart of parsoid in {dc_from} and {dc_to}'
 
 
 def execute(dc_from, dc_to):
-    from_servers = Remote(site=dc_from)
-    from_servers.select('R:class = role::parsoid')
-    from_servers.sync('restart-parsoid', batch_size=1, batch_sleep=15.0)
-    to_servers = Remote(site=dc_to)
-    to_servers.select('R:class = role::parsoid')
-    to_servers.sync('restart-parsoid', batch_size=1, batch_sleep=15.0)
+    runs = []
+    for dc in (dc_from, dc_to):
+        servers = Remote(site=dc)
+        servers.select('R:class = role::parsoid')
+        # The rolling restarts of the two datacenters are independent, run them in parallel. Keep it slow: at most two
+        # hosts at a time, each one started 15s after the previous one.
+        batch = AdaptiveBatch(initial=1, max_latency=30.0, min_pooled=0.9, max_batch=2)
+        runs.append(servers.submit('restart-parsoid', batch_size=batch, batch_sleep=15.0))
+
+    wait_all(runs)
@@ -1,5 +1,3 @@
-import time
-
 from switchdc.lib.dnsdisc import Discovery
 from switchdc.lib.remote import Remote
 
@@ -10,8 +8,7 @@ def execute(dc_from, dc_to):
     """Restore the original TTL of all the MediaWiki read-write discovery records and cleanup confd stale files."""
     ttl = Discovery('appservers-rw', 'api-rw', 'imagescaler-rw')
     ttl.update_ttl(300)
-    # Verify
-    time.sleep(5)
+    # Verify, waiting for all the authdns servers to converge
     ttl.check_ttl(300)
 
     remote = Remote()
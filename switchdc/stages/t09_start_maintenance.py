@@ -1,6 +1,6 @@
 from switchdc import get_reason
 from switchdc.lib import mediawiki
-from switchdc.lib.remote import Remote
+from switchdc.lib.remote import AdaptiveBatch, Remote
 
 __title__ = 'Start MediaWiki jobrunners, videoscalers and maintenance in {dc_to}'
 
@@ -11,7 +11,8 @@ def execute(dc_from, dc_to):
     remote = Remote()
     remote.select('R:class = profile::mediawiki::jobrunner or R:class = role::mediawiki_maintenance')
     command = 'run-puppet-agent --enable "{message}"'.format(message=get_reason())
-    remote.async(command, batch_size=30)
+    # Puppet runs don't affect the pooled capacity, the batch is limited only by the run latency
+    remote.async(command, batch_size=AdaptiveBatch(initial=10, max_latency=180.0, min_pooled=0.0))
 
     # Clear systemctl state in dc_from (jessie only)
     remote = Remote(site=dc_from)
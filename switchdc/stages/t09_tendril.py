@@ -12,8 +12,9 @@ def execute(dc_from, dc_to):
     tendril.select('R:Class = Role::Mariadb::Tendril')
 
     commands = []
+    remotes = mysql.get_db_remotes(dc_to, mysql.CORE_SHARDS, group='core', role='master')
     for shard in mysql.CORE_SHARDS:
-        remote = mysql.get_db_remote(dc_to, group='core', role='master', shard=shard)
+        remote = remotes[shard]
         if len(remote.hosts) > 1:
             logger.error('Expected to find only one host for core DB of shard {shard} in {dc}'.format(
                          shard=shard, dc=dc_to))
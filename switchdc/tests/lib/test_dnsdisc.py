@@ -0,0 +1,120 @@
+import unittest
+
+import dns.resolver
+import mock
+
+from switchdc import SwitchdcError
+from switchdc.lib.dnsdisc import Discovery
+
+
+class TestDiscoveryResolvers(unittest.TestCase):
+
+    def setUp(self):
+        Discovery._resolvers = None
+        self.addCleanup(setattr, Discovery, '_resolvers', None)
+        patcher = mock.patch('switchdc.lib.dnsdisc.Confctl')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('switchdc.lib.dnsdisc.dns.resolver.query')
+    @mock.patch('switchdc.lib.dnsdisc.Remote.query')
+    def test_resolvers_cached(self, mocked_query, mocked_resolve):
+        mocked_query.return_value = {'ns0.example.org', 'ns1.example.org'}
+        mocked_resolve.side_effect = lambda name: [mock.Mock(address=name.replace('.example.org', '-address'))]
+
+        first = Discovery('appservers-rw')
+        second = Discovery('api-rw')
+        self.assertIs(first.resolvers, second.resolvers)
+        self.assertListEqual(sorted(first.resolvers.keys()), ['ns0.example.org', 'ns1.example.org'])
+        self.assertListEqual(first.resolvers['ns1.example.org'].nameservers, ['ns1-address'])
+        self.assertEqual(mocked_query.call_count, 1)
+        self.assertEqual(mocked_resolve.call_count, 2)
+
+    @mock.patch('switchdc.lib.dnsdisc.dns.resolver.query')
+    @mock.patch('switchdc.lib.dnsdisc.Remote.query')
+    def test_refresh(self, mocked_query, mocked_resolve):
+        mocked_query.return_value = {'ns0.example.org'}
+        mocked_resolve.return_value = [mock.Mock(address='10.0.0.1')]
+        discovery = Discovery('appservers-rw')
+        resolvers = discovery.resolvers
+
+        mocked_query.return_value = {'ns0.example.org', 'ns1.example.org'}
+        Discovery.refresh()
+        self.assertIsNot(discovery.resolvers, resolvers)
+        self.assertEqual(len(discovery.resolvers), 2)
+
+
+class FakeResolver(object):
+
+    def __init__(self, addresses, ttl=10):
+        self.addresses = addresses
+        self.ttl = ttl
+        self.stale_ttls = []  # TTLs returned by the first queries, before the new one has propagated
+        self.lifetimes = []
+
+    def query(self, name, lifetime=None):
+        self.lifetimes.append(lifetime)
+        if name not in self.addresses:
+            raise dns.resolver.NXDOMAIN()
+
+        answer = mock.MagicMock(ttl=self.stale_ttls.pop(0) if self.stale_ttls else self.ttl)
+        answer.__iter__.return_value = [mock.Mock(address=self.addresses[name])]
+        return answer
+
+
+class TestDiscoveryQueries(unittest.TestCase):
+
+    def setUp(self):
+        self.addresses = {'appservers-rw.discovery.wmnet': '10.2.1.1', 'api-rw.discovery.wmnet': '10.2.1.22',
+                          'appservers.svc.codfw.wmnet': '10.2.1.1', 'api.svc.codfw.wmnet': '10.2.1.22'}
+        Discovery._resolvers = {'ns0': FakeResolver(self.addresses), 'ns1': FakeResolver(dict(self.addresses))}
+        self.addCleanup(setattr, Discovery, '_resolvers', None)
+        patcher = mock.patch('switchdc.lib.dnsdisc.Confctl')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.discovery = Discovery('appservers-rw', 'api-rw')
+
+    def test_resolve_matrix(self):
+        Discovery._resolvers['ns1'].addresses.pop('api-rw.discovery.wmnet')
+        matrix = self.discovery.resolve_matrix(timeout=1)
+
+        self.assertListEqual(sorted(matrix.keys()), [('ns0', 'api-rw'), ('ns0', 'appservers-rw'),
+                                                     ('ns1', 'api-rw'), ('ns1', 'appservers-rw')])
+        answer = matrix[('ns0', 'appservers-rw')]
+        self.assertEqual(answer[:4], ('ns0', 'appservers-rw', ['10.2.1.1'], 10))
+        self.assertIsNone(answer.error)
+        self.assertEqual(matrix[('ns1', 'api-rw')].error, 'NXDOMAIN')
+        self.assertListEqual(Discovery._resolvers['ns0'].lifetimes, [1, 1])
+
+    def test_check_ttl(self):
+        self.discovery.check_ttl(10)
+        with self.assertRaisesRegexp(SwitchdcError, '1'):
+            self.discovery.check_ttl(300, timeout=0.5)
+
+    def test_check_records(self):
+        self.discovery.check_records({'appservers-rw': 'appservers.svc.codfw.wmnet', 'api-rw': 'api.svc.codfw.wmnet'})
+
+    def test_check_records_mismatch(self):
+        Discovery._resolvers['ns1'].addresses['api-rw.discovery.wmnet'] = '10.64.0.1'
+        with self.assertRaisesRegexp(SwitchdcError, '1'):
+            self.discovery.check_records({'appservers-rw': 'appservers.svc.codfw.wmnet',
+                                          'api-rw': 'api.svc.codfw.wmnet'}, timeout=0.5)
+        self.assertGreater(len(Discovery._resolvers['ns1'].lifetimes), 4)
+
+    def test_wait_for_convergence(self):
+        resolver = Discovery._resolvers['ns1']
+        resolver.stale_ttls = [300, 300]
+
+        converged = self.discovery.wait_for_convergence(lambda answer: None if answer.ttl == 10 else 'mismatch')
+        self.assertListEqual(sorted(converged.keys()), ['ns0', 'ns1'])
+        self.assertGreaterEqual(converged['ns1'] - converged['ns0'], 0.2)
+        # Only the nameserver not yet converged is queried again
+        self.assertEqual(len(Discovery._resolvers['ns0'].lifetimes), 2)
+        self.assertEqual(len(resolver.lifetimes), 4)
+
+    @mock.patch('switchdc.lib.dnsdisc.is_dry_run')
+    def test_wait_for_convergence_dry_run(self, mocked_dry_run):
+        mocked_dry_run.return_value = True
+        converged = self.discovery.wait_for_convergence(lambda answer: 'mismatch')
+        self.assertDictEqual(converged, {})
+        self.assertEqual(len(Discovery._resolvers['ns0'].lifetimes), 2)
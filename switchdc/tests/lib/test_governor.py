@@ -0,0 +1,48 @@
+import threading
+import unittest
+
+from switchdc.lib.governor import Governor
+from switchdc.timing import timings
+
+
+class TestGovernor(unittest.TestCase):
+
+    def setUp(self):
+        self.governor = Governor({'hosts': 10, 'puppetdb': 1})
+        timings.reset()
+
+    def test_acquire(self):
+        with self.governor.acquire('hosts', 4):
+            self.assertEqual(self.governor.in_use('hosts'), 4)
+            with self.governor.acquire('hosts', 6):
+                self.assertEqual(self.governor.in_use('hosts'), 10)
+        self.assertEqual(self.governor.in_use('hosts'), 0)
+
+    def test_acquire_capped(self):
+        with self.governor.acquire('hosts', 50):
+            self.assertEqual(self.governor.in_use('hosts'), 10)
+
+    def test_unlimited(self):
+        with self.governor.acquire('other', 1000):
+            self.assertEqual(self.governor.in_use('other'), 0)
+
+    def test_wait(self):
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def hold():
+            with self.governor.acquire('puppetdb'):
+                acquired.set()
+                release.wait(5)
+
+        thread = threading.Thread(target=hold)
+        thread.start()
+        acquired.wait(5)
+        threading.Timer(0.1, release.set).start()
+        with self.governor.acquire('puppetdb'):
+            self.assertEqual(self.governor.in_use('puppetdb'), 1)
+        thread.join()
+
+        waits = timings.durations('governor.puppetdb')
+        self.assertEqual(len(waits), 2)
+        self.assertGreaterEqual(max(waits), 0.05)
@@ -0,0 +1,303 @@
+import time
+import unittest
+
+import mock
+
+from switchdc.lib import mysql
+from switchdc.lib.remote import RemoteExecutionError
+from switchdc.tests import base_config_dir, DockerManager
+
+
+class StubRun(object):
+
+    def __init__(self, host, rc, output, on_result=None):
+        self.hosts = [host]
+        if on_result is not None:
+            on_result(host, rc, output)
+
+    def wait(self):
+        return 0
+
+
+def get_remotes(hosts):
+    remotes = {}
+    for shard, host in hosts.iteritems():
+        remotes[shard] = mock.Mock(hosts=[host])
+
+    return remotes
+
+
+class TestEnsureCoreMastersInSync(unittest.TestCase):
+
+    def setUp(self):
+        self.remotes_to = get_remotes({shard: 'db-to-' + shard for shard in mysql.CORE_SHARDS})
+        self.gtids = {shard: '0-1-{i}'.format(i=i) for i, shard in enumerate(mysql.CORE_SHARDS)}
+        self.lags = {shard: 1.0 for shard in mysql.CORE_SHARDS}
+
+    def set_outputs(self, outputs):
+        for shard, remote in self.remotes_to.iteritems():
+            remote.submit.side_effect = self.get_submit(remote.hosts[0], outputs[shard])
+
+    @staticmethod
+    def get_submit(host, output):
+        return lambda *args, **kwargs: StubRun(host, 0, output, on_result=kwargs['on_result'])
+
+    def test_get_gtid_wait_timeout(self):
+        self.assertEqual(mysql.get_gtid_wait_timeout(None), mysql.GTID_WAIT_DEFAULT_TIMEOUT)
+        self.assertEqual(mysql.get_gtid_wait_timeout(0), mysql.GTID_WAIT_MIN_TIMEOUT)
+        self.assertEqual(mysql.get_gtid_wait_timeout(-3.0), mysql.GTID_WAIT_MIN_TIMEOUT)
+        self.assertEqual(mysql.get_gtid_wait_timeout(2.1), mysql.GTID_WAIT_MIN_TIMEOUT + 7)
+        self.assertEqual(mysql.get_gtid_wait_timeout(3600), mysql.GTID_WAIT_MAX_TIMEOUT)
+
+    @mock.patch('switchdc.lib.mysql.get_core_masters_positions')
+    @mock.patch('switchdc.lib.mysql.get_db_remotes')
+    def test_in_sync(self, mocked_remotes, mocked_positions):
+        mocked_remotes.side_effect = [{}, self.remotes_to]
+        mocked_positions.return_value = (self.gtids, self.lags)
+        self.set_outputs({shard: '0\n' for shard in mysql.CORE_SHARDS})
+
+        durations = mysql.ensure_core_masters_in_sync('dc1', 'dc2')
+        self.assertListEqual(sorted(durations.keys()), sorted(mysql.CORE_SHARDS))
+        args, kwargs = self.remotes_to['s1'].submit.call_args
+        self.assertIn("MASTER_GTID_WAIT('0-1-0', 8)", args[0])
+        self.assertTrue(kwargs['is_safe'])
+
+    @mock.patch('switchdc.lib.mysql.get_core_masters_positions')
+    @mock.patch('switchdc.lib.mysql.get_db_remotes')
+    def test_not_in_sync(self, mocked_remotes, mocked_positions):
+        mocked_remotes.side_effect = [{}, self.remotes_to]
+        mocked_positions.return_value = (self.gtids, self.lags)
+        outputs = {shard: '0' for shard in mysql.CORE_SHARDS}
+        outputs['s4'] = '-1'
+        self.set_outputs(outputs)
+
+        with self.assertRaisesRegexp(mysql.MysqlError, '2'):
+            mysql.ensure_core_masters_in_sync('dc1', 'dc2')
+        # All the shards are waited for anyway
+        for remote in self.remotes_to.itervalues():
+            self.assertTrue(remote.submit.called)
+
+    def test_get_single_hosts_multiple_masters(self):
+        remotes = {'s1': mock.Mock(hosts=['db1', 'db2'])}
+        with self.assertRaisesRegexp(mysql.MysqlError, '1'):
+            mysql._get_single_hosts(remotes)
+
+
+class TestSetCoreMastersReadonlyAndVerify(unittest.TestCase):
+
+    def setUp(self):
+        self.remotes = {'dc1': mock.Mock(hosts=['db1001', 'db1002']), 'dc2': mock.Mock(hosts=['db2001'])}
+        self.outputs = {'db1001': '1', 'db1002': '1', 'db2001': '1'}
+
+    def get_remote(self, dc, **kwargs):
+        remote = self.remotes[dc]
+        remote.submit.side_effect = lambda *args, **kwargs: self.submit(remote.hosts, kwargs['on_result'])
+        return remote
+
+    def submit(self, hosts, on_result):
+        for host in hosts:
+            on_result(host, 0, self.outputs[host])
+
+        run = mock.Mock(hosts=hosts)
+        run.wait.return_value = 0
+        return run
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=False)
+    @mock.patch('switchdc.lib.mysql.get_db_remote')
+    def test_set_and_verify(self, mocked_remote, mocked_dry_run):
+        mocked_remote.side_effect = self.get_remote
+        results = mysql.set_core_masters_readonly_and_verify('dc1', True, verify={'dc2': True})
+
+        self.assertListEqual(sorted(results), [mysql.ReadOnlyResult('db1001', 'dc1', True, True, 0),
+                                               mysql.ReadOnlyResult('db1002', 'dc1', True, True, 0),
+                                               mysql.ReadOnlyResult('db2001', 'dc2', True, True, 0)])
+        args, kwargs = self.remotes['dc1'].submit.call_args
+        self.assertIn('SET GLOBAL read_only=1; SELECT @@global.read_only', args[0])
+        self.assertFalse(kwargs['is_safe'])
+        args, kwargs = self.remotes['dc2'].submit.call_args
+        self.assertNotIn('SET GLOBAL', args[0])
+        self.assertTrue(kwargs['is_safe'])
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=False)
+    @mock.patch('switchdc.lib.mysql.get_db_remote')
+    def test_set_and_verify_mismatch(self, mocked_remote, mocked_dry_run):
+        mocked_remote.side_effect = self.get_remote
+        self.outputs['db2001'] = '0'
+        with self.assertRaisesRegexp(mysql.MysqlError, '1'):
+            mysql.set_core_masters_readonly_and_verify('dc1', True, verify={'dc2': True})
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=True)
+    @mock.patch('switchdc.lib.mysql.get_db_remote')
+    def test_set_and_verify_dry_run(self, mocked_remote, mocked_dry_run):
+        mocked_remote.side_effect = self.get_remote
+        self.outputs['db1002'] = '0'
+        results = mysql.set_core_masters_readonly_and_verify('dc1', True)
+
+        self.assertFalse([result for result in results if result.host == 'db1002'][0].ok)
+        args, kwargs = self.remotes['dc1'].submit.call_args
+        self.assertNotIn('SET GLOBAL', args[0])
+        self.assertTrue(kwargs['is_safe'])
+
+
+class TestLagMonitor(unittest.TestCase):
+
+    def setUp(self):
+        self.monitor = mysql.LagMonitor('dc1', 'dc2')
+
+    def test_no_samples(self):
+        self.assertIsNone(self.monitor.lag('s1'))
+        self.assertIsNone(self.monitor.rate('s1'))
+        self.assertIsNone(self.monitor.eta('s1'))
+        self.assertIn('s1   lag=unknown', self.monitor.report())
+
+    def test_steady_lag(self):
+        for i in xrange(5):
+            self.monitor.record('s1', 100 + i * 10, 20.0)
+        self.assertEqual(self.monitor.lag('s1'), 20.0)
+        self.assertEqual(self.monitor.rate('s1'), 0.0)
+        self.assertEqual(self.monitor.eta('s1'), 20.0)
+
+    def test_decreasing_lag(self):
+        for i in xrange(5):
+            self.monitor.record('s1', 100 + i * 10, 30.0 - i * 5)
+        self.assertAlmostEqual(self.monitor.rate('s1'), 0.5)
+        self.assertAlmostEqual(self.monitor.eta('s1'), 10.0 / 1.5)
+
+    def test_growing_lag(self):
+        for i in xrange(5):
+            self.monitor.record('s1', 100 + i * 10, 10.0 + i * 5)
+        self.assertAlmostEqual(self.monitor.rate('s1'), -0.5)
+        self.assertAlmostEqual(self.monitor.eta('s1'), 60.0)
+
+    def test_stalled_replica(self):
+        for i in xrange(5):
+            self.monitor.record('s1', 100 + i * 10, 10.0 + i * 10)
+        self.assertAlmostEqual(self.monitor.rate('s1'), -1.0)
+        self.assertAlmostEqual(self.monitor.eta('s1'), 50.0 / mysql.LAG_MONITOR_MIN_SPEED)
+
+    def test_window(self):
+        monitor = mysql.LagMonitor('dc1', 'dc2', window=2)
+        for i in xrange(5):
+            monitor.record('s1', 100 + i * 10, 10.0 + i)
+        self.assertAlmostEqual(monitor.rate('s1'), -0.1)
+
+    def test_exceeding(self):
+        for shard in mysql.CORE_SHARDS:
+            self.monitor.record(shard, 100, 60.0 if shard == 's2' else 1.0)
+        self.assertDictEqual(self.monitor.exceeding(30), {'s2': 60.0})
+
+    @mock.patch('switchdc.lib.mysql.submit_query')
+    @mock.patch('switchdc.lib.mysql.get_db_remotes')
+    def test_sample(self, mocked_remotes, mocked_submit):
+        mocked_remotes.return_value = get_remotes({'s1': 'db2001', 's2': 'db2002'})
+
+        def submit(remote, query, **kwargs):
+            self.assertIn("datacenter = 'dc1'", query)
+            kwargs['on_result']('db2001', 0, '1.5')
+            kwargs['on_result']('db2002', 0, 'NULL')
+            return StubRun('db2001', 0, '')
+
+        mocked_submit.side_effect = submit
+        self.monitor.sample()
+        self.assertEqual(self.monitor.lag('s1'), 1.5)
+        self.assertIsNone(self.monitor.lag('s2'))
+
+
+class TestSubmitQuery(unittest.TestCase):
+
+    def test_format_rows(self):
+        self.assertEqual(mysql.format_rows([(1, None, 'a'), (2, 0, 'b')]), '1\tNULL\ta\n2\t0\tb')
+        self.assertEqual(mysql.format_rows([]), '')
+
+    @mock.patch('switchdc.lib.mysql.get_native_client', return_value=None)
+    def test_submit_query_cumin(self, mocked_client):
+        remote = mock.Mock()
+        mysql.submit_query(remote, 'SET GLOBAL read_only=1', 'SELECT @@global.read_only', is_safe=False)
+        remote.submit.assert_called_once_with(
+            mysql.get_query_command('SET GLOBAL read_only=1; SELECT @@global.read_only'), is_safe=False)
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=False)
+    @mock.patch('switchdc.lib.mysql.get_native_client')
+    def test_submit_query_joins_pool(self, mocked_client, mocked_dry_run):
+        mocked_client.return_value.query.return_value = [(1,)]
+        run = mysql.submit_query(mock.Mock(hosts=['host1', 'host2']), 'SELECT 1')
+        pool = run._pool
+        self.assertEqual(run.wait(), 0)
+        self.assertDictEqual(run.results, {'host1': '1', 'host2': '1'})
+        self.assertIsNone(run._pool)
+        self.assertFalse(any(worker.is_alive() for worker in pool._pool))
+
+
+class TestNativeClient(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Start a MariaDB instance in a docker container and expose it on port 13306 on localhost
+        cls.docker = DockerManager(base_config_dir, 'mysql', tag='0.1')
+        cls.docker.run('switchdc_mysql-1', ports={'3306/tcp': 13306}, detach=True)
+        cls.client = mysql.NativeClient('switchdc', 'switchdc', port=13306)
+        for _ in xrange(30):  # Wait for MariaDB to accept connections
+            if not cls.client.preconnect(['127.0.0.1']):
+                break
+            time.sleep(1)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.client.close()
+        cls.docker.cleanup()
+
+    def setUp(self):
+        self.results = []
+
+    def on_result(self, host, rc, output):
+        self.results.append((host, rc, output))
+
+    def test_preconnect(self):
+        self.assertListEqual(self.client.preconnect(['127.0.0.1']), [])
+        self.assertEqual(len(self.client.pool('127.0.0.1')._idle), self.client.pool_size)
+
+    def test_preconnect_unreachable(self):
+        client = mysql.NativeClient('switchdc', 'switchdc', port=13307, connect_timeout=1)
+        self.assertListEqual(client.preconnect(['127.0.0.1']), ['127.0.0.1'])
+
+    def test_query_typed(self):
+        self.assertListEqual(self.client.query('127.0.0.1', "SELECT 1, NULL, 'a'"), [(1, None, 'a')])
+
+    def test_query_same_session(self):
+        self.assertListEqual(self.client.query('127.0.0.1', 'SET @switchdc = 5', 'SELECT @switchdc'), [(5,)])
+
+    def test_query_reuses_connections(self):
+        self.client.preconnect(['127.0.0.1'])
+        idle = list(self.client.pool('127.0.0.1')._idle)
+        self.client.query('127.0.0.1', 'SELECT 1')
+        self.assertItemsEqual(self.client.pool('127.0.0.1')._idle, idle)
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=False)
+    @mock.patch('switchdc.lib.mysql.get_native_client')
+    def test_submit_query(self, mocked_client, mocked_dry_run):
+        mocked_client.return_value = self.client
+        run = mysql.submit_query(mock.Mock(hosts=['127.0.0.1']), 'SET GLOBAL read_only=1',
+                                 'SELECT @@global.read_only', on_result=self.on_result)
+        self.assertEqual(run.wait(), 0)
+        self.assertDictEqual(run.results, {'127.0.0.1': '1'})
+        self.assertListEqual(self.results, [('127.0.0.1', 0, '1')])
+        self.assertListEqual(self.client.query('127.0.0.1', 'SET GLOBAL read_only=0', 'SELECT @@global.read_only'),
+                             [(0,)])
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=False)
+    @mock.patch('switchdc.lib.mysql.get_native_client')
+    def test_submit_query_failure(self, mocked_client, mocked_dry_run):
+        mocked_client.return_value = self.client
+        run = mysql.submit_query(mock.Mock(hosts=['127.0.0.1']), 'SELECT invalid', on_result=self.on_result)
+        with self.assertRaisesRegexp(RemoteExecutionError, '1'):
+            run.wait()
+        self.assertListEqual(self.results, [('127.0.0.1', 1, '')])
+
+    @mock.patch('switchdc.lib.mysql.is_dry_run', return_value=True)
+    @mock.patch('switchdc.lib.mysql.get_native_client')
+    def test_submit_query_dry_run(self, mocked_client, mocked_dry_run):
+        mocked_client.return_value = self.client
+        run = mysql.submit_query(mock.Mock(hosts=['127.0.0.1']), 'SET GLOBAL read_only=1', on_result=self.on_result)
+        self.assertEqual(run.wait(), 0)
+        self.assertListEqual(self.results, [])
+        self.assertListEqual(self.client.query('127.0.0.1', 'SELECT @@global.read_only'), [(0,)])
@@ -1,10 +1,12 @@
 import os
 import unittest
 
+import mock
 import redis
 
 from switchdc.tests import base_config_dir, DockerManager
-from switchdc.lib.redis_cluster import RedisInstance, RedisShardsBase
+from switchdc.lib.redis_cluster import (BacklogResult, ConnectionRegistry, ParityResult, RedisInstance,
+                                        RedisShardsBase)
 
 
 class TestRedisBase(unittest.TestCase):
@@ -60,6 +62,15 @@ class TestRedisInstance(TestRedisBase):
         self.assertFalse(self.red_from.is_master)
         self.assertEqual(self.red_from.slave_of, str(self.red_to))
 
+    def test_replication_snapshot(self):
+        self.assertTrue(self.red_from.is_master)
+        # Changes not done through the instance are visible only after a refresh
+        self.red_from.client.slaveof('127.0.0.1', 16380)
+        self.assertTrue(self.red_from.is_master)
+        self.assertEqual(self.red_from.refresh()['role'], 'slave')
+        self.assertFalse(self.red_from.is_master)
+        self.red_from.client.slaveof()
+
     def test_str(self):
         self.assertEqual(str(self.red_from), '127.0.0.1:16379')
 
@@ -79,3 +90,115 @@ class TestRedisShardsBase(TestRedisBase):
 
     def test_datacenters(self):
         self.assertListEqual(sorted(self.rs.datacenters), ['from', 'to'])
+
+    def test_refresh(self):
+        self.rs.refresh('to')
+        self.assertIsNotNone(self.rs.shards['to']['shard1']._replication)
+        self.assertIsNone(self.rs.shards['from']['shard1']._replication)
+        self.rs.refresh()
+        self.assertEqual(self.rs.shards['from']['shard1']._replication['role'], 'master')
+
+    def test_preconnect(self):
+        self.assertListEqual(self.rs.preconnect(), [])
+        # The connections are shared across instances
+        rs = RedisShardsBase('sessions', self.config_dir, None)
+        self.assertIs(rs.shards['to']['shard1'].client.connection_pool,
+                      self.rs.shards['to']['shard1'].client.connection_pool)
+
+    def test_check_parity(self):
+        results = self.rs.check_parity('from', 'to', timeout=5)
+        self.assertListEqual(results.keys(), ['shard1'])
+        self.assertEqual(results['shard1'].shard, 'shard1')
+        # The inverse direction is not replicating
+        self.assertIsNone(self.rs.check_parity('to', 'from', timeout=5)['shard1'].converged)
+
+
+class TestShardParity(unittest.TestCase):
+
+    def setUp(self):
+        self.master = mock.MagicMock(keys_count=10)
+        self.master.__str__.return_value = '127.0.0.1:16379'
+        self.master.refresh.return_value = {'role': 'master', 'master_repl_offset': 1000}
+        self.replica = mock.MagicMock(slave_of='127.0.0.1:16379', keys_count=8)
+
+    @mock.patch('switchdc.lib.redis_cluster.time.sleep')
+    def test_converged(self, mocked_sleep):
+        self.replica.refresh.side_effect = [{'role': 'slave'}, {'role': 'slave', 'slave_repl_offset': 900},
+                                            {'role': 'slave', 'slave_repl_offset': 1000}]
+        result = RedisShardsBase._check_shard_parity('shard1', self.master, self.replica, float('inf'))
+        self.assertEqual(result[:4], ('shard1', 0, 2, True))
+        self.assertFalse(result.syncing)
+        mocked_sleep.assert_called_once_with(0.1)
+
+    def test_not_converged(self):
+        self.replica.refresh.return_value = {'role': 'slave', 'slave_repl_offset': 900}
+        result = RedisShardsBase._check_shard_parity('shard1', self.master, self.replica, 0)
+        self.assertEqual(result[:4], ('shard1', 100, 2, False))
+
+    def test_not_replicating(self):
+        self.replica.refresh.return_value = {'role': 'master'}
+        result = RedisShardsBase._check_shard_parity('shard1', self.master, self.replica, 0)
+        self.assertEqual(result, ParityResult('shard1', None, None, None, 0.0, False))
+
+    def test_syncing(self):
+        self.replica.refresh.return_value = {'role': 'slave', 'slave_repl_offset': 1000, 'master_link_status': 'down',
+                                             'master_sync_in_progress': 1}
+        result = RedisShardsBase._check_shard_parity('shard1', self.master, self.replica, 0)
+        self.assertEqual(result[:4], ('shard1', 0, 2, False))
+        self.assertTrue(result.syncing)
+
+
+class TestConnectionRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = ConnectionRegistry()
+
+    def test_get_pool(self):
+        pool = self.registry.get_pool('127.0.0.1', 16379)
+        self.assertIs(self.registry.get_pool('127.0.0.1', 16379), pool)
+        self.assertIsNot(self.registry.get_pool('127.0.0.1', 16380), pool)
+        self.assertIsNot(self.registry.get_pool('127.0.0.1', 16379, db=1), pool)
+
+    def test_instance_shares_pool(self):
+        first = RedisInstance('127.0.0.1', 16379, registry=self.registry)
+        second = RedisInstance('127.0.0.1', 16379, registry=self.registry)
+        self.assertIsInstance(first.client, redis.StrictRedis)
+        self.assertIs(first.client.connection_pool, second.client.connection_pool)
+
+    def test_health_check(self):
+        reachable = mock.MagicMock()
+        unreachable = mock.MagicMock()
+        unreachable.client.ping.side_effect = redis.ConnectionError('refused')
+        self.assertListEqual(self.registry.health_check([reachable, unreachable]), [unreachable])
+        unreachable.client.connection_pool.disconnect.assert_called_once_with()
+        self.assertFalse(reachable.client.connection_pool.disconnect.called)
+
+
+class TestCheckBacklog(unittest.TestCase):
+
+    def setUp(self):
+        self.rs = RedisShardsBase('sessions', os.path.join(base_config_dir, 'stages.d', 't06_redis'), None)
+        self.master = mock.MagicMock()
+        self.master.refresh.side_effect = [{'master_repl_offset': 1000}, {'master_repl_offset': 6000}]
+        self.replica = mock.MagicMock()
+        self.rs.shards = {'from': {'shard1': self.master}, 'to': {'shard1': self.replica}}
+
+    @mock.patch('switchdc.lib.redis_cluster.time')
+    def test_psync(self, mocked_time):
+        mocked_time.time.side_effect = [100, 105]
+        self.replica.refresh.return_value = {'slave_repl_offset': 5500, 'repl_backlog_active': 1,
+                                             'repl_backlog_size': 1024 ** 2, 'repl_backlog_histlen': 6000}
+        results = self.rs.check_backlog('from', 'to', interval=5, window=60)
+        self.assertEqual(results['shard1'], BacklogResult('shard1', 1024 ** 2, 6000, 500, 1000.0, 60500, True))
+
+    @mock.patch('switchdc.lib.redis_cluster.time')
+    def test_full_sync(self, mocked_time):
+        mocked_time.time.side_effect = [100, 105]
+        self.replica.refresh.return_value = {'slave_repl_offset': 6000, 'repl_backlog_active': 1,
+                                             'repl_backlog_size': 50000, 'repl_backlog_histlen': 6000}
+        self.assertFalse(self.rs.check_backlog('from', 'to', interval=5, window=60)['shard1'].psync)
+
+    def test_failure(self):
+        self.master.refresh.side_effect = redis.ConnectionError('refused')
+        self.assertEqual(self.rs.check_backlog('from', 'to', interval=0)['shard1'],
+                         BacklogResult('shard1', None, None, None, None, None, False))
@@ -1,8 +1,14 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
 import unittest
 
 import mock
 
-from switchdc.lib.remote import Remote, RemoteExecutionError
+from switchdc.lib.remote import (AdaptiveBatch, get_streaming_handler, get_timeout_command, Inventory, inventory,
+                                 OutputCollector, Remote, RemoteExecutionError, wait_all)
 
 
 class StubNode(object):
@@ -11,12 +17,177 @@ class StubNode(object):
         self.name = name
         self.state = mock.MagicMock()
         self.state.is_failed = failed
+        self.state.is_success = not failed
         self.running_command_index = 1
 
 
+class StubEventHandler(object):
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.nodes = {'srv01': StubNode('srv01', False), 'srv02': StubNode('srv02', False)}
+        for node in self.nodes.values():
+            node.running_command_index = 0
+
+    def ev_read(self, worker):
+        pass
+
+    def ev_hup(self, worker):
+        self.nodes[worker.current_node].running_command_index += 1
+
+
+class TestStreamingHandler(unittest.TestCase):
+
+    def setUp(self):
+        self.results = []
+        self.worker = mock.Mock()
+
+    def on_result(self, host, rc, output):
+        self.results.append((host, rc, output))
+        return rc == 0
+
+    def event(self, handler, event, host, rc=0, msg=''):
+        self.worker.current_node = host
+        self.worker.current_rc = rc
+        self.worker.current_msg = msg
+        getattr(handler, event)(self.worker)
+
+    def test_streaming_lines(self):
+        lines = []
+        handler = get_streaming_handler(StubEventHandler, self.on_result, on_line=lambda *args: lines.append(args))
+        handler = handler(['command1'])
+        self.event(handler, 'ev_read', 'srv01', msg='line1')
+        self.event(handler, 'ev_hup', 'srv01')
+        self.assertListEqual(lines, [('srv01', 'line1')])
+        self.assertListEqual(self.results, [('srv01', 0, '')])
+
+    def test_streaming(self):
+        handler = get_streaming_handler(StubEventHandler, self.on_result)(['command1', 'command2'])
+        self.event(handler, 'ev_read', 'srv01', msg='line1')
+        self.event(handler, 'ev_hup', 'srv01')
+        self.assertListEqual(self.results, [])  # srv01 has still one command to run
+        self.event(handler, 'ev_read', 'srv01', msg='line2')
+        self.event(handler, 'ev_hup', 'srv01')
+        self.assertListEqual(self.results, [('srv01', 0, 'line1\nline2')])
+        self.worker.task.abort.assert_not_called()
+
+    def test_abort(self):
+        handler = get_streaming_handler(StubEventHandler, self.on_result)(['command1', 'command2'])
+        self.event(handler, 'ev_hup', 'srv02', rc=1)
+        self.assertListEqual(self.results, [('srv02', 1, '')])
+        self.worker.task.abort.assert_called_once_with()
+
+
+class TestGetTimeoutCommand(unittest.TestCase):
+
+    def test_get_timeout_command(self):
+        self.assertEqual(get_timeout_command("echo 'a' && sleep 5", 3),
+                         """timeout --kill-after=10 3 sh -c 'echo '"'"'a'"'"' && sleep 5'""")
+
+
+class TestOutputCollector(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.output = OutputCollector(patterns=[r'^\+ added', 'missing'], tail_size=2, max_matches=1,
+                                      output_dir=self.output_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.output_dir)
+
+    def test_collect(self):
+        for line in ('+ added 1', 'line 2', '+ added 3', 'line 4'):
+            self.output.add_line('srv01', line)
+        self.output.add_line('srv02', 'other')
+        self.assertEqual(self.output.complete('srv01', 0), '+ added 3\nline 4')
+        self.output.close()
+
+        srv01 = self.output.get('srv01')
+        self.assertEqual(srv01.rc, 0)
+        self.assertEqual(srv01.lines, 4)
+        self.assertListEqual(srv01.matches[r'^\+ added'], ['+ added 1'])
+        self.assertTrue(srv01.matched(r'^\+ added'))
+        self.assertFalse(srv01.matched('missing'))
+        self.assertEqual(srv01.digest, hashlib.sha1('+ added 1\nline 2\n+ added 3\nline 4\n').hexdigest())
+        self.assertIsNone(self.output.get('srv02').rc)
+        self.assertListEqual(list(self.output.read('srv01')), ['+ added 1', 'line 2', '+ added 3', 'line 4'])
+        self.assertListEqual(list(self.output.read('srv02')), ['other'])
+
+    def test_append(self):
+        self.output.add_line('srv01', 'first')
+        self.output.close()
+        self.output.add_line('srv01', 'second')
+        self.output.close()
+        self.assertListEqual(list(self.output.read('srv01')), ['first', 'second'])
+
+    def test_output_dir(self):
+        output_dir = os.path.join(self.output_dir, 'missing')
+        OutputCollector(output_dir=output_dir)
+        self.assertTrue(os.path.isdir(output_dir))
+
+
+class TestAdaptiveBatch(unittest.TestCase):
+
+    def test_max_size(self):
+        self.assertEqual(AdaptiveBatch(min_pooled=0.8).max_size(100), 20)
+        self.assertEqual(AdaptiveBatch(min_pooled=0.99).max_size(10), 1)
+        self.assertEqual(AdaptiveBatch(min_pooled=0.8, max_batch=5).max_size(100), 5)
+
+    def test_next_size(self):
+        batch = AdaptiveBatch(max_latency=10.0, max_failure_ratio=0.1, min_pooled=0.8)
+        self.assertEqual(batch.next_size(4, 100, 5.0, 0.0), 8)
+        self.assertEqual(batch.next_size(16, 100, 5.0, 0.0), 20)  # Capped by the pooled capacity floor
+        self.assertEqual(batch.next_size(20, 100, 11.0, 0.0), 10)
+        self.assertEqual(batch.next_size(1, 100, 5.0, 0.5), 1)
+        self.assertListEqual(batch.timeline, [(4, 5.0, 0.0), (16, 5.0, 0.0), (20, 11.0, 0.0), (1, 5.0, 0.5)])
+
+
+class TestInventory(unittest.TestCase):
+
+    def setUp(self):
+        self.inventory = Inventory(ttl=60)
+
+    def test_get_store(self):
+        self.assertIsNone(self.inventory.get('some_query'))
+        self.inventory.store('some_query', {'srv01', 'srv02'})
+        self.assertEqual(self.inventory.get('some_query'), {'srv01', 'srv02'})
+        self.assertEqual((self.inventory.hits, self.inventory.misses), (1, 1))
+
+    @mock.patch('switchdc.lib.remote.time.time')
+    def test_ttl(self, time_mock):
+        time_mock.return_value = 1000
+        self.inventory.store('some_query', {'srv01'})
+        time_mock.return_value = 1059
+        self.assertEqual(self.inventory.get('some_query'), {'srv01'})
+        time_mock.return_value = 1060
+        self.assertIsNone(self.inventory.get('some_query'))
+
+    def test_site_index(self):
+        self.assertIsNone(self.inventory.site_hosts('site1', count_miss=False))
+        self.inventory.index_site('site1', {'srv01', 'srv02'})
+        self.inventory.index_site('site2', {'srv03'})
+        self.assertEqual(self.inventory.site_hosts('site1'), {'srv01', 'srv02'})
+        self.assertEqual(self.inventory.site_hosts('site2'), {'srv03'})
+        self.assertEqual((self.inventory.hits, self.inventory.misses), (2, 0))
+
+    def test_invalidate(self):
+        self.inventory.store('query1', {'srv01'})
+        self.inventory.store('query2', {'srv02'})
+        self.inventory.index_site('site1', {'srv01'})
+        self.inventory.invalidate('query1')
+        self.assertIsNone(self.inventory.get('query1'))
+        self.assertEqual(self.inventory.get('query2'), {'srv02'})
+        self.inventory.invalidate()
+        self.assertIsNone(self.inventory.get('query2'))
+        self.assertIsNone(self.inventory.site_hosts('site1'))
+
+
 @mock.patch('switchdc.lib.remote.Remote.query')
 class TestRemote(unittest.TestCase):
 
+    def setUp(self):
+        inventory.invalidate()
+
     def test_init(self, query_mock):
         r = Remote()
         r._site = None
@@ -26,11 +197,22 @@ class TestRemote(unittest.TestCase):
         query_mock.assert_called_with('R:Ganglia::Cluster%site = some_site')
         self.assertEqual(r._site, {'a', 'b', 'c', 'd'})
         self.assertEqual(r.hosts, [])
+        # A second instance for the same site uses the site index
+        query_mock.reset_mock()
+        r = Remote(site='some_site')
+        query_mock.assert_not_called()
+        self.assertEqual(r._site, {'a', 'b', 'c', 'd'})
 
     def test_query(self, query_mock):
         Remote.query('my_query')
         query_mock.assert_called_with('my_query')
 
+    def test_query_many(self, query_mock):
+        query_mock.side_effect = lambda query: {query + '_host'}
+        self.assertListEqual(Remote.query_many('q1', 'q2', 'q1'), [{'q1_host'}, {'q2_host'}, {'q1_host'}])
+        self.assertEqual(query_mock.call_count, 2)
+        self.assertListEqual(Remote.query_many(), [])
+
     def test_select(self, query_mock):
         query_mock.return_value = {'srv01', 'srv02', 'srv03', 'srv04'}
         r = Remote(site='some_site')
@@ -54,12 +236,164 @@ class TestRemote(unittest.TestCase):
         r.select(Remote.query('some_query'))
         self.assertEqual(r.sync('command1', 'command2', some_kwarg='value'), 0)
         exec_mock.side_effect = RemoteExecutionError(1)
-        worker_mock = mock.Mock()
-        worker_mock._handler_instance.nodes.itervalues.return_value = [
-            StubNode('srv02', False),
-            StubNode('srv03', True)]
-        r.worker = worker_mock
         with self.assertRaises(RemoteExecutionError) as e:
             r.sync('command1', 'command2')
             self.assertEqual(e.message, 1)
+
+    @mock.patch('switchdc.lib.remote.get_streaming_handler')
+    @mock.patch('switchdc.lib.remote.Transport.new')
+    def test_failures(self, transport_mock, handler_mock, query_mock):
+        query_mock.return_value = {'srv02', 'srv03'}
+        r = Remote()
+        r.select('some_query')
+        worker = transport_mock.return_value
+        worker.execute.return_value = 1
+        worker._handler_instance.nodes.itervalues.return_value = [StubNode('srv02', False), StubNode('srv03', True)]
+        with self.assertRaises(RemoteExecutionError):
+            r.sync('command1', 'command2', is_safe=True)
         self.assertEqual(r.failures[1], ['srv03'])
+
+    @mock.patch('switchdc.lib.remote.Remote._run')
+    def test_submit(self, run_mock, query_mock):
+        run_mock.return_value = 0
+        query_mock.return_value = {'srv01', 'srv02'}
+        r = Remote()
+        r.select('some_query')
+        run = r.submit('command1', 'command2', mode='async', batch_size=1)
+        self.assertEqual(run.wait(), 0)
+        self.assertTrue(run.done())
+        self.assertIsNot(run.remote, r)
+        self.assertListEqual(sorted(run.hosts), ['srv01', 'srv02'])
+        run_mock.assert_called_once_with('async', ('command1', 'command2'), batch_size=1)
+        self.assertDictEqual(run.results, {})
+
+    @mock.patch('switchdc.lib.remote.Remote._run')
+    def test_wait_all(self, run_mock, query_mock):
+        run_mock.side_effect = [RemoteExecutionError(1), 0]
+        r = Remote()
+        runs = [r.submit('command1'), r.submit('command2')]
+        with self.assertRaises(RemoteExecutionError):
+            wait_all(runs)
+        self.assertTrue(all(run.done() for run in runs))
+
+    @mock.patch('switchdc.lib.remote.get_streaming_handler')
+    @mock.patch('switchdc.lib.remote.Transport.new')
+    def test_results(self, transport_mock, handler_mock, query_mock):
+        query_mock.return_value = {'srv01', 'srv02'}
+        r = Remote()
+        r.select('some_query')
+        self.assertDictEqual(r.results, {})
+        output = mock.Mock()
+        output.message.return_value = 'output'
+        worker = transport_mock.return_value
+        worker.execute.return_value = 0
+        worker.get_results.return_value = [(['srv01', 'srv02'], output)]
+        self.assertEqual(r.sync('command', is_safe=True), 0)
+        # The results are a snapshot taken at the end of the execution
+        worker.get_results.return_value = []
+        self.assertDictEqual(r.results, {'srv01': 'output', 'srv02': 'output'})
+
+    @mock.patch('switchdc.lib.remote.OutputCollector')
+    @mock.patch('switchdc.lib.remote.get_streaming_handler')
+    @mock.patch('switchdc.lib.remote.Transport.new')
+    def test_output_restores_msgtree(self, transport_mock, handler_mock, output_mock, query_mock):
+        query_mock.return_value = {'srv01'}
+        r = Remote()
+        r.select('some_query')
+        task = transport_mock.return_value.task
+        task.default.return_value = True
+        transport_mock.return_value.execute.side_effect = RemoteExecutionError(1)
+        with self.assertRaises(RemoteExecutionError):
+            r.sync('command', is_safe=True, output=output_mock())
+
+        self.assertListEqual(task.set_default.call_args_list, [
+            mock.call('stdout_msgtree', False), mock.call('stderr_msgtree', False),
+            mock.call('stdout_msgtree', True), mock.call('stderr_msgtree', True)])
+        output_mock.return_value.close.assert_called_once_with()
+
+    @mock.patch('switchdc.lib.remote.Remote.sync')
+    def test_prewarm(self, sync_mock, query_mock):
+        query_mock.return_value = {'srv01', 'srv02', 'srv03'}
+        r = Remote()
+        r.select('some_query')
+        r.worker = mock.Mock()
+        r.worker._handler_instance.nodes.itervalues.return_value = [StubNode('srv01', False), StubNode('srv02', True)]
+        self.assertListEqual(r.prewarm(), ['srv02', 'srv03'])
+        sync_mock.assert_called_once_with('true', success_threshold=0.0, is_safe=True)
+
+    @mock.patch('switchdc.lib.remote.Remote._run', autospec=True)
+    def test_run_adaptive(self, run_mock, query_mock):
+        query_mock.return_value = {'srv{:02d}'.format(i) for i in xrange(1, 11)}
+        r = Remote()
+        r.select('some_query')
+        failing = r.hosts[4]
+
+        def run(remote, mode, commands, on_result=None, **kwargs):
+            host = remote.hosts[0]
+            rc = 1 if host == failing else 0
+            remote._results = {host: 'output'}
+            remote._failures = {1: [host]} if rc else {}
+            on_result(host, rc, '')
+
+        run_mock.side_effect = run
+        batch = AdaptiveBatch(initial=1, max_failure_ratio=0.0, min_pooled=0.8)
+        self.assertEqual(r._run_adaptive('sync', ['command'], batch, success_threshold=0.8), 0)
+        # Each host is executed on its own in a sliding window of at most 2 hosts
+        self.assertListEqual(sorted(call[0][0].hosts[0] for call in run_mock.call_args_list), sorted(r.hosts))
+        self.assertEqual(sum(size for size, _, _ in batch.timeline), 10)
+        self.assertLessEqual(max(size for size, _, _ in batch.timeline), 2)
+        self.assertEqual(batch.timeline[0][0], 1)
+        self.assertEqual(len([ratio for _, _, ratio in batch.timeline if ratio > 0]), 1)
+        # The results and the failures of all the hosts
+        self.assertListEqual(sorted(r.results.keys()), sorted(r.hosts))
+        self.assertDictEqual(dict(r.failures), {1: [failing]})
+
+        run_mock.reset_mock()
+        batch = AdaptiveBatch(initial=1, min_pooled=0.8)
+        with self.assertRaises(RemoteExecutionError):
+            r._run_adaptive('sync', ['command'], batch)
+        self.assertLess(run_mock.call_count, 10)
+        self.assertEqual(sum(size for size, _, _ in batch.timeline), run_mock.call_count)
+
+    @mock.patch('switchdc.lib.remote.Remote._run', autospec=True)
+    def test_run_early(self, run_mock, query_mock):
+        query_mock.return_value = {'srv01', 'srv02', 'srv03', 'srv04'}
+        r = Remote()
+        r.select('some_query')
+        returned = []
+
+        def run(remote, mode, commands, on_result=None, **kwargs):
+            for host in remote.hosts[:3]:
+                returned.append(on_result(host, 0, ''))
+            if returned[-1] is False:  # Aborted by the execution itself
+                raise RemoteExecutionError(2)
+            return 0
+
+        run_mock.side_effect = run
+        self.assertEqual(r._run_early('sync', ['command'], False, success_threshold=0.75), 0)
+        self.assertListEqual(r.stragglers, [r.hosts[3]])
+        self.assertListEqual(returned, [None, None, False])
+
+        # If the threshold is not met the whole execution is waited for
+        run_mock.side_effect = lambda remote, *args, **kwargs: 0
+        self.assertEqual(r._run_early('sync', ['command'], False), 0)
+        self.assertListEqual(r.stragglers, [])
+
+    @mock.patch('switchdc.lib.remote.Remote._run', autospec=True)
+    def test_run_early_keep_stragglers(self, run_mock, query_mock):
+        query_mock.return_value = {'srv01', 'srv02'}
+        r = Remote()
+        r.select('some_query')
+        release = threading.Event()
+        returned = []
+
+        def run(remote, mode, commands, on_result=None, **kwargs):
+            returned.append(on_result(remote.hosts[0], 0, ''))
+            release.wait(5)
+            returned.append(on_result(remote.hosts[1], 0, ''))
+            return 0
+
+        run_mock.side_effect = run
+        self.assertEqual(r._run_early('sync', ['command'], True, success_threshold=0.5), 0)
+        self.assertListEqual(r.stragglers, [r.hosts[1]])
+        release.set()  # The straggler completes in background without being aborted
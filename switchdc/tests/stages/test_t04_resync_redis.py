@@ -1,9 +1,13 @@
+import os
 import socket
+import unittest
 
 import mock
+import redis
 
 import switchdc.stages.t04_resync_redis as stage
 
+from switchdc.tests import base_config_dir
 from switchdc.tests.lib.test_redis_cluster import TestRedisBase
 
 
@@ -40,3 +44,110 @@ class TestRedisShards(TestRedisBase):
         self.assertEqual([str(self.red_to)], self.rs.check_parallel('to'))
         pool.map.assert_called_with(stage.wait_for_master, [self.red_to])
         mock_pool.assert_called_with(1)
+
+
+class TestWaitForMasterProgress(unittest.TestCase):
+
+    def setUp(self):
+        stage.progress.reset()
+        self.instance = mock.MagicMock()
+        self.instance.__str__.return_value = '127.0.0.1:16380'
+
+    @staticmethod
+    def syncing(read_bytes, left_bytes, last_io=0):
+        return {'role': 'slave', 'master_link_status': 'down', 'master_sync_in_progress': 1,
+                'master_sync_read_bytes': read_bytes, 'master_sync_left_bytes': left_bytes,
+                'master_sync_last_io_seconds_ago': last_io}
+
+    @mock.patch('switchdc.stages.t04_resync_redis.time.sleep')
+    def test_wait_for_master_progress(self, mocked_sleep):
+        synced = {'role': 'slave', 'master_link_status': 'up', 'master_sync_in_progress': 0}
+        self.instance.client.info.side_effect = [self.syncing(0, 3000), self.syncing(1000, 2000),
+                                                 self.syncing(2000, 1000), synced]
+        self.assertEqual(stage.wait_for_master(self.instance), (self.instance, True))
+        self.assertIn('synced 1/1', stage.progress.summary(1))
+        # The polling backs off
+        sleeps = [call[0][0] for call in mocked_sleep.call_args_list]
+        self.assertListEqual(sleeps, sorted(sleeps))
+        self.assertLess(sleeps[0], sleeps[-1])
+
+    @mock.patch('switchdc.stages.t04_resync_redis.time.sleep')
+    def test_wait_for_master_stalled(self, mocked_sleep):
+        self.instance.client.info.side_effect = [self.syncing(1000, 2000), self.syncing(1000, 2000, last_io=60)]
+        self.assertEqual(stage.wait_for_master(self.instance), (self.instance, False))
+        self.assertEqual(self.instance.client.info.call_count, 2)
+
+    @mock.patch('switchdc.stages.t04_resync_redis.STALL_TIMEOUT', 0)
+    @mock.patch('switchdc.stages.t04_resync_redis.time.sleep')
+    def test_wait_for_master_bgsave(self, mocked_sleep):
+        synced = {'role': 'slave', 'master_link_status': 'up', 'master_sync_in_progress': 0}
+        # Not stalled while the master is still generating the RDB and no byte has been transferred yet
+        self.instance.client.info.side_effect = [self.syncing(0, -1), self.syncing(0, -1), synced]
+        self.assertEqual(stage.wait_for_master(self.instance), (self.instance, True))
+
+    @mock.patch('switchdc.stages.t04_resync_redis.time.sleep')
+    def test_wait_for_master_connection_error(self, mocked_sleep):
+        synced = {'role': 'slave', 'master_link_status': 'up', 'master_sync_in_progress': 0}
+        self.instance.client.info.side_effect = [redis.ConnectionError, redis.ConnectionError, synced]
+        self.assertEqual(stage.wait_for_master(self.instance), (self.instance, True))
+        self.assertEqual(mocked_sleep.call_args_list.count(mock.call(stage.CONNECTION_RETRY_SLEEP)), 2)
+
+    def test_summary(self):
+        stage.progress.update('a', read_bytes=1024 ** 2, left_bytes=3 * 1024 ** 2, throughput=1024 ** 2, eta=3)
+        stage.progress.update('b', synced=True, read_bytes=1024 ** 2)
+        self.assertEqual(stage.progress.summary(3), 'synced 1/3, transferred 2.0MB, left 3.0MB, '
+                                                    'throughput 1.0MB/s, max ETA 3s')
+
+
+class TestRollingRestart(unittest.TestCase):
+
+    def setUp(self):
+        self.rs = stage.RedisShards('sessions', os.path.join(base_config_dir, 'stages.d', 't06_redis'), None)
+        self.rs.shards['from'] = {}
+        self.rs.shards['to'] = {}
+        for i, host in enumerate(('rdb1001', 'rdb1001', 'rdb1001', 'rdb1002')):
+            shard = 'shard{i}'.format(i=i)
+            self.rs.shards['from'][shard] = self.get_instance(host, 6379 + i)
+            self.rs.shards['to'][shard] = self.get_instance(host.replace('1', '2', 1), 6379 + i)
+
+    @staticmethod
+    def get_instance(host, port, bgsave=0):
+        instance = mock.MagicMock(host=host, port=port)
+        instance.client.info.return_value = {'rdb_bgsave_in_progress': bgsave}
+        return instance
+
+    @mock.patch('switchdc.stages.t04_resync_redis.MAX_SYNCS_PER_HOST', 2)
+    def test_next_wave(self):
+        pending = sorted(self.rs.shards['to'].items())
+        self.assertListEqual([shard for shard, _ in self.rs._next_wave(pending, 'from')],
+                             ['shard0', 'shard1', 'shard3'])
+        # A BGSAVE already in progress reduces the capacity of the host
+        self.rs.shards['from']['shard0'].client.info.return_value = {'rdb_bgsave_in_progress': 1}
+        self.assertListEqual([shard for shard, _ in self.rs._next_wave(pending, 'from')], ['shard0', 'shard3'])
+
+    @mock.patch('switchdc.stages.t04_resync_redis.MAX_SYNCS_PER_HOST', 1)
+    @mock.patch('switchdc.stages.t04_resync_redis.get_redis_hosts')
+    @mock.patch('switchdc.stages.t04_resync_redis.restart_instances')
+    def test_rolling_restart(self, mocked_restart, mocked_hosts):
+        with mock.patch.object(self.rs, 'check_parallel', return_value=[]) as mocked_check:
+            self.assertListEqual(self.rs.rolling_restart('to', 'from'), [])
+
+        mocked_hosts.assert_called_once_with('to')
+        self.assertEqual(mocked_restart.call_count, 3)
+        self.assertListEqual([call[1]['instances'] for call in mocked_check.call_args_list],
+                             [call[0][1] for call in mocked_restart.call_args_list])
+        self.assertEqual(len(mocked_restart.call_args_list[0][0][1]), 2)
+
+    @mock.patch('switchdc.stages.t04_resync_redis.wait_all')
+    @mock.patch('switchdc.stages.t04_resync_redis.Remote')
+    def test_restart_instances(self, mocked_remote, mocked_wait):
+        hosts = {'rdb2001': 'rdb2001.codfw.wmnet', 'rdb2002': 'rdb2002.codfw.wmnet'}
+        stage.restart_instances('to', [self.rs.shards['to']['shard0'], self.rs.shards['to']['shard1']], hosts)
+
+        mocked_remote.assert_called_once_with(site='to')
+        mocked_remote.return_value.select.assert_called_once_with({'rdb2001.codfw.wmnet'})
+        mocked_remote.return_value.submit.assert_called_once_with(
+            'systemctl restart redis-instance-tcp_6379 redis-instance-tcp_6380')
+
+        with self.assertRaises(stage.RedisSwitchError):
+            stage.restart_instances('to', [self.rs.shards['to']['shard3']], {})
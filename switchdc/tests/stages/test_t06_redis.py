@@ -1,8 +1,11 @@
+import unittest
+
 import mock
 
 import switchdc.stages.t06_redis as stage
 
 from switchdc import SwitchdcError
+from switchdc.lib.redis_cluster import ParityResult, RedisSwitchError
 from switchdc.tests.lib.test_redis_cluster import TestRedisBase
 
 
@@ -41,6 +44,29 @@ class TestRedisShards(TestRedisBase):
         self.rs.stop_replica('from')
 
 
+class TestVerifyParity(unittest.TestCase):
+
+    @mock.patch.object(stage.RedisShards, '__init__', return_value=None)
+    def setUp(self, mocked_init):
+        self.rs = stage.RedisShards()
+        self.rs.cluster = 'sessions'
+        self.rs.dry_run = False
+        self.rs.check_parity = mock.Mock(return_value={
+            'shard1': ParityResult('shard1', 0, 0, True, 0.5, False),
+            'shard2': ParityResult('shard2', 100, 2, False, 30.0, True)})
+
+    def test_verify_parity(self):
+        with self.assertRaisesRegexp(RedisSwitchError, '3'):
+            self.rs.verify_parity('from', 'to')
+
+    @mock.patch('switchdc.stages.t06_redis.logger')
+    def test_verify_parity_not_strict(self, mocked_logger):
+        self.rs.verify_parity('to', 'from', strict=False)
+        self.rs.check_parity.assert_called_once_with('to', 'from')
+        self.assertIn('shard2 (still syncing', mocked_logger.warning.call_args[0][0])
+        self.assertFalse(mocked_logger.error.called)
+
+
 class TestStage(TestRedisBase):
 
     def setUp(self):
@@ -61,3 +87,26 @@ class TestStage(TestRedisBase):
         # The first cluster has no instances, so no redis call is actually made
         self.assertTrue(self.red_from.is_master)
         self.assertEqual(self.red_to.slave_of, str(self.red_from))
+
+
+class TestRunParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.servers = [mock.Mock(cluster='jobqueue'), mock.Mock(cluster='sessions')]
+
+    def test_run_parallel(self):
+        stage.run_parallel(lambda shards: shards.stop_replica('to'), self.servers, 3)
+        for shards in self.servers:
+            shards.stop_replica.assert_called_once_with('to')
+
+    def test_run_parallel_generic_failure(self):
+        self.servers[0].stop_replica.side_effect = ValueError('Bad, sorry')
+        with self.assertRaisesRegexp(SwitchdcError, '3'):
+            stage.run_parallel(lambda shards: shards.stop_replica('to'), self.servers, 3)
+        # The other cluster is inverted anyway
+        self.servers[1].stop_replica.assert_called_once_with('to')
+
+    def test_run_parallel_redis_failure(self):
+        self.servers[1].start_replica.side_effect = RedisSwitchError(2)
+        with self.assertRaisesRegexp(RedisSwitchError, '2'):
+            stage.run_parallel(lambda shards: shards.start_replica('from', 'to'), self.servers, 4)
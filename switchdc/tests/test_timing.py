@@ -0,0 +1,64 @@
+import unittest
+
+import mock
+
+from switchdc.timing import timed, timed_call, timed_generator, timings, Timings
+
+
+class TestTimings(unittest.TestCase):
+
+    def setUp(self):
+        self.timings = Timings()
+        for duration in (0.2, 0.4, 0.6, 0.8, 2.0):
+            self.timings.record('op', duration)
+
+    def test_percentile(self):
+        self.assertEqual(self.timings.percentile('op', 50), 0.6)
+        self.assertEqual(self.timings.percentile('op', 99), 2.0)
+        self.assertIsNone(self.timings.percentile('other', 50))
+
+    def test_histogram(self):
+        histogram = dict(self.timings.histogram('op'))
+        self.assertEqual(histogram[0.5], 2)
+        self.assertEqual(histogram[1], 2)
+        self.assertEqual(histogram[5], 1)
+        self.assertEqual(sum(histogram.values()), 5)
+
+    def test_hosts(self):
+        self.timings.record('run', 1.0, host='srv01')
+        self.timings.record('run', 3.0, host='srv01')
+        self.timings.record('run', 2.0, host='srv02')
+        self.assertListEqual(self.timings.slowest_hosts('run', num=1), [('srv01', 3.0)])
+        self.assertListEqual(sorted(self.timings.durations('run')), [2.0, 3.0])
+
+    def test_summary(self):
+        self.timings.record('run', 1.0, host='srv01')
+        summary = self.timings.summary()
+        self.assertEqual(len(summary), 2)
+        self.assertTrue(summary[0].startswith('op: count=5, total=4.000s, p50=0.600s'))
+        self.assertIn('slowest hosts: srv01=1.000s', summary[1])
+        self.timings.reset()
+        self.assertListEqual(self.timings.summary(), [])
+
+
+@mock.patch('switchdc.timing.time.time')
+class TestTimed(unittest.TestCase):
+
+    def setUp(self):
+        timings.reset()
+
+    def test_timed(self, time_mock):
+        time_mock.side_effect = [10.0, 12.5]
+        with timed('op'):
+            pass
+        self.assertListEqual(timings.durations('op'), [2.5])
+
+    def test_timed_call(self, time_mock):
+        time_mock.side_effect = [10.0, 11.0]
+        self.assertEqual(timed_call('op')(lambda x: x * 2)(2), 4)
+        self.assertListEqual(timings.durations('op'), [1.0])
+
+    def test_timed_generator(self, time_mock):
+        time_mock.side_effect = [10.0, 13.0]
+        self.assertListEqual(list(timed_generator('op')(lambda: iter([1, 2]))()), [1, 2])
+        self.assertListEqual(timings.durations('op'), [3.0])
@@ -0,0 +1,172 @@
+import functools
+import threading
+import time
+
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket collects everything above
+HISTOGRAM_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+PERCENTILES = (50, 95, 99)
+
+
+class Timings(object):
+    """Collect the latency of the operations executed during a task."""
+
+    def __init__(self):
+        """Timings constructor."""
+        self._lock = threading.Lock()
+        self._durations = defaultdict(list)  # Operation: list of durations
+        self._hosts = defaultdict(dict)  # Operation: {host: slowest duration}
+
+    def record(self, operation, duration, host=None):
+        """Record the duration of an operation.
+
+        Arguments:
+        operation -- the name of the operation type
+        duration  -- the duration in seconds
+        host      -- the host to which the duration refers to, if any. [optional, default: None]
+        """
+        with self._lock:
+            if host is None:
+                self._durations[operation].append(duration)
+            else:
+                self._hosts[operation][host] = max(duration, self._hosts[operation].get(host, 0))
+
+    def reset(self):
+        """Discard all the recorded durations."""
+        with self._lock:
+            self._durations.clear()
+            self._hosts.clear()
+
+    def histogram(self, operation):
+        """Return the latency histogram of an operation as a list of (upper bound, count) tuples.
+
+        Arguments:
+        operation -- the name of the operation type
+        """
+        buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+        for duration in self.durations(operation):
+            for i, bound in enumerate(HISTOGRAM_BUCKETS):
+                if duration <= bound:
+                    buckets[i] += 1
+                    break
+            else:
+                buckets[-1] += 1
+
+        return zip(HISTOGRAM_BUCKETS + (float('inf'),), buckets)
+
+    def percentile(self, operation, percentile):
+        """Return the given percentile of the durations of an operation, None if there are no durations.
+
+        Arguments:
+        operation  -- the name of the operation type
+        percentile -- the percentile to calculate, between 0 and 100
+        """
+        durations = sorted(self.durations(operation))
+        if not durations:
+            return None
+
+        index = int(round(percentile / 100.0 * (len(durations) - 1)))
+        return durations[index]
+
+    def durations(self, operation):
+        """Return the list of recorded durations of an operation, including the per-host ones.
+
+        Arguments:
+        operation -- the name of the operation type
+        """
+        with self._lock:
+            return list(self._durations.get(operation, [])) + self._hosts.get(operation, {}).values()
+
+    def slowest_hosts(self, operation, num=5):
+        """Return the list of (host, duration) tuples of the slowest hosts of an operation.
+
+        Arguments:
+        operation -- the name of the operation type
+        num       -- the number of hosts to return. [optional, default: 5]
+        """
+        with self._lock:
+            hosts = self._hosts.get(operation, {}).items()
+
+        return sorted(hosts, key=lambda item: item[1], reverse=True)[:num]
+
+    def summary(self):
+        """Return a list of summary lines, one per operation type."""
+        with self._lock:
+            operations = sorted(set(self._durations.keys()) | set(self._hosts.keys()))
+
+        lines = []
+        for operation in operations:
+            durations = self.durations(operation)
+            percentiles = ', '.join('p{p}={value:.3f}s'.format(p=p, value=self.percentile(operation, p))
+                                    for p in PERCENTILES)
+            line = '{operation}: count={count}, total={total:.3f}s, {percentiles}, max={max:.3f}s'.format(
+                operation=operation, count=len(durations), total=sum(durations), percentiles=percentiles,
+                max=max(durations))
+
+            histogram = ', '.join('<={bound}s:{count}'.format(bound=bound, count=count)
+                                  for bound, count in self.histogram(operation) if count)
+            line += ', histogram: {histogram}'.format(histogram=histogram)
+
+            slowest = self.slowest_hosts(operation)
+            if slowest:
+                line += ', slowest hosts: {hosts}'.format(hosts=', '.join(
+                    '{host}={duration:.3f}s'.format(host=host, duration=duration) for host, duration in slowest))
+
+            lines.append(line)
+
+        return lines
+
+
+timings = Timings()
+
+
+@contextmanager
+def timed(operation):
+    """Context manager to record the duration of the enclosed block.
+
+    Arguments:
+    operation -- the name of the operation type
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        timings.record(operation, time.time() - start)
+
+
+def timed_call(operation):
+    """Decorator to record the duration of each call of the decorated function.
+
+    Arguments:
+    operation -- the name of the operation type
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(operation):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def timed_generator(operation):
+    """Decorator to record the duration of the decorated generator, from the first call until it's exhausted.
+
+    Arguments:
+    operation -- the name of the operation type
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timed(operation):
+                for item in func(*args, **kwargs):
+                    yield item
+
+        return wrapper
+
+    return decorator